@@ -0,0 +1,1628 @@
+####################################################################################################
+# prpo_lib.py
+# Classes and helpers of prpo_main.py that do not depend on its configuration or connections, so
+# they can be imported on their own (tests/).
+####################################################################################################
+import json
+import pymysql.cursors
+from datetime import datetime
+from collections import defaultdict, deque, namedtuple
+import logging
+import pathlib
+import itertools
+from operator import itemgetter, attrgetter
+import time
+import io
+import os
+import tempfile
+import subprocess
+import threading
+import concurrent.futures
+import contextlib
+import ctypes
+import ctypes.util
+import select
+import struct
+import sqlite3
+import hashlib
+from decimal import Decimal
+
+####################################################################################################
+# Key of a PR/PO line item.
+# Keys are normalized (nbr, line_nbr) tuples instead of a server-side concat(nbr, ':', line_nbr),
+# so '00010' from the datafile and 10 from the table are the same key and membership is a set lookup.
+####################################################################################################
+def line_item_key(nbr, line_nbr):
+    nbr = str(nbr).strip()
+    line_nbr = str(line_nbr).strip()
+    try:
+        return nbr, int(line_nbr)
+    except ValueError:
+        return nbr, line_nbr
+
+####################################################################################################
+# State of an invalid PR/PO record, as get_invalid_records() reads it keyed by line_item_key().
+# It is the state written by the *_invalid_product_site_aqid_UPDATE_SQL statements (status_id last),
+# normalized to strings so a row can be routed to insert/update/soft-delete with one dict lookup and
+# a record that already holds what would be written is not rewritten.
+####################################################################################################
+def invalid_record_state(*values):
+    state = []
+    for value in values:
+        value = '' if value is None else str(value).strip()
+        state.append(str(int(value)) if value.isdigit() else value)
+
+    return tuple(state)
+
+####################################################################################################
+# split aq_id
+####################################################################################################
+def parse_aqid(aq_id):
+    items = aq_id.split('-')
+    a_equipment_id = items[0]
+    a_equipment_version = items[1]
+    if len(items) == 3:
+        a_equipment_type = items[2]
+    elif len(items) == 2:
+        a_equipment_type = ''
+
+    return a_equipment_id, a_equipment_version, a_equipment_type
+
+####################################################################################################
+# get equipment_id, equipment_db_id from aq_id
+# RETRO spend appends the '-R' retro suffix to the AQ_ID before it is looked up.
+####################################################################################################
+def normalize_aqid(aq_id, spend_type_description):
+    return (aq_id + "-R") if (spend_type_description == 'RETRO' and aq_id[-2:] != '-R') else aq_id
+
+####################################################################################################
+# Comparable key of an AQ_ID: (a_equipment_id, a_equipment_version, a_equipment_type).
+# With strip_zeros, numeric parts lose their leading zeros, which matches both the numeric comparison
+# MySQL does in "a_equipment_id = '00123'" and the LPAD(a_equipment_id,5,0) / LPAD(a_equipment_version,2,0)
+# form of the uid; without it the parts are compared as written. A missing type is '' as in
+# ifnull(a_equipment_type,''); upper() follows the case-insensitive collation.
+# Returns None for an AQ_ID parse_aqid() cannot split.
+####################################################################################################
+def aqid_key(a_equipment_id, a_equipment_version, a_equipment_type, strip_zeros=True):
+    key = []
+    for item in (a_equipment_id, a_equipment_version, a_equipment_type):
+        item = '' if item is None else str(item).strip().upper()
+        key.append((item.lstrip('0') or '0') if strip_zeros and item.isdigit() else item)
+
+    return tuple(key)
+
+def parse_aqid_key(aq_id, strip_zeros=True):
+    try:
+        return aqid_key(*parse_aqid(aq_id), strip_zeros=strip_zeros)
+    except (IndexError, NameError):
+        return None
+
+####################################################################################################
+# Resolves AQ_IDs to (equipment_id, equipment_db_id) with one gh_bom_equipment query per chunk of
+# distinct AQ_IDs. The WHERE clause only filters on a_equipment_id so the index can be used; version
+# and type are matched here. An AQ_ID is matched as written first (aqid_key() without strip_zeros),
+# and only without an exact match by its key without leading zeros, so '010' and '10' stay apart
+# when both are in gh_bom_equipment; such stored ids are logged once. As in the old per-row query,
+# an AQ_ID that matches more than one equipment is not mapped. Unknown AQ_IDs are cached as None
+# and never queried again.
+####################################################################################################
+class EquipmentResolver:
+    equipment_SELECT_SQL = """
+            SELECT
+                equipment_id,
+                db_id as equipment_db_id,
+                a_equipment_id,
+                a_equipment_version,
+                a_equipment_type
+            FROM
+                gh_bom_equipment
+            WHERE
+                a_equipment_id in %s"""
+
+    def __init__(self, conn, chunk_size=1000):
+        self.conn = conn
+        self.chunk_size = chunk_size
+        # keyed by the exact key of the AQ_ID.
+        self.equipment = {}
+        self.collisions = set()
+        self.num_queries = 0
+
+    def prefetch(self, aq_ids):
+        keys = {}
+        for aq_id in aq_ids:
+            key = parse_aqid_key(aq_id, strip_zeros=False)
+            if key is None:
+                continue
+            if key not in self.equipment:
+                keys[key] = aqid_key(*key)
+
+        keys = list(keys.items())
+        for i in range(0, len(keys), self.chunk_size):
+            chunk = dict(keys[i:i + self.chunk_size])
+            # the AQ_ID as it appears in the datafile and its normalized form, in case a_equipment_id is a varchar.
+            a_equipment_ids = set(key[0] for key in chunk) | set(key[0] for key in chunk.values())
+            normalized_keys = set(chunk.values())
+            exact_matches, matches = defaultdict(list), defaultdict(list)
+            stored_keys = defaultdict(set)
+            try:
+                with self.conn.cursor() as cursor:
+                    cursor.execute(self.equipment_SELECT_SQL, (tuple(a_equipment_ids),))
+                    self.num_queries += 1
+                    for row in cursor.fetchall():
+                        exact_key = aqid_key(row['a_equipment_id'], row['a_equipment_version'], row['a_equipment_type'], strip_zeros=False)
+                        key = aqid_key(*exact_key)
+                        if key in normalized_keys:
+                            equipment = (row['equipment_id'], row['equipment_db_id'])
+                            exact_matches[exact_key].append(equipment)
+                            matches[key].append(equipment)
+                            stored_keys[key].add(exact_key)
+            except Exception as sqlerr:
+                logging.critical('ERROR: equipment_SELECT_SQL in EquipmentResolver.prefetch() ' + str(sqlerr))
+                raise
+
+            for key, exact_keys in stored_keys.items():
+                if len(exact_keys) > 1 and key not in self.collisions:
+                    self.collisions.add(key)
+                    logging.warning('gh_bom_equipment AQ_IDs ' + ', '.join(sorted('-'.join(exact_key).rstrip('-') for exact_key in exact_keys)) +
+                                    ' are the same without leading zeros; only an exact AQ_ID match maps them.')
+
+            for exact_key, key in chunk.items():
+                equipment = exact_matches.get(exact_key) or matches.get(key)
+                self.equipment[exact_key] = equipment[0] if equipment and len(equipment) == 1 else None
+
+    def resolve(self, aq_id):
+        key = parse_aqid_key(aq_id, strip_zeros=False)
+        if key is None:
+            return None
+        if key not in self.equipment:
+            self.prefetch([aq_id])
+
+        return self.equipment[key]
+
+####################################################################################################
+# Decodes the rows of a csv.reader over a datafile, after its header, into records of the given
+# columns: namedtuples read as row.PURCHASE_REQUISITION_NBR. The column positions are looked up in
+# the header once and every record is cut out of its row with one itemgetter. Blank lines are
+# skipped, as csv.DictReader did. With typed the columns in column_types are converted once (empty
+# values stay ''); a row that is too short or has a value that does not convert is logged and
+# skipped, and counted in num_malformed and in malformed_rows (a DiagnosticsCollector) by column, or
+# 'too few columns'. Without typed every value is the string csv.DictReader gave, or None for a
+# missing column.
+####################################################################################################
+def parse_line_nbr(value):
+    return int(value)
+
+def parse_amount(value):
+    amount = Decimal(value)
+    if not amount.is_finite():
+        raise ValueError('not a number: ' + value)
+    return amount
+
+def parse_date(value):
+    # date format from datafile is: yyyy-mm-dd; MySQL gets the string as before.
+    datetime.strptime(value, '%Y-%m-%d')
+    return value
+
+PR_COLUMN_TYPES = {'PURCH_REQ_LINE_NBR': parse_line_nbr,
+                   'REQUEST_DATE': parse_date,
+                   'TOTAL_AMOUNT': parse_amount,
+                   'PRICE_PER_UNIT': parse_amount,
+                   'QUANTITY': parse_amount}
+
+PO_COLUMN_TYPES = {'PURCH_ORDER_LINE_NBR': parse_line_nbr,
+                   'EAPPROVAL_PR_LINE_NBR': parse_line_nbr,
+                   'PO_DATE': parse_date,
+                   'PO_QUANTITY': parse_amount,
+                   'NET_PRICE': parse_amount,
+                   'NET_VALUE': parse_amount,
+                   'EFFECTIVE_VALUE': parse_amount,
+                   'GR_QUANTITY': parse_amount}
+
+class RowDecoder:
+    def __init__(self, headers, columns, column_types, typed=False, malformed_rows=None):
+        positions = {header.strip(' '): position for position, header in enumerate(headers)}
+        columns = list(columns)
+        self.record = namedtuple('DatafileRecord', columns)
+        self.row_len = max(positions[column] for column in columns) + 1
+        self.getter = itemgetter(*[positions[column] for column in columns])
+        self.converters = [(index, column_types[column]) for index, column in enumerate(columns) if column in column_types] if typed else []
+        self.typed = typed
+        self.num_malformed = 0
+        self.malformed_rows = malformed_rows
+
+    def decode(self, rows):
+        make_record, getter, converters = self.record._make, self.getter, self.converters
+        # line 1 is the header.
+        for line_nbr, values in enumerate(rows, 2):
+            if not values:
+                continue
+
+            if len(values) < self.row_len:
+                if self.typed:
+                    self.malformed(line_nbr, 'too few columns', 'has ' + str(len(values)) + ' columns')
+                    continue
+                values = values + [None] * (self.row_len - len(values))
+
+            record = getter(values)
+            if converters:
+                record = list(record)
+                try:
+                    for index, convert in converters:
+                        if record[index] != '':
+                            record[index] = convert(record[index])
+                except (ValueError, ArithmeticError) as err:
+                    self.malformed(line_nbr, self.record._fields[index], self.record._fields[index] + ' ' + repr(record[index]) + ' ' + str(err))
+                    continue
+
+            yield make_record(record)
+
+    def malformed(self, line_nbr, code, reason):
+        self.num_malformed += 1
+        if self.malformed_rows is not None:
+            self.malformed_rows.add(code, 'line ' + str(line_nbr))
+        logging.error('Skipping malformed row on line ' + str(line_nbr) + ' of the datafile: ' + reason)
+
+####################################################################################################
+# Declarative description of a feed: its name ('PR'/'PO'), line item table and db_col_mapping (table
+# column => datafile column, in the column order of the INSERT, the two key columns first), the
+# RowDecoder column_types of its datafile, and what the one loader of prpo_main.py
+# (processing_line_items()) does differently per feed:
+#   site_column     the column with the SAP site code
+#   pr_columns      columns with the PR line a line belongs to (PO: pr_nbr, pr_line_nbr); they are
+#                   written to the invalid table and gh_pr_po_file, and their pr_nbr is consolidated
+#   with_status     status_id is written on INSERT too (PO)
+#   insert_deleted  a D of a line that is not stored inserts it with status_id 0 (PO)
+# The statements of the feed are generated from it, each with a builder of its parameters:
+#   insert_SQL          datafile columns, gh ids, created[, status_id]
+#   raw_insert_SQL      datafile columns, gh ids, gh_product_name, gh_site, created[, status_id]
+#   update_SQL          other datafile columns, gh ids, updated, status_id WHERE the key columns
+#   raw_update_SQL      other datafile columns, gh ids, gh_product_name, gh_site, updated[, status_id] WHERE ...
+#   status_UPDATE_SQL   record_type, updated, status_id WHERE ...
+#   invalid_insert_SQL  pr_columns, key columns, aq_id, gh ids, category, description, updated
+#   invalid_update_SQL  pr_columns, aq_id, gh ids, description, status_id, updated WHERE ...
+#   invalid_delete_SQL  updated, status_id WHERE ...
+# [, status_id] is only there with_status. A builder, e.g. update_params(row, values), takes a
+# RowDecoder record of the db_col_mapping columns and the values of the other columns, in the order
+# above, and picks the parameters out of row + values with one itemgetter. invalid_state(row, values)
+# is the invalid_record_state() of pr_columns + values (aq_id, gh ids, description, status_id), as
+# get_invalid_records() reads invalid_state_columns; provenance_params(row, (file_name, created))
+# builds a gh_pr_po_file row of provenance_columns.
+#
+# with_hash ([PERFORMANCE] skip_unchanged_rows) adds a content_hash column to every line item
+# statement, set to the content_hash argument of the builder. content_hash(row, values) fingerprints
+# what a line item is written with, except timestamps; a status update clears it, so the next I/U of
+# the line is written. The column has to be added to both line item tables, in the main and in the
+# conveyor database:
+#   ALTER TABLE gh_eapproval_pr_line_item ADD COLUMN content_hash CHAR(40) NULL;
+#   ALTER TABLE gh_sap_po_line_item ADD COLUMN content_hash CHAR(40) NULL;
+####################################################################################################
+class FeedSchema:
+    GH_COLUMNS = ['gh_product_id', 'gh_site_id', 'gh_equipment_id', 'gh_equipment_db_id']
+    RAW_COLUMNS = GH_COLUMNS + ['gh_product_name', 'gh_site']
+    INVALID_STATE_COLUMNS = ['aq_id'] + GH_COLUMNS + ['description', 'status_id']
+
+    def __init__(self, name, table, db_col_mapping, column_types, invalid_table, site_column, pr_columns=(),
+                 with_status=False, insert_deleted=False, with_hash=False):
+        self.name = name
+        self.table = table
+        self.db_col_mapping = db_col_mapping
+        self.column_types = column_types
+        self.columns = list(db_col_mapping)
+        self.key_columns = self.columns[:2]
+        self.invalid_table = invalid_table
+        self.site_column = site_column
+        self.pr_columns = list(pr_columns)
+        self.with_status = with_status
+        self.insert_deleted = insert_deleted
+        self.with_hash = with_hash
+        status = ['status_id'] if with_status else []
+        content_hash = ['content_hash'] if with_hash else []
+
+        self.insert_SQL, self.insert_params = self.insert(self.columns, self.GH_COLUMNS + ['created'] + status + content_hash)
+        self.raw_insert_SQL, self.raw_insert_params = self.insert(self.columns, self.RAW_COLUMNS + ['created'] + status + content_hash)
+        self.update_SQL, self.update_params = self.update(self.columns[2:], self.GH_COLUMNS + ['updated', 'status_id'] + content_hash)
+        self.raw_update_SQL, self.raw_update_params = self.update(self.columns[2:], self.RAW_COLUMNS + ['updated'] + status + content_hash)
+        self.status_UPDATE_SQL, self.status_params = self.update([], ['record_type', 'updated', 'status_id'] + content_hash)
+
+        self.invalid_insert_SQL, self.invalid_insert_params = self.insert(self.pr_columns + self.key_columns,
+                                                                          ['aq_id'] + self.GH_COLUMNS + ['category', 'description', 'updated'],
+                                                                          invalid_table)
+        self.invalid_update_SQL, self.invalid_update_params = self.update(self.pr_columns, self.INVALID_STATE_COLUMNS + ['updated'], invalid_table)
+        self.invalid_delete_SQL, self.invalid_delete_params = self.update([], ['updated', 'status_id'], invalid_table)
+        self.invalid_state_columns = self.pr_columns + self.INVALID_STATE_COLUMNS
+        state_getter = itemgetter(*self.positions(self.pr_columns, self.INVALID_STATE_COLUMNS))
+        self.invalid_state = lambda row, values: invalid_record_state(*state_getter(row + values))
+
+        self.provenance_columns = self.key_columns + self.pr_columns + ['file_name', 'created']
+        self.provenance_params = self.builder(self.positions(self.key_columns + self.pr_columns, ['file_name', 'created']))
+
+        # PR nbr and line, PO nbr and line of a row, as the email report lists them ('' for a PR).
+        if self.pr_columns:
+            report_getter = itemgetter(*self.positions(self.pr_columns + self.key_columns, []))
+        else:
+            report_getter = itemgetter(*self.positions(self.key_columns, ['', '']))
+        self.report_key = lambda row: report_getter(row + ('', ''))
+
+    def insert(self, row_columns, value_columns, table=None):
+        columns = row_columns + value_columns
+        sql = "INSERT INTO " + (table or self.table) + " (" + ", ".join(columns) + ") VALUES (" + ", ".join(['%s'] * len(columns)) + ")"
+        return sql, self.builder(self.positions(row_columns, value_columns))
+
+    def update(self, row_columns, value_columns, table=None):
+        sql = ("UPDATE " + (table or self.table) + " SET " + ", ".join(column + " = %s" for column in row_columns + value_columns) +
+               " WHERE " + " AND ".join(column + " = %s" for column in self.key_columns))
+        return sql, self.builder(self.positions(row_columns, value_columns) + self.positions(self.key_columns, []))
+
+    def positions(self, row_columns, value_columns):
+        # where row_columns are in a row and value_columns in the values after it.
+        return ([self.columns.index(column) for column in row_columns] +
+                [len(self.columns) + index for index in range(len(value_columns))])
+
+    def builder(self, positions):
+        getter = itemgetter(*positions)
+        if self.with_hash:
+            def params(row, values, content_hash=None):
+                return getter(row + values + (content_hash,))
+        else:
+            def params(row, values, content_hash=None):
+                return getter(row + values)
+        return params
+
+    def row_getter(self, *columns):
+        # the values of db_col_mapping columns in a row.
+        return itemgetter(*[self.columns.index(column) for column in columns])
+
+    @staticmethod
+    def content_hash(row, values):
+        content = '\x1f'.join('\x00' if value is None else str(value) for value in row + values)
+        return hashlib.sha1(content.encode('utf-8', 'surrogateescape')).hexdigest()
+
+PR_DB_COL_MAPPING = { 'pr_nbr': 'PURCHASE_REQUISITION_NBR',
+                      'pr_line_nbr': 'PURCH_REQ_LINE_NBR',
+                      'pr_status_desc': 'PR_STATUS_DESCRIPTION',
+                      'company_code': 'COMPANY_CODE',
+                      'currency_code': 'CURRENCY_CODE',
+                      'request_date': 'REQUEST_DATE',
+                      'material_description': 'MATERIAL_DESCRIPTION',
+                      'total_amount': 'TOTAL_AMOUNT',
+                      'price_per_unit': 'PRICE_PER_UNIT',
+                      'quantity': 'QUANTITY',
+                      'model_number': 'MODEL_NUMBER',
+                      'aq_id': 'AQ_ID',
+                      'project_nbr': 'PROJECT_NBR',
+                      'spend_type_code': 'SPEND_TYPE_CODE',
+                      'functional_location_code': 'FUNCTIONAL_LOCATION_CODE',
+                      'spend_type_description': 'SPEND_TYPE_DESCRIPTION',
+                      'functional_location_description': 'FUNCTIONAL_LOCATION_DESCRIPTION',
+                      'destination': 'DESTINATION',
+                      'vendor_number': 'VENDOR_NUMBER',
+                      'vendor_name': 'VENDOR_NAME',
+                      'initiator': 'INITIATOR',
+                      'cost_center_nbr': 'COST_CENTER_NBR',
+                      'record_type': 'RECORD_TYPE' }
+
+PO_DB_COL_MAPPING = {'po_nbr': 'PURCHASE_ORDER_NUMBER',
+                     'po_line_nbr': 'PURCH_ORDER_LINE_NBR',
+                     'material_description': 'MATERIAL_DESCRIPTION',
+                     'company_code': 'COMPANY_CODE',
+                     'tracking_no': 'TRACKING_NO',
+                     'po_quantity': 'PO_QUANTITY',
+                     'net_price': 'NET_PRICE',
+                     'net_value': 'NET_VALUE',
+                     'effective_value': 'EFFECTIVE_VALUE',
+                     'pr_nbr': 'EAPPROVAL_PR_NBR',
+                     'pr_line_nbr': 'EAPPROVAL_PR_LINE_NBR',
+                     'initiator': 'NAME_OF_INITIATOR',
+                     'vendor_name': 'VENDOR_NAME',
+                     'functional_location': 'FUNCTIONAL_LOCATION',
+                     'project_nbr': 'PROJECT_NBR',
+                     'aq_id': 'AQID',
+                     'po_status': 'PO_STATUS',
+                     'spend_type_code': 'SPEND_TYPE_CODE',
+                     'spend_type_description': 'SPEND_TYPE_DESC',
+                     'currency': 'CURRENCY',
+                     'order_unit': 'ORDER_UNIT',
+                     'order_price_unit': 'ORDER_PRICE_UNIT',
+                     'gr_quantity': 'GR_QUANTITY',
+                     'record_type': 'RECORD_TYPE',
+                     'po_date': 'PO_DATE',
+                     'po_item_deleted_flag': 'PO_ITEM_DELETED_FLAG' }
+
+####################################################################################################
+# Finds the rows of a datafile whose line item write a later row supersedes (nbr_col, line_nbr_col,
+# compared as line_item_key()), so a line that appears several times in one file is only written to
+# the line item tables once. Reading the rows back to front, a row is superseded when a later row of
+# its line is an I or U (which writes the whole line again), or when it is a D and a later row of
+# its line is a D too. A D keeps the last I/U before it, so the line is still written and then
+# marked deleted. Rows of other record types are never superseded. With writes, only the rows for
+# which writes(row) is true take part: a row the loader does not write (its product, site or AQ_ID
+# does not map) neither supersedes an earlier row of its line nor is superseded. collapse() reads
+# all rows first and returns them in file order, with a parallel list of whether each is superseded;
+# the rows are still processed (gh_pr_po_file, invalid records), only their writes are skipped.
+# num_collapsed counts the superseded rows.
+####################################################################################################
+class DuplicateLineCollapser:
+    def __init__(self, nbr_col, line_nbr_col):
+        self.line_getter = attrgetter(nbr_col, line_nbr_col)
+        self.num_collapsed = 0
+
+    def collapse(self, rows, writes=None):
+        rows = list(rows)
+        superseded = [False] * len(rows)
+        written, deleted = set(), set()
+        for index in range(len(rows) - 1, -1, -1):
+            row = rows[index]
+            if row.RECORD_TYPE not in ('I', 'U', 'D') or (writes is not None and not writes(row)):
+                continue
+
+            key = line_item_key(*self.line_getter(row))
+            if key in written or (row.RECORD_TYPE == 'D' and key in deleted):
+                superseded[index] = True
+                self.num_collapsed += 1
+            elif row.RECORD_TYPE == 'D':
+                deleted.add(key)
+            else:
+                written.add(key)
+
+        return rows, superseded
+
+####################################################################################################
+# Collects the codes (SAP site codes, aq_ids) of a datafile that could not be mapped. Every code is
+# counted, but only the first sample_size PR/PO lines of each code are kept, so a file full of
+# unmapped codes costs no more than one count per distinct code. render() returns one line per
+# code, most frequent first, with at most max_codes codes and a line counting the rest.
+####################################################################################################
+class DiagnosticsCollector:
+    def __init__(self, title, sample_size):
+        self.title = title
+        self.sample_size = sample_size
+        self.counts = defaultdict(int)
+        self.samples = defaultdict(list)
+        self.total = 0
+
+    def __len__(self):
+        return self.total
+
+    def add(self, code, line):
+        self.total += 1
+        self.counts[code] += 1
+        if len(self.samples[code]) < self.sample_size:
+            self.samples[code].append(line)
+
+    def render(self, max_codes=200):
+        codes = sorted(self.counts, key=lambda code: -self.counts[code])
+        summary = self.title + ' ' + str(self.total) + ' recs, ' + str(len(codes)) + ' codes\n'
+        for code in codes[:max_codes]:
+            more = self.counts[code] - len(self.samples[code])
+            summary += (code or "''") + ': ' + str(self.counts[code]) + ' (' + ', '.join(self.samples[code]) + (', +' + str(more) + ' more' if more else '') + ')\n'
+        if len(codes) > max_codes:
+            summary += '+' + str(len(codes) - max_codes) + ' more codes\n'
+        return summary
+
+####################################################################################################
+# Yields the datafile rows unchanged, resolving the AQ_IDs of every chunk_size rows before they are processed.
+####################################################################################################
+def prefetch_equipment(rows, equipment_resolver, aqid_col, spend_type_col, chunk_size):
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            return
+
+        equipment_resolver.prefetch(normalize_aqid(getattr(row, aqid_col), getattr(row, spend_type_col)) for row in chunk if getattr(row, aqid_col))
+        yield from chunk
+
+####################################################################################################
+# Validation rules compiled from check_valid_product_and_site() and check_invalid_aqid_with_kpr_release().
+# Both result sets are turned into frozensets of id tuples once per file, so classifying a row is
+# two hash lookups instead of comparing a new dict against every dict in a list.
+# classify() returns (category, description), or (None, None) for a valid record.
+####################################################################################################
+INVALID_PRODUCT_SITE = 'Invalid product and site'
+NO_KPR_RELEASE = 'No KPR release for AQ_ID'
+
+class ValidationRules:
+    __slots__ = ('valid_product_sites', 'invalid_aqid_kpr_release')
+
+    def __init__(self, valid_product_sites, invalid_aqid_kpr_release):
+        self.valid_product_sites = frozenset((row['product_id'], row['site_id']) for row in valid_product_sites)
+        self.invalid_aqid_kpr_release = frozenset((row['product_id'], row['site_id'], row['equipment_id'], row['equipment_db_id'])
+                                                  for row in invalid_aqid_kpr_release)
+
+    def classify(self, product_id, site_id, equipment_id, equipment_db_id, project_nbr='', site_code='', aq_id=''):
+        ####################################################################
+        # Is Functional Location a valid site for a given product?
+        ####################################################################
+        if (product_id, site_id) not in self.valid_product_sites:
+            return INVALID_PRODUCT_SITE, project_nbr + " and " + site_code + " are not valid MP site in ghDS."
+
+        ####################################################################
+        # Does AQID have KPR release? AQID has KPR release if (qty > 0)
+        ####################################################################
+        if (product_id, site_id, equipment_id, equipment_db_id) in self.invalid_aqid_kpr_release:
+            return NO_KPR_RELEASE, 'No KPR release for: ' + str(aq_id)
+
+        return None, None
+
+# the reference data a datafile is validated against (see load_reference_data() in prpo_main.py).
+ReferenceData = namedtuple('ReferenceData', ['products', 'sites', 'validation_rules'])
+
+# the values a ReferenceDataCache snapshot can hold.
+SNAPSHOT_SCALARS = (str, int, float, type(None))
+
+####################################################################################################
+# Cache of ReferenceData shared by the datafiles of all cycles ([PERFORMANCE] reference_cache_*).
+# get() reloads it when it is older than ttl_seconds or, with probe, when reference_probe_SELECT_SQL
+# returns something else than when it was loaded. The probe sees rows added, removed or (de)activated
+# and changed release quantities; anything else is picked up when the TTL expires.
+# With snapshot_file the cache is written as JSON after every load and read back at startup, if still
+# fresh; a snapshot that does not have the shape snapshot_json() writes is ignored (see read_snapshot()).
+# ttl_seconds = 0 loads the reference data for every file, as before. load(conn, parallel) loads it
+# (load_reference_data() in prpo_main.py).
+####################################################################################################
+class ReferenceDataCache:
+    reference_probe_SELECT_SQL = """
+        SELECT (SELECT count(*) FROM gh_product_codes WHERE status_id = 1) as product_codes,
+               (SELECT count(*) FROM gh_sites WHERE status_id > 0) as sites,
+               (SELECT count(*) FROM gh_model WHERE status_id = 1) as models,
+               (SELECT count(*) FROM gh_product_prpo_automation WHERE status_id = 1) as prpo_automation,
+               (SELECT count(*) FROM gh_mpintent_equipment WHERE status_id = 1) as mpintent_equipment,
+               (SELECT count(*) FROM gh_mpintent_equipment_release WHERE status_id = 1) as releases,
+               (SELECT sum(ifnull(release_qty,0)) FROM gh_mpintent_equipment_release WHERE status_id = 1) as release_qty"""
+
+    def __init__(self, load, ttl_seconds, probe=False, snapshot_file='', parallel=False):
+        self.load = load
+        self.ttl_seconds = ttl_seconds
+        self.probe = probe
+        self.snapshot_file = snapshot_file
+        self.parallel = parallel
+        self.lock = threading.Lock()
+        self.data = self.signature = None
+        self.loaded = 0
+
+        if ttl_seconds > 0 and snapshot_file:
+            self.read_snapshot()
+
+    def get(self, conn):
+        if self.ttl_seconds <= 0:
+            return self.load(conn, self.parallel)
+
+        with self.lock:
+            signature = self.probe_signature(conn) if self.probe else None
+            if self.data is None or time.time() - self.loaded >= self.ttl_seconds or signature != self.signature:
+                self.data = self.load(conn, self.parallel)
+                self.signature = signature
+                self.loaded = time.time()
+                if self.snapshot_file:
+                    self.write_snapshot()
+            else:
+                logging.info('(REFERENCE CACHE) Using products, sites and validation rules loaded at ' + datetime.fromtimestamp(self.loaded).strftime('%Y-%m-%d %X'))
+            return self.data
+
+    def probe_signature(self, conn):
+        # values as strings (sum() is a Decimal), so the signature survives a JSON snapshot unchanged.
+        with conn.cursor() as cursor:
+            cursor.execute(self.reference_probe_SELECT_SQL)
+            return tuple(sorted((name, None if value is None else str(value)) for name, value in cursor.fetchone().items()))
+
+    def snapshot_json(self):
+        # products and sites as loaded (code => row); the validation rules as lists of their key tuples.
+        for table in (self.data.products, self.data.sites):
+            for code, row in table.items():
+                if not isinstance(code, str) or not all(isinstance(value, SNAPSHOT_SCALARS) for value in row.values()):
+                    raise TypeError('not a JSON value in ' + repr(code) + ': ' + repr(row))
+        rules = self.data.validation_rules
+        return {'loaded': self.loaded,
+                'signature': None if self.signature is None else [list(item) for item in self.signature],
+                'products': self.data.products,
+                'sites': self.data.sites,
+                'valid_product_sites': [list(key) for key in rules.valid_product_sites],
+                'invalid_aqid_kpr_release': [list(key) for key in rules.invalid_aqid_kpr_release]}
+
+    @staticmethod
+    def snapshot_data(snapshot):
+        # validates what snapshot_json() wrote and rebuilds (data, signature, loaded); raises ValueError.
+        def scalars(values, length=None):
+            return (isinstance(values, list) and (length is None or len(values) == length) and
+                    all(isinstance(value, SNAPSHOT_SCALARS) for value in values))
+
+        def table(rows):
+            return (isinstance(rows, dict) and
+                    all(isinstance(code, str) and isinstance(row, dict) and scalars(list(row.values())) for code, row in rows.items()))
+
+        if not (isinstance(snapshot, dict) and isinstance(snapshot.get('loaded'), (int, float)) and
+                (snapshot.get('signature') is None or
+                 (isinstance(snapshot['signature'], list) and all(scalars(item, 2) and isinstance(item[0], str) for item in snapshot['signature']))) and
+                table(snapshot.get('products')) and table(snapshot.get('sites')) and
+                isinstance(snapshot.get('valid_product_sites'), list) and all(scalars(key, 2) for key in snapshot['valid_product_sites']) and
+                isinstance(snapshot.get('invalid_aqid_kpr_release'), list) and all(scalars(key, 4) for key in snapshot['invalid_aqid_kpr_release'])):
+            raise ValueError('not a reference data snapshot')
+
+        validation_rules = ValidationRules([{'product_id': key[0], 'site_id': key[1]} for key in snapshot['valid_product_sites']],
+                                           [{'product_id': key[0], 'site_id': key[1], 'equipment_id': key[2], 'equipment_db_id': key[3]}
+                                            for key in snapshot['invalid_aqid_kpr_release']])
+        signature = None if snapshot['signature'] is None else tuple(tuple(item) for item in snapshot['signature'])
+        return ReferenceData(snapshot['products'], snapshot['sites'], validation_rules), signature, snapshot['loaded']
+
+    def read_snapshot(self):
+        try:
+            with open(self.snapshot_file) as f:
+                data, signature, loaded = self.snapshot_data(json.load(f))
+        except FileNotFoundError:
+            return
+        except Exception as err:
+            logging.warning('(REFERENCE CACHE) Ignoring unreadable snapshot ' + self.snapshot_file + '. ' + repr(err))
+            return
+
+        if time.time() - loaded < self.ttl_seconds:
+            self.data, self.signature, self.loaded = data, signature, loaded
+            logging.info('(REFERENCE CACHE) Read snapshot of ' + datetime.fromtimestamp(self.loaded).strftime('%Y-%m-%d %X') + ' from ' + self.snapshot_file)
+
+    def write_snapshot(self):
+        # a failed write only costs a cold start; the cache itself is fine.
+        f = None
+        try:
+            snapshot = self.snapshot_json()
+            with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(os.path.abspath(self.snapshot_file)), delete=False) as f:
+                json.dump(snapshot, f)
+            os.replace(f.name, self.snapshot_file)
+        except Exception as err:
+            if f is not None and os.path.exists(f.name):
+                os.unlink(f.name)
+            logging.warning('(REFERENCE CACHE) Unable to write snapshot ' + self.snapshot_file + '. ' + repr(err))
+
+####################################################################################################
+# Hash aggregation of (product_id, site_id, equipment_id, equipment_db_id, quantity) rows, e.g. from
+# an unbuffered cursor, into one total per equipment. Rows can come in any order; only the running
+# totals are kept, keyed by the tuple of ids. Each quantity is truncated with int() before summing,
+# as the legacy PR path always did. records() returns one {product_id, site_id, equip_id, equip_db_id}
+# record per equipment with the total under qty_field ('pr_qty', or 'po_qty' for PO rows that cannot
+# be summed in SQL). Both consolidation engines sum the PR quantities with it.
+####################################################################################################
+class QuantityAggregator:
+    __slots__ = ('qty_field', 'totals')
+
+    def __init__(self, qty_field):
+        self.qty_field = qty_field
+        self.totals = {}
+
+    def consume(self, rows):
+        totals = self.totals
+        for product_id, site_id, equipment_id, equipment_db_id, quantity in rows:
+            key = (product_id, site_id, equipment_id, equipment_db_id)
+            totals[key] = totals.get(key, 0) + int(quantity)
+
+        return self
+
+    def records(self):
+        return [{'product_id':key[0], 'site_id':key[1], 'equip_id':key[2], 'equip_db_id':key[3], self.qty_field:qty} for key, qty in self.totals.items()]
+
+####################################################################################################
+# Returns (key, legacy pr_qty, set pr_qty) for every equipment where the two PR summaries differ.
+# A missing equipment is reported with a pr_qty of None.
+####################################################################################################
+def compare_pr_qty(legacy_prs, set_prs):
+    f = itemgetter('product_id','site_id','equip_id','equip_db_id')
+    legacy_qty = {f(d): d['pr_qty'] for d in legacy_prs}
+    set_qty = {f(d): d['pr_qty'] for d in set_prs}
+    return [(key, legacy_qty.get(key), set_qty.get(key)) for key in legacy_qty.keys() | set_qty.keys() if legacy_qty.get(key) != set_qty.get(key)]
+
+####################################################################################################
+# Buffers INSERT/UPDATE statements and sends them with cursor.executemany() every batch_size rows.
+# pymysql rewrites an executemany() INSERT ... VALUES into one multi-row INSERT; UPDATEs are sent
+# back to back in the same call. Rows are grouped per (sql, counter) and counts[counter] adds up the
+# affected rows, so the rows inserted/updated reported to gh_pr_po_file_process_log stay exact.
+# A key is only pending once: a second statement for the same key flushes the batch first, so the
+# statements of one PR/PO line are applied in datafile order.
+####################################################################################################
+class BatchWriter:
+    def __init__(self, conn, batch_size=1000, savepoints=False):
+        self.conn = conn
+        self.batch_size = batch_size
+        self.savepoints = savepoints
+        self.pending = {}
+        self.pending_keys = set()
+        self.num_pending = 0
+        self.counts = defaultdict(int)
+
+    def add(self, sql, data, key, counter):
+        if key in self.pending_keys:
+            self.flush()
+
+        self.pending.setdefault((sql, counter), []).append(data)
+        self.pending_keys.add(key)
+        self.num_pending += 1
+
+        if self.num_pending >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.num_pending:
+            return
+
+        with self.conn.cursor() as cursor:
+            if self.savepoints:
+                cursor.execute("SAVEPOINT batch_writer")
+            try:
+                counts = self.execute_pending(cursor)
+            except pymysql.err.OperationalError as err:
+                # 1205 (lock wait timeout) only rolls back the statement; retry the batch once from the savepoint.
+                if not (self.savepoints and err.args[0] == 1205):
+                    raise
+                logging.warning('Lock wait timeout while writing a batch, retrying from savepoint. ' + str(err))
+                cursor.execute("ROLLBACK TO SAVEPOINT batch_writer")
+                counts = self.execute_pending(cursor)
+
+        for counter, rowcount in counts.items():
+            self.counts[counter] += rowcount
+        self.discard()
+
+    def execute_pending(self, cursor):
+        counts = defaultdict(int)
+        for (sql, counter), data in self.pending.items():
+            cursor.executemany(sql, data)
+            counts[counter] += cursor.rowcount
+
+        return counts
+
+    def discard(self):
+        self.pending = {}
+        self.pending_keys = set()
+        self.num_pending = 0
+
+####################################################################################################
+# Records which file each PR/PO line came from (gh_pr_po_file on conveyor).
+# Rows are buffered and written batch_size at a time, as one multi-row INSERT or, with
+# load_data, through LOAD DATA LOCAL INFILE from a temporary tab-separated file. flush() is called
+# per file by CommitPolicy.commit().
+####################################################################################################
+def load_data_field(value):
+    if value is None:
+        return '\\N'
+
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+
+class ProvenanceRecorder:
+    def __init__(self, conn, table, columns, batch_size=10000, load_data=False):
+        self.conn = conn
+        self.batch_size = batch_size
+        self.load_data = load_data
+        self.pending = []
+        self.num_recorded = 0
+        self.provenance_INSERT_SQL = "INSERT INTO " + table + " (" + ", ".join(columns) + ") VALUES (" + ", ".join(['%s'] * len(columns)) + ")"
+        self.provenance_LOAD_DATA_SQL = "LOAD DATA LOCAL INFILE %s INTO TABLE " + table + " FIELDS TERMINATED BY '\\t' LINES TERMINATED BY '\\n' (" + ", ".join(columns) + ")"
+
+    def record(self, data):
+        self.pending.append(data)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+
+        with self.conn.cursor() as cursor:
+            if self.load_data:
+                with tempfile.NamedTemporaryFile('w', encoding='latin-1', newline='', suffix='.tsv', delete=False) as tsv:
+                    for data in self.pending:
+                        tsv.write('\t'.join(load_data_field(value) for value in data) + '\n')
+                try:
+                    cursor.execute(self.provenance_LOAD_DATA_SQL, tsv.name)
+                finally:
+                    os.remove(tsv.name)
+            else:
+                cursor.executemany(self.provenance_INSERT_SQL, self.pending)
+
+        self.num_recorded += len(self.pending)
+        self.discard()
+
+    def discard(self):
+        self.pending = []
+
+####################################################################################################
+# Commit policy of the PR/PO loaders. Both connections run with autocommit off and nothing is
+# committed per statement ([PERFORMANCE] commit_mode):
+#   rows      - flush the writers and commit every commit_every datafile rows.
+#   file      - commit once, after the gh_pr_po_file_process_log row; a file is applied atomically.
+#   savepoint - as 'file', and every writer batch runs behind a SAVEPOINT so a lock wait timeout
+#               retries that batch instead of failing the file.
+# The connections are committed in list order (conveyor first, main database last); on_commit, when
+# given, is called with the number of datafile rows committed so far. A file resumed after
+# committed_rows rows counts on from there.
+####################################################################################################
+class CommitPolicy:
+    def __init__(self, conns, writers=(), mode='file', commit_every=1000, on_commit=None, committed_rows=0):
+        self.conns = conns
+        self.writers = writers
+        self.mode = mode
+        self.commit_every = commit_every
+        self.on_commit = on_commit
+        self.num_rows = self.committed_rows = committed_rows
+
+    def row_done(self):
+        self.num_rows += 1
+        if self.mode == 'rows' and self.num_rows % self.commit_every == 0:
+            self.commit()
+
+    def commit(self):
+        for writer in self.writers:
+            writer.flush()
+        for conn in self.conns:
+            conn.commit()
+        self.committed_rows = self.num_rows
+        if self.on_commit is not None:
+            self.on_commit(self.committed_rows)
+
+    def rollback(self):
+        for writer in self.writers:
+            writer.discard()
+        for conn in self.conns:
+            try:
+                conn.rollback()
+            except Exception as err:
+                logging.error('*ERROR* rollback failed in CommitPolicy.rollback(). ' + str(err))
+
+####################################################################################################
+# Equipment summary keys (product_id, site_id, equipment_id, equipment_db_id) touched by the PR/PO
+# lines written in one cycle, for an incremental processing_prpo_consolidation().
+# A line reports the key it is stored with and the key it is written with. A PO line also reports
+# its PR number: the PR lines of a PR that is on a PO drop out of the PR quantity, and resolve()
+# adds their keys from gh_eapproval_pr_line_item.
+####################################################################################################
+class ConsolidationScope:
+    pr_keys_SELECT_SQL = """
+            SELECT DISTINCT gh_product_id, gh_site_id, gh_equipment_id, gh_equipment_db_id
+            FROM gh_eapproval_pr_line_item
+            WHERE pr_nbr in %s"""
+
+    def __init__(self, chunk_size=1000):
+        self.chunk_size = chunk_size
+        self.keys = set()
+        self.pr_nbrs = set()
+
+    def add_keys(self, *keys):
+        for key in keys:
+            if key is not None:
+                self.keys.add(key)
+
+    def add_pr_nbr(self, pr_nbr):
+        pr_nbr = str(pr_nbr or '').strip()
+        if pr_nbr:
+            self.pr_nbrs.add(pr_nbr)
+
+    def resolve(self, conn):
+        pr_nbrs = list(self.pr_nbrs)
+        try:
+            with conn.cursor(pymysql.cursors.SSCursor) as cursor:
+                for i in range(0, len(pr_nbrs), self.chunk_size):
+                    cursor.execute(self.pr_keys_SELECT_SQL, (pr_nbrs[i:i + self.chunk_size],))
+                    for key in cursor:
+                        self.keys.add(tuple(key))
+        except Exception as sqlerr:
+            logging.critical('*ERROR* pr_keys_SELECT_SQL in ConsolidationScope.resolve(). ' + str(sqlerr))
+            raise
+        self.pr_nbrs = set()
+
+    def product_ids(self):
+        return tuple({key[0] for key in self.keys if key[0] is not None})
+
+####################################################################################################
+# Write-behind journal for the conveyor (conn2) raw mirror and gh_pr_po_file.
+# processing_line_items() hands its raw lines and gh_pr_po_file rows to a
+# ConveyorJournalWriter instead of conn2. Every CommitPolicy.commit() turns what was written since
+# into a segment file in journal_dir (a JSON header with the tables and SQL, then one JSON entry per
+# line), fsynced and renamed into place before the park commit. A drainer thread applies the
+# segments in order, batch_size entries per conveyor transaction, and records how far it got in
+# checkpoint.json after each commit.
+# Replaying is idempotent: whether a raw line is inserted or updated is decided from the conveyor
+# table when the batch is applied, and until a segment has been drained without an error since the
+# start or the last failed drain (which can leave a batch committed without its checkpoint), batches
+# skip gh_pr_po_file rows that are already there.
+####################################################################################################
+class ConveyorJournal:
+    def __init__(self, journal_dir, batch_size=1000, poll_seconds=5):
+        self.journal_dir = journal_dir
+        self.checkpoint_file = os.path.join(journal_dir, 'checkpoint.json')
+        self.batch_size = batch_size
+        self.poll_seconds = poll_seconds
+        self.lock = threading.Lock()
+        self.num_segments = 0
+        self.replaying = True
+
+        pathlib.Path(journal_dir).mkdir(parents=True, exist_ok=True)
+        # segments that were never renamed into place belong to files whose park commit never happened.
+        for unfinished in pathlib.Path(journal_dir).glob('*.jsonl.tmp'):
+            unfinished.unlink()
+
+    def writer(self, table, nbr_col, line_nbr_col, insert_sql, update_sql, provenance_table, provenance_columns):
+        header = {'table': table, 'nbr_col': nbr_col, 'line_nbr_col': line_nbr_col, 'insert_sql': insert_sql, 'update_sql': update_sql,
+                  'provenance_table': provenance_table, 'provenance_columns': provenance_columns}
+        return ConveyorJournalWriter(self, header)
+
+    def new_segment(self):
+        with self.lock:
+            self.num_segments += 1
+            return os.path.join(self.journal_dir, '%020d-%06d.jsonl' % (time.time_ns(), self.num_segments))
+
+    def commit_segment(self, segment, segment_file):
+        segment_file.flush()
+        os.fsync(segment_file.fileno())
+        segment_file.close()
+        os.replace(segment + '.tmp', segment)
+        self.sync_dir()
+
+    def sync_dir(self):
+        dir_fd = os.open(self.journal_dir, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+    def segments(self):
+        return sorted(pathlib.Path(self.journal_dir).glob('*.jsonl'))
+
+    def read_checkpoint(self):
+        try:
+            with open(self.checkpoint_file) as f:
+                checkpoint = json.load(f)
+            return checkpoint['segment'], checkpoint['entries']
+        except FileNotFoundError:
+            return None, 0
+
+    def write_checkpoint(self, segment_name, entries):
+        with open(self.checkpoint_file + '.tmp', 'w') as f:
+            json.dump({'segment': segment_name, 'entries': entries}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.checkpoint_file + '.tmp', self.checkpoint_file)
+
+    def lag(self):
+        segments = self.segments()
+        checkpoint_segment, applied = self.read_checkpoint()
+        num_entries = 0
+        oldest = 0
+        for segment in segments:
+            try:
+                with open(segment) as f:
+                    entries = sum(1 for line in f) - 1
+                if not oldest:
+                    oldest = time.time() - segment.stat().st_mtime
+            except FileNotFoundError:
+                continue    # applied in the meantime.
+            num_entries += entries - applied if segment.name == checkpoint_segment else entries
+
+        return len(segments), num_entries, oldest
+
+    def log_lag(self):
+        num_segments, num_entries, oldest = self.lag()
+        logging.info('(RAW) Conveyor journal lag: ' + str(num_entries) + ' entries in ' + str(num_segments) + ' segment(s), oldest ' + str(int(oldest)) + ' secs.')
+
+    def start_drainer(self, pool):
+        drainer = threading.Thread(target=self.drain_forever, args=(pool,), name='ConveyorJournal', daemon=True)
+        drainer.start()
+
+    def drain_forever(self, pool):
+        while True:
+            try:
+                with pool.connection() as drain_conn:
+                    drained = self.drain(drain_conn)
+                if not drained:
+                    time.sleep(self.poll_seconds)
+            except Exception as err:
+                logging.error('*ERROR* applying the conveyor journal, retrying in 60 secs. ' + str(err))
+                time.sleep(60)
+
+    def drain(self, conn):
+        segments = self.segments()
+        if not segments:
+            return False
+
+        segment = segments[0]
+        checkpoint_segment, applied = self.read_checkpoint()
+        if checkpoint_segment != segment.name:
+            applied = 0
+
+        with open(segment) as f:
+            header = json.loads(f.readline())
+            entries = [json.loads(line) for line in f]
+
+        try:
+            for start in range(applied, len(entries), self.batch_size):
+                self.apply(conn, header, entries[start:start + self.batch_size])
+                conn.commit()
+                self.write_checkpoint(segment.name, min(start + self.batch_size, len(entries)))
+        except BaseException:
+            # the batch may have been committed without its checkpoint; the retry replays it.
+            self.replaying = True
+            raise
+        self.replaying = False
+
+        segment.unlink()
+        self.sync_dir()
+        logging.info('(RAW) Conveyor journal segment ' + segment.name + ' applied to ' + header['table'] + ' (' + str(len(entries)) + ' entries).')
+        return True
+
+    def apply(self, conn, header, batch):
+        existing = self.existing_keys(conn, header, {tuple(entry[2]) for entry in batch if entry[0] == 'raw'})
+        raw_writer = BatchWriter(conn, self.batch_size)
+        provenance = []
+
+        for entry in batch:
+            if entry[0] == 'file':
+                provenance.append(entry[1])
+                continue
+
+            op, key, values = entry[1], tuple(entry[2]), entry[3]
+            # raw UPDATEs take the INSERT values with the two key columns moved last.
+            if op == 'update':
+                values = values[-2:] + values[:-2]
+            if key in existing:
+                raw_writer.add(header['update_sql'], values[2:] + values[:2], key, 'raw_rows_updated')
+            else:
+                raw_writer.add(header['insert_sql'], values, key, 'raw_rows_inserted')
+                existing.add(key)
+        raw_writer.flush()
+
+        if provenance and self.replaying:
+            provenance = self.new_provenance(conn, header, provenance)
+        if provenance:
+            provenance_INSERT_SQL = "INSERT INTO " + header['provenance_table'] + " (" + ", ".join(header['provenance_columns']) + ") VALUES (" + ", ".join(['%s'] * len(header['provenance_columns'])) + ")"
+            with conn.cursor() as cursor:
+                cursor.executemany(provenance_INSERT_SQL, provenance)
+
+    def existing_keys(self, conn, header, keys):
+        existing = set()
+        nbrs = list({key[0] for key in keys})
+        existing_keys_SELECT_SQL = "SELECT " + header['nbr_col'] + ", " + header['line_nbr_col'] + " FROM " + header['table'] + " WHERE " + header['nbr_col'] + " in %s"
+        with conn.cursor(pymysql.cursors.SSCursor) as cursor:
+            for i in range(0, len(nbrs), self.batch_size):
+                cursor.execute(existing_keys_SELECT_SQL, (nbrs[i:i + self.batch_size],))
+                for nbr, line_nbr in cursor:
+                    key = line_item_key(nbr, line_nbr)
+                    if key in keys:
+                        existing.add(key)
+
+        return existing
+
+    def new_provenance(self, conn, header, provenance):
+        columns = header['provenance_columns']
+        file_names = list({row[columns.index('file_name')] for row in provenance})
+        provenance_SELECT_SQL = "SELECT " + ", ".join(columns) + " FROM " + header['provenance_table'] + " WHERE file_name in %s"
+        with conn.cursor(pymysql.cursors.SSCursor) as cursor:
+            cursor.execute(provenance_SELECT_SQL, (file_names,))
+            recorded = {invalid_record_state(*row) for row in cursor}
+
+        return [row for row in provenance if invalid_record_state(*row) not in recorded]
+
+####################################################################################################
+# Buffers one file's raw lines and gh_pr_po_file rows for the ConveyorJournal. It stands in for both
+# the raw BatchWriter and the ProvenanceRecorder of processing_line_items(): entries are
+# appended to a temporary segment file, which flush() (CommitPolicy.commit()) puts in place and
+# discard() (CommitPolicy.rollback()) deletes. counts and num_recorded count journaled entries.
+####################################################################################################
+class ConveyorJournalWriter:
+    def __init__(self, journal, header):
+        self.journal = journal
+        self.header = header
+        self.segment = self.segment_file = None
+        self.counts = defaultdict(int)
+        self.num_recorded = 0
+
+    def write(self, entry):
+        if self.segment_file is None:
+            self.segment = self.journal.new_segment()
+            self.segment_file = open(self.segment + '.tmp', 'w')
+            self.segment_file.write(json.dumps(self.header) + '\n')
+        self.segment_file.write(json.dumps(entry, default=str) + '\n')
+
+    def add(self, sql, data, key, counter):
+        op = 'insert' if sql == self.header['insert_sql'] else 'update'
+        self.write(['raw', op, list(key), list(data)])
+        self.counts[counter] += 1
+
+    def record(self, data):
+        self.write(['file', list(data)])
+        self.num_recorded += 1
+
+    def flush(self):
+        if self.segment_file is not None:
+            self.journal.commit_segment(self.segment, self.segment_file)
+            self.segment = self.segment_file = None
+
+    def discard(self):
+        if self.segment_file is not None:
+            self.segment_file.close()
+            os.remove(self.segment + '.tmp')
+            self.segment = self.segment_file = None
+
+####################################################################################################
+# Brings gh_pr_po_equipment_summary in line with the consolidated prpo records.
+# The summary table is read with one query; only equipment that is new or whose PR/PO quantities
+# changed is written, through a BatchWriter, so an unchanged summary row is not rewritten every cycle.
+# Keys are compared NULL-safe (<=> in the UPDATE) so equipment with a NULL id is updated in place.
+# Summary rows that are no longer in prpo are left as they are.
+####################################################################################################
+class EquipmentSummarySync:
+    summary_SELECT_SQL = """
+            SELECT product_id, site_id, equipment_id, equipment_db_id, pr_new_requisition_qty, po_valid_qty
+            FROM gh_pr_po_equipment_summary"""
+
+    summary_INSERT_SQL = """
+            INSERT INTO gh_pr_po_equipment_summary (product_id, site_id, equipment_id, equipment_db_id, pr_new_requisition_qty, po_valid_qty, created)
+            VALUES (%s, %s, %s, %s, %s, %s, %s)"""
+
+    summary_UPDATE_SQL = """
+            UPDATE gh_pr_po_equipment_summary
+            SET pr_new_requisition_qty = %s, po_valid_qty = %s, updated = %s
+            WHERE
+                 product_id <=> %s and site_id <=> %s and equipment_id <=> %s and equipment_db_id <=> %s"""
+
+    def __init__(self, conn, batch_size=1000):
+        self.conn = conn
+        self.batch_size = batch_size
+        self.rows_inserted = self.rows_updated = self.rows_unchanged = 0
+
+    def load(self):
+        summary = {}
+        try:
+            with self.conn.cursor(pymysql.cursors.SSCursor) as cursor:
+                cursor.execute(self.summary_SELECT_SQL)
+                for product_id, site_id, equipment_id, equipment_db_id, pr_qty, po_qty in cursor:
+                    summary[(product_id, site_id, equipment_id, equipment_db_id)] = (pr_qty, po_qty)
+
+            return summary
+        except Exception as sqlerr:
+            logging.critical('*ERROR* summary_SELECT_SQL in EquipmentSummarySync.load(). ' + str(sqlerr))
+            raise
+
+    def sync(self, prpo, now):
+        summary = self.load()
+        writer = BatchWriter(self.conn, self.batch_size)
+
+        for row in prpo:
+            key = (row['product_id'], row['site_id'], row['equip_id'], row['equip_db_id'])
+            qty = (row['pr_qty'], row['po_qty'])
+
+            if key not in summary:
+                writer.add(self.summary_INSERT_SQL, key + qty + (now,), key, 'rows_inserted')
+            elif summary[key] != qty:
+                writer.add(self.summary_UPDATE_SQL, qty + (now,) + key, key, 'rows_updated')
+            else:
+                self.rows_unchanged += 1
+            summary[key] = qty
+
+        writer.flush()
+        self.rows_inserted += writer.counts['rows_inserted']
+        self.rows_updated += writer.counts['rows_updated']
+
+####################################################################################################
+# Decrypts a .txt.asc datafile with a gpg subprocess and yields the plaintext line by line, so
+# csv.reader gets the first rows while gpg is still decrypting and the whole plaintext is never
+# held in memory. The passphrase is handed to gpg on its own pipe (--passphrase-fd).
+# gpg's exit status is checked when the plaintext ends: a failed decryption (wrong passphrase,
+# corrupt or truncated file) raises DecryptError from the reader, before the file is committed.
+####################################################################################################
+class DecryptError(Exception):
+    pass
+
+class GPGDecryptStream:
+    def __init__(self, gpg, encrypted_file, passphrase):
+        self.encoding = gpg.encoding
+        self.stderr = tempfile.TemporaryFile()
+
+        args = [gpg.gpgbinary, '--batch', '--no-tty', '--yes', '--quiet']
+        if gpg.gnupghome:
+            args += ['--homedir', gpg.gnupghome]
+        if gpg.version and gpg.version >= (2, 1):
+            args += ['--pinentry-mode', 'loopback']
+
+        passphrase_r, passphrase_w = os.pipe()
+        try:
+            args += ['--passphrase-fd', str(passphrase_r), '--decrypt']
+            self.process = subprocess.Popen(args, stdin=encrypted_file, stdout=subprocess.PIPE, stderr=self.stderr, pass_fds=(passphrase_r,))
+        except Exception:
+            os.close(passphrase_w)
+            self.stderr.close()
+            raise
+        finally:
+            os.close(passphrase_r)
+
+        try:
+            with os.fdopen(passphrase_w, 'w') as passphrase_pipe:
+                passphrase_pipe.write(passphrase + '\n')
+        except BrokenPipeError:
+            pass    # gpg already exited; wait() reports why.
+
+        self.plaintext = io.TextIOWrapper(self.process.stdout, encoding=self.encoding, newline='')
+
+    def __iter__(self):
+        for line in self.plaintext:
+            yield line
+        self.wait()
+
+    def wait(self):
+        returncode = self.process.wait()
+        if returncode != 0:
+            self.stderr.seek(0)
+            raise DecryptError('gpg exited with status ' + str(returncode) + '. ' + self.stderr.read().decode(self.encoding, 'replace').strip())
+
+    def close(self):
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+        self.plaintext.close()
+        self.stderr.close()
+
+####################################################################################################
+# Decrypts the next queued datafiles in background threads while the current one is loaded into
+# MySQL, so gpg and the database work at the same time. datafiles are (encrypted file, passphrase)
+# in the order plaintext() asks for them. At most depth files are decrypted ahead, and no new one is
+# started while the plaintext held ahead is max_mb or more (a file decrypting at that moment can
+# still go over it). A file that was not decrypted ahead is decrypted in plaintext() itself.
+####################################################################################################
+class DecryptPrefetcher:
+    def __init__(self, gpg, datafiles, depth=2, max_mb=512):
+        self.gpg = gpg
+        self.queue = deque(datafiles)
+        self.depth = depth
+        self.max_chars = max_mb * 1024 * 1024
+        self.held_chars = 0
+        self.lock = threading.Lock()
+        self.futures = {}
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=depth)
+        self.fill()
+
+    def decrypt(self, encrypted_file, passphrase):
+        with open(encrypted_file, 'rb') as f:
+            plaintext = str(self.gpg.decrypt_file(f, passphrase=passphrase))
+        with self.lock:
+            self.held_chars += len(plaintext)
+
+        return plaintext
+
+    def fill(self):
+        while self.queue and len(self.futures) < self.depth and self.held_chars < self.max_chars:
+            encrypted_file, passphrase = self.queue.popleft()
+            self.futures[encrypted_file] = self.executor.submit(self.decrypt, encrypted_file, passphrase)
+
+    def plaintext(self, encrypted_file, passphrase):
+        future = self.futures.pop(encrypted_file, None)
+        if future is not None:
+            plaintext = future.result()
+        else:
+            self.queue = deque(datafile for datafile in self.queue if datafile[0] != encrypted_file)
+            plaintext = self.decrypt(encrypted_file, passphrase)
+
+        with self.lock:
+            self.held_chars -= len(plaintext)
+        self.fill()
+
+        return plaintext
+
+    def close(self):
+        self.queue.clear()
+        for future in self.futures.values():
+            future.cancel()
+        self.executor.shutdown(wait=True)
+        self.futures = {}
+
+####################################################################################################
+# Persistent record of the processed datafiles, in a local SQLite file ([PERFORMANCE] manifest_file).
+# One row per (datatype, file_name) with its state, the rows read, the last committed row, when it
+# started and finished, the sha256 of the encrypted datafile and the error, if any:
+#   pending    - queued by a .fetched marker and not started yet
+#   processing - started and not finished (still running, or the process died)
+#   processed  - loaded and logged in gh_pr_po_file_process_log
+#   error      - an .error marker was written; it stays done until that marker is removed
+#   failed     - stopped without a marker (lost connection, ...); tried again like a file without markers
+# unfinished() lists the pending, processing and failed files, so they are queued again without
+# listing the status directory. start(resume=True) returns the rows an earlier run of the same
+# datafile (same checksum) committed before it stopped, 0 when it starts from the first row.
+# The existing .processed/.error markers are imported once per datatype, the first time the
+# manifest is opened. It is shared by the parallel workers, hence the lock.
+####################################################################################################
+class ProcessingManifest:
+    def __init__(self, manifest_file):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(manifest_file, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS datafile (
+                               datatype TEXT NOT NULL,
+                               file_name TEXT NOT NULL,
+                               state TEXT NOT NULL,
+                               num_rows INTEGER,
+                               last_committed_row INTEGER,
+                               started TEXT,
+                               finished TEXT,
+                               checksum TEXT,
+                               error TEXT,
+                               PRIMARY KEY (datatype, file_name))""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS datafile_state ON datafile (datatype, state)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS imported_markers (datatype TEXT PRIMARY KEY, imported TEXT NOT NULL)")
+
+    def import_markers(self, datatype, status_dir):
+        with self.lock:
+            if self.db.execute("SELECT 1 FROM imported_markers WHERE datatype = ?", (datatype,)).fetchone():
+                return
+
+            states = {}
+            try:
+                status_files = os.listdir(status_dir)
+            except FileNotFoundError:
+                status_files = []
+            for name in status_files:
+                file_name, _, marker = name.partition('.')
+                # a file that has both markers was processed after an earlier error.
+                if marker == 'processed' or (marker == 'error' and states.get(file_name) != 'processed'):
+                    states[file_name] = marker
+
+            self.db.execute("BEGIN")
+            self.db.executemany("INSERT OR IGNORE INTO datafile (datatype, file_name, state) VALUES (?, ?, ?)",
+                                [(datatype, file_name, state) for file_name, state in states.items()])
+            self.db.execute("INSERT INTO imported_markers (datatype, imported) VALUES (?, ?)", (datatype, datetime.now().strftime('%Y-%m-%d %X')))
+            self.db.execute("COMMIT")
+        logging.info('(MANIFEST) Imported ' + str(len(states)) + ' ' + datatype + ' .processed/.error markers from ' + status_dir)
+
+    def is_done(self, datatype, file_name, error_marker):
+        with self.lock:
+            row = self.db.execute("SELECT state FROM datafile WHERE datatype = ? AND file_name = ?", (datatype, file_name)).fetchone()
+        if row is None:
+            return False
+        return row[0] == 'processed' or (row[0] == 'error' and error_marker)
+
+    def unfinished(self, datatype):
+        with self.lock:
+            rows = self.db.execute("SELECT file_name FROM datafile WHERE datatype = ? AND state IN ('pending', 'processing', 'failed')", (datatype,)).fetchall()
+        return [row[0] for row in rows]
+
+    def queue(self, datatype, file_names):
+        with self.lock:
+            self.db.executemany("""INSERT INTO datafile (datatype, file_name, state) VALUES (?, ?, 'pending')
+                                   ON CONFLICT (datatype, file_name) DO UPDATE SET state = 'pending'""",
+                                [(datatype, file_name) for file_name in file_names])
+
+    def start(self, datatype, file_name, checksum, resume=False):
+        with self.lock:
+            row = self.db.execute("SELECT state, last_committed_row, checksum FROM datafile WHERE datatype = ? AND file_name = ?", (datatype, file_name)).fetchone()
+            resume_row = 0
+            if resume and row is not None and row[0] != 'processed' and row[2] == checksum:
+                resume_row = row[1] or 0
+            self.db.execute("INSERT OR REPLACE INTO datafile (datatype, file_name, state, last_committed_row, started, checksum) VALUES (?, ?, 'processing', ?, ?, ?)",
+                            (datatype, file_name, resume_row, datetime.now().strftime('%Y-%m-%d %X'), checksum))
+        return resume_row
+
+    def committed(self, datatype, file_name, num_rows):
+        with self.lock:
+            self.db.execute("UPDATE datafile SET last_committed_row = ? WHERE datatype = ? AND file_name = ?", (num_rows, datatype, file_name))
+
+    def finish(self, datatype, file_name, state, num_rows=None, error=None):
+        with self.lock:
+            self.db.execute("UPDATE datafile SET state = ?, num_rows = ?, finished = ?, error = ? WHERE datatype = ? AND file_name = ?",
+                            (state, num_rows, datetime.now().strftime('%Y-%m-%d %X'), error, datatype, file_name))
+
+def file_checksum(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+####################################################################################################
+# Waits for new .fetched markers in the PR/PO status directories instead of sleeping blindly.
+# With inotify (through libc, Linux only) wait() returns True as soon as a .fetched file is created,
+# written, touched or moved in; our own .processed/.error markers do not wake it up. Without inotify
+# the directories' modification times are compared every poll_seconds. wait() returns False when
+# the timeout passes with no change. take_fetched() returns the file names (up to the first '.') of
+# the .fetched markers seen since the last call, by status directory, or None when the directories
+# have to be listed: polling does not tell which files changed, and inotify drops its events when
+# its queue overflows.
+####################################################################################################
+class StatusWatcher:
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+    EVENT_HEADER = struct.Struct('iIII')    # struct inotify_event: wd, mask, cookie, len (name follows)
+
+    def __init__(self, status_dirs, mode='inotify', poll_seconds=30):
+        self.status_dirs = status_dirs
+        self.poll_seconds = poll_seconds
+        self.mtimes = self.dir_mtimes()
+        self.inotify_fd = None
+        self.watched_dirs = {}
+        self.fetched = {status_dir: set() for status_dir in status_dirs}
+        self.rescan = False
+
+        if mode == 'inotify':
+            try:
+                self.inotify_fd = self.start_inotify()
+                logging.info('Watching ' + ', '.join(status_dirs) + ' with inotify.')
+            except (OSError, AttributeError) as err:
+                logging.warning('inotify is not available, polling ' + ', '.join(status_dirs) + ' every ' + str(poll_seconds) + ' secs. ' + str(err))
+
+    def start_inotify(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        inotify_fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if inotify_fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+        for status_dir in self.status_dirs:
+            wd = libc.inotify_add_watch(inotify_fd, os.fsencode(status_dir), self.IN_ATTRIB | self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE)
+            if wd < 0:
+                errno = ctypes.get_errno()
+                os.close(inotify_fd)
+                raise OSError(errno, 'inotify_add_watch failed on ' + status_dir)
+            self.watched_dirs[wd] = status_dir
+
+        return inotify_fd
+
+    def dir_mtimes(self):
+        mtimes = []
+        for status_dir in self.status_dirs:
+            try:
+                mtimes.append(os.stat(status_dir).st_mtime_ns)
+            except OSError:
+                mtimes.append(None)
+
+        return mtimes
+
+    def wait(self, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+
+            if self.inotify_fd is not None:
+                readable, _, _ = select.select([self.inotify_fd], [], [], remaining)
+                if readable and self.read_fetched_events():
+                    return True
+            else:
+                time.sleep(min(self.poll_seconds, remaining))
+                mtimes = self.dir_mtimes()
+                if mtimes != self.mtimes:
+                    self.mtimes = mtimes
+                    self.rescan = True
+                    return True
+
+    def take_fetched(self):
+        fetched = None if self.rescan else self.fetched
+        self.fetched = {status_dir: set() for status_dir in self.status_dirs}
+        self.rescan = False
+        return fetched
+
+    def read_fetched_events(self):
+        fetched = False
+        while True:
+            try:
+                events = os.read(self.inotify_fd, 65536)
+            except BlockingIOError:
+                return fetched
+
+            offset = 0
+            while offset < len(events):
+                wd, mask, cookie, name_len = self.EVENT_HEADER.unpack_from(events, offset)
+                name = events[offset + self.EVENT_HEADER.size:offset + self.EVENT_HEADER.size + name_len].rstrip(b'\0')
+                if mask & self.IN_Q_OVERFLOW:
+                    self.rescan = fetched = True
+                elif name.endswith(b'.fetched') and wd in self.watched_dirs:
+                    self.fetched[self.watched_dirs[wd]].add(os.fsdecode(name).partition('.')[0])
+                    fetched = True
+                offset += self.EVENT_HEADER.size + name_len
+
+####################################################################################################
+# Pool of connections made by connect (connect_park or connect_conveyor, so every connection has the
+# same session settings). checkout() pings an idle connection before handing it out and replaces it
+# when the ping fails; a new connection is retried with exponential backoff (up to max_backoff secs)
+# while the server cannot be reached. checkin() rolls back anything left uncommitted and keeps the
+# connection, or closes it when that fails. At most max_size connections are checked out at a time;
+# checkout(blocking=False) returns None instead of waiting for one.
+####################################################################################################
+class ConnectionPool:
+    def __init__(self, connect, name, max_size=4, connections=(), max_backoff=300):
+        self.connect = connect
+        self.name = name
+        self.max_backoff = max_backoff
+        self.idle = deque(connections)
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(max_size)
+
+    def checkout(self, blocking=True):
+        if not self.slots.acquire(blocking):
+            return None
+        try:
+            while True:
+                with self.lock:
+                    conn = self.idle.pop() if self.idle else None
+                if conn is None:
+                    return self.connect_with_backoff()
+                try:
+                    conn.ping(reconnect=False)
+                    return conn
+                except Exception as err:
+                    logging.warning('Replacing a ' + self.name + ' connection that failed its health check. ' + str(err))
+                    self.close(conn)
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def connect_with_backoff(self):
+        backoff = 1
+        while True:
+            try:
+                return self.connect()
+            except pymysql.err.OperationalError as err:
+                logging.error('*ERROR* connecting to ' + self.name + ', retrying in ' + str(backoff) + ' secs. ' + str(err))
+                time.sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+
+    def checkin(self, conn):
+        try:
+            if conn.open:
+                try:
+                    conn.rollback()
+                    with self.lock:
+                        self.idle.append(conn)
+                    return
+                except Exception as err:
+                    logging.warning('Closing a ' + self.name + ' connection that failed to roll back. ' + str(err))
+            self.close(conn)
+        finally:
+            self.slots.release()
+
+    def close(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    @contextlib.contextmanager
+    def connection(self):
+        conn = self.checkout()
+        try:
+            yield conn
+        finally:
+            self.checkin(conn)
+
+####################################################################################################
+# Runs loads, {name: (pool, conn, function)}, and returns {name: function(connection)}; conn is the
+# caller's connection to the database of pool. Without parallel every function runs on its conn, in
+# order. With parallel the first load of each conn runs on it in this thread, and every other load in
+# a thread of its own on a connection checked out of pool. A load that finds the pool exhausted runs
+# on conn after the others instead of waiting, so a small pool makes the loads slower but never
+# blocks them. Every connection reads its own snapshot of the database.
+####################################################################################################
+def run_loads(loads, parallel=False):
+    results = {}
+    if not parallel:
+        for name, (pool, conn, function) in loads.items():
+            results[name] = function(conn)
+        return results
+
+    used_conns, inline, futures = [], [], {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(loads)) as executor:
+        for name, (pool, conn, function) in loads.items():
+            pooled_conn = None
+            if any(conn is used_conn for used_conn in used_conns):
+                pooled_conn = pool.checkout(blocking=False)
+            else:
+                used_conns.append(conn)
+
+            if pooled_conn is None:
+                inline.append((name, conn, function))
+            else:
+                futures[name] = executor.submit(run_pooled_load, pool, pooled_conn, function)
+
+        for name, conn, function in inline:
+            results[name] = function(conn)
+        for name, future in futures.items():
+            results[name] = future.result()
+
+    return results
+
+def run_pooled_load(pool, conn, function):
+    try:
+        return function(conn)
+    finally:
+        pool.checkin(conn)
@@ -19,12 +19,24 @@ import time
 import gnupg
 import io
 import os
+import threading
+import contextlib
 import socket
+import functools
 
 import smtplib
 from email.mime.image import MIMEImage
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
+from html import escape
+
+from prpo_lib import (line_item_key, invalid_record_state, normalize_aqid, EquipmentResolver, prefetch_equipment,
+                      RowDecoder, PR_COLUMN_TYPES, PO_COLUMN_TYPES, FeedSchema, PR_DB_COL_MAPPING, PO_DB_COL_MAPPING,
+                      DuplicateLineCollapser, DiagnosticsCollector, ValidationRules, INVALID_PRODUCT_SITE, NO_KPR_RELEASE,
+                      ReferenceData, ReferenceDataCache, QuantityAggregator, compare_pr_qty, BatchWriter,
+                      ProvenanceRecorder, CommitPolicy, ConsolidationScope, ConveyorJournal, EquipmentSummarySync,
+                      DecryptError, GPGDecryptStream, DecryptPrefetcher, ProcessingManifest, file_checksum, StatusWatcher,
+                      ConnectionPool, run_loads)
 
 ####################################################################################################
 # prpo_main.py
@@ -75,6 +87,81 @@ except Exception as err:
     sys.exit(1)
 
 
+######### PERFORMANCE (optional section)
+# aqid_prefetch_size: number of datafile rows whose AQ_IDs are resolved against gh_bom_equipment together.
+aqid_prefetch_size = config.getint('PERFORMANCE', 'aqid_prefetch_size', fallback=1000)
+# batch_size: number of line item INSERT/UPDATEs sent to the database in one executemany().
+batch_size = config.getint('PERFORMANCE', 'batch_size', fallback=1000)
+# commit_mode: rows, file or savepoint (see CommitPolicy); commit_every: rows per commit in 'rows' mode.
+commit_mode = config.get('PERFORMANCE', 'commit_mode', fallback='file')
+commit_every = config.getint('PERFORMANCE', 'commit_every', fallback=1000)
+# provenance_batch_size: gh_pr_po_file rows per write; provenance_load_data: write them with LOAD DATA LOCAL INFILE.
+provenance_batch_size = config.getint('PERFORMANCE', 'provenance_batch_size', fallback=10000)
+provenance_load_data = config.getboolean('PERFORMANCE', 'provenance_load_data', fallback=False)
+# consolidation_engine: legacy (one PO lookup per active PR), set (one anti-join) or verify (run both, compare, keep legacy).
+consolidation_engine = config.get('PERFORMANCE', 'consolidation_engine', fallback='legacy')
+# incremental_consolidation: consolidate only the products touched by the processed files; every
+# full_consolidation_hours a full consolidation runs instead, even when no file was processed.
+incremental_consolidation = config.getboolean('PERFORMANCE', 'incremental_consolidation', fallback=False)
+full_consolidation_hours = config.getfloat('PERFORMANCE', 'full_consolidation_hours', fallback=24)
+# streaming_decrypt: decrypt datafiles with a gpg subprocess and parse the rows as they are decrypted.
+streaming_decrypt = config.getboolean('PERFORMANCE', 'streaming_decrypt', fallback=False)
+# decrypt_prefetch_depth: queued datafiles decrypted ahead in background threads while a file is loaded
+# (0 = off, not used with streaming_decrypt); decrypt_prefetch_max_mb: decrypted plaintext held ahead.
+decrypt_prefetch_depth = config.getint('PERFORMANCE', 'decrypt_prefetch_depth', fallback=0)
+decrypt_prefetch_max_mb = config.getint('PERFORMANCE', 'decrypt_prefetch_max_mb', fallback=512)
+# parallel_datatypes: process PR files and PO files at the same time, each in its own thread with its own connections.
+parallel_datatypes = config.getboolean('PERFORMANCE', 'parallel_datatypes', fallback=False)
+# conveyor_journal_dir: when set, conveyor raw mirror and gh_pr_po_file writes are journaled to this directory and
+# applied to conveyor by a background drainer, conveyor_journal_batch_size lines per conveyor transaction.
+conveyor_journal_dir = config.get('PERFORMANCE', 'conveyor_journal_dir', fallback='')
+conveyor_journal_batch_size = config.getint('PERFORMANCE', 'conveyor_journal_batch_size', fallback=1000)
+# db_pool_size: connections per database (park, conveyor) that can be checked out at the same time; the main loop keeps one
+# of each, and with parallel_datatypes each of the two workers checks out its own, so at least 3 then.
+db_pool_size = config.getint('PERFORMANCE', 'db_pool_size', fallback=4)
+# status_watch: inotify (wake up as soon as a .fetched marker arrives, polling when inotify is not available) or poll;
+# status_poll_seconds: how often the status directories' modification times are checked when polling.
+status_watch = config.get('PERFORMANCE', 'status_watch', fallback='inotify')
+status_poll_seconds = config.getint('PERFORMANCE', 'status_poll_seconds', fallback=30)
+# manifest_file: SQLite file recording each datafile's state, row counts, timings and checksum; when set it, and not the
+# .processed/.error markers, decides which datafiles are done (the markers are still written); with commit_mode = rows, a
+# datafile that stopped part way resumes after its last committed row. Empty = markers only.
+manifest_file = config.get('PERFORMANCE', 'manifest_file', fallback='')
+# reference_cache_seconds: products, sites and the validation rules are loaded once and shared by the datafiles for up to
+# this many seconds (0 = loaded for every datafile); reference_cache_probe: reload sooner when a row count probe of
+# their tables changes; reference_cache_file: JSON snapshot of the cache, read at startup (empty = none).
+reference_cache_seconds = config.getint('PERFORMANCE', 'reference_cache_seconds', fallback=0)
+reference_cache_probe = config.getboolean('PERFORMANCE', 'reference_cache_probe', fallback=False)
+reference_cache_file = config.get('PERFORMANCE', 'reference_cache_file', fallback='')
+# parallel_reference_load: run the reference data and current line item queries of a datafile at the same time, on pooled connections.
+parallel_reference_load = config.getboolean('PERFORMANCE', 'parallel_reference_load', fallback=False)
+# typed_rows: convert line numbers, quantities, amounts and dates of the datafile rows once when they are read, and
+# skip rows whose values do not convert instead of sending them to MySQL (see RowDecoder); they are counted in the
+# process log and listed in the email. false sends every value to MySQL as the datafile string.
+typed_rows = config.getboolean('PERFORMANCE', 'typed_rows', fallback=True)
+# skip_unchanged_rows: store a content_hash with every PR/PO line item and skip the UPDATEs of lines whose hash has not
+# changed; needs the content_hash column (see FeedSchema) in gh_eapproval_pr_line_item and gh_sap_po_line_item, in both databases.
+skip_unchanged_rows = config.getboolean('PERFORMANCE', 'skip_unchanged_rows', fallback=False)
+# collapse_duplicate_lines: read a whole datafile first and skip the line item writes of rows that a later row of the same
+# line supersedes (only rows whose product, site and AQ_ID map take part in the line item writes); the rows are still recorded
+# in gh_pr_po_file and checked for invalid records (not used with streaming_decrypt).
+collapse_duplicate_lines = config.getboolean('PERFORMANCE', 'collapse_duplicate_lines', fallback=False)
+# diagnostics_sample_size: PR/PO lines kept per unmapped site code or aq_id for the process log and email (see DiagnosticsCollector).
+diagnostics_sample_size = config.getint('PERFORMANCE', 'diagnostics_sample_size', fallback=5)
+if commit_mode not in ('rows', 'file', 'savepoint'):
+    logging.critical('*ERROR* [PERFORMANCE] commit_mode must be rows, file or savepoint, not ' + commit_mode)
+    sys.exit(1)
+if consolidation_engine not in ('legacy', 'set', 'verify'):
+    logging.critical('*ERROR* [PERFORMANCE] consolidation_engine must be legacy, set or verify, not ' + consolidation_engine)
+    sys.exit(1)
+# with a smaller pool the workers would wait for a connection the main loop never gives back.
+min_db_pool_size = 3 if parallel_datatypes else 1
+if db_pool_size < min_db_pool_size:
+    logging.critical('*ERROR* [PERFORMANCE] db_pool_size must be at least ' + str(min_db_pool_size) +
+                     (' with parallel_datatypes (one connection for the main loop and one per worker)' if parallel_datatypes else '') + ', not ' + str(db_pool_size))
+    sys.exit(1)
+
+
 ######### GPG CREDENTIALS
 msginfo = 'Reading environment GPG credentials...'
 logging.info(msginfo)
@@ -109,79 +196,96 @@ except Exception as osdberr:
 ####################################################################################################
 # Setting database configuration
 ####################################################################################################
-try:
-    conn = pymysql.connect(host=db_host,
+# session settings of every park and conveyor connection.
+db_session_settings = {'charset': 'latin1',  # utf8mb4
+                       'autocommit': False,
+                       'cursorclass': pymysql.cursors.DictCursor}
+
+def connect_park():
+    return pymysql.connect(host=db_host,
                        user=db_user,
                        passwd=db_password,
                        db=db_name,
-                       charset='latin1',  # utf8mb4
-                       cursorclass=pymysql.cursors.DictCursor)
+                       **db_session_settings)
 
-    conn2 = pymysql.connect(host=db_host2,
+def connect_conveyor():
+    return pymysql.connect(host=db_host2,
                        user=db_user2,
                        passwd=db_password2,
                        db=db_name2,
-                       charset='latin1',  # utf8mb4
-                       cursorclass=pymysql.cursors.DictCursor)
+                       local_infile=provenance_load_data,
+                       **db_session_settings)
+
+try:
+    conn = connect_park()
+    conn2 = connect_conveyor()
 except Exception as dberr:
     errmsg = '*DATABASE CONNECTION ERROR* Unable to connect to the database...Please check the connection settings.\n' + str(dberr)
     logging.critical(errmsg)
     sys.exit(1)
 
 
-def processing_PR(conn, conn2, input_text_datafile, file_name):
-    log, products, sites, current_invalid_PR = {}, {}, {}, []
-    current_raw_PR_IDs, current_PR_IDs = [], []
-    sitecode_not_found = aqid_not_found = equipment_id = equipment_db_id = ''
+####################################################################################################
+# The PR and PO feeds (see FeedSchema).
+####################################################################################################
+PR_SCHEMA = FeedSchema('PR', 'gh_eapproval_pr_line_item', PR_DB_COL_MAPPING, PR_COLUMN_TYPES, 'gh_pr_invalid_data', 'functional_location_code',
+                       with_hash=skip_unchanged_rows)
+PO_SCHEMA = FeedSchema('PO', 'gh_sap_po_line_item', PO_DB_COL_MAPPING, PO_COLUMN_TYPES, 'gh_po_invalid_data', 'functional_location',
+                       pr_columns=['pr_nbr', 'pr_line_nbr'], with_status=True, insert_deleted=True, with_hash=skip_unchanged_rows)
+
+####################################################################################################
+# Loads a decrypted PR or PO datafile (schema: PR_SCHEMA or PO_SCHEMA) into the line item table, its
+# conveyor mirror and gh_pr_po_file, and the invalid table of the feed. data_path is the pr_data_path
+# or po_data_path the .processed/.error markers are written to.
+####################################################################################################
+def processing_line_items(schema, data_path, conn, conn2, input_text_datafile, file_name, consolidation_scope, invalid_recs, diagnostics, resume_row=0):
+    name = schema.name
+    log, products, sites, current_invalid = {}, {}, {}, {}
+    current_raw_IDs, current_IDs = set(), {}
+    # stored content_hash of the line items, with skip_unchanged_rows.
+    current_raw_hashes = {} if skip_unchanged_rows else None
+    current_hashes = {} if skip_unchanged_rows else None
+    # stored pr_nbr of the line items, for a feed with pr_columns.
+    current_pr_nbrs = {} if schema.pr_columns else None
+    raw_rows_unchanged = rows_unchanged = 0
+    sitecode_not_found = DiagnosticsCollector('SAP Site Code not found in gh_sites:', diagnostics_sample_size)
+    aqid_not_found = DiagnosticsCollector('aq_id not found in gh_bom_equipment:', diagnostics_sample_size)
+    malformed_rows = DiagnosticsCollector('Malformed datafile rows skipped:', diagnostics_sample_size)
+    diagnostics.extend((sitecode_not_found, aqid_not_found, malformed_rows))
     total_no_recs = raw_rows_inserted = raw_rows_updated = rows_updated_with_rectype_c = recs_with_null_aqid = 0
     rows_inserted = rows_updated = rows_deleted = 0
     invalid_prod_sites_rows_inserted = invalid_prod_sites_rows_updated = 0
     invalid_kpr_rel_rows_inserted = invalid_kpr_rel_rows_updated  = 0
-    valid_prod_sites_and_kpr_rel_deleted = 0
+    valid_prod_sites_and_kpr_rel_deleted = invalid_rows_unchanged = 0
 
-    logging.info('Begin PR processing at ' + datetime.now().strftime('%Y-%m-%d %X'))
+    logging.info('Begin processing ' + name + ' at ' + datetime.now().strftime('%Y-%m-%d %X'))
     log['loaded_date_time'] = datetime.now().strftime("%Y-%m-%d %X")
 
-    db_col_mapping = { 'pr_nbr': 'PURCHASE_REQUISITION_NBR',
-                       'pr_line_nbr': 'PURCH_REQ_LINE_NBR',
-                       'pr_status_desc': 'PR_STATUS_DESCRIPTION',
-                       'company_code': 'COMPANY_CODE',
-                       'currency_code': 'CURRENCY_CODE',
-                       'request_date': 'REQUEST_DATE',
-                       'material_description': 'MATERIAL_DESCRIPTION',
-                       'total_amount': 'TOTAL_AMOUNT',
-                       'price_per_unit': 'PRICE_PER_UNIT',
-                       'quantity': 'QUANTITY',
-                       'model_number': 'MODEL_NUMBER',
-                       'aq_id': 'AQ_ID',
-                       'project_nbr': 'PROJECT_NBR',
-                       'spend_type_code': 'SPEND_TYPE_CODE',
-                       'functional_location_code': 'FUNCTIONAL_LOCATION_CODE',
-                       'spend_type_description': 'SPEND_TYPE_DESCRIPTION',
-                       'functional_location_description': 'FUNCTIONAL_LOCATION_DESCRIPTION',
-                       'destination': 'DESTINATION',
-                       'vendor_number': 'VENDOR_NUMBER',
-                       'vendor_name': 'VENDOR_NAME',
-                       'initiator': 'INITIATOR',
-                       'cost_center_nbr': 'COST_CENTER_NBR',
-                       'record_type': 'RECORD_TYPE' }
+    ####################################################################################################
+    # Mapping: Database columns <=> column header from text datafile (see FeedSchema).
+    ####################################################################################################
+    db_col_mapping = schema.db_col_mapping
+    nbr_col, line_nbr_col = db_col_mapping[schema.key_columns[0]], db_col_mapping[schema.key_columns[1]]
+    aqid_col, spend_type_col = db_col_mapping['aq_id'], db_col_mapping['spend_type_description']
+    site_col = db_col_mapping[schema.site_column]
+    pr_nbr_of = schema.row_getter(schema.pr_columns[0]) if schema.pr_columns else None
 
     ####################################################################################################
     # Logging.
     # Exception occured: must be str, not PosixPath. (cast filename to str())
-    logging.info('Opening datafile: /var/pr/data/' + str(file_name))
-    log['file_name'] = pr_data_path + '/data/' + str(file_name)
-    log['decrypted_data_loc'] = pr_data_path + '/tmp/'
+    logging.info('Opening datafile: ' + data_path + '/data/' + str(file_name))
+    log['file_name'] = data_path + '/data/' + str(file_name)
+    log['decrypted_data_loc'] = data_path + '/tmp/'
     logging.info('Reading datafile.' + '\n')
 
     ##################################################################################
     # strip() to remove all leading or trailing blank spaces before the fieldnames from the datafiles.
     # Console: Exception occured: name 'col' is not defined. Mismatched column names.
     ##################################################################################
-    headers = input_text_datafile.fieldnames
+    headers = next(input_text_datafile, None)
     if not headers:
         logging.error('Datafile is empty. Please check the datafile and try again.')
-        open(pr_data_path + '/status/' + str(file_name) + '.processed', 'a').close()
+        open(data_path + '/status/' + str(file_name) + '.processed', 'a').close()
         return
     else:
         headers = [x.strip(' ') for x in headers]
@@ -190,227 +294,134 @@ def processing_PR(conn, conn2, input_text_datafile, file_name):
                 logging.error(v + ' Headers do not match. Please check the datafile.')
                 sys.exit(1)
 
-    logging.info('Getting products from gh_product_codes...')
-    products = get_product_id(conn)
-
-    logging.info('Getting site_id from gh_sites...')
-    sites = get_site_id(conn)
-
-    logging.info('Getting valid products and sites...')
-    valid_product_sites = check_valid_product_and_site(conn)
-
-    logging.info('Getting AQ_ID with no KPR Release...')
-    invalid_aqid_kpr_release = check_invalid_aqid_with_kpr_release(conn)
+    # the datafile rows as records of the db_col_mapping columns (row.AQ_ID).
+    datafile_rows = RowDecoder(headers, db_col_mapping.values(), schema.column_types, typed_rows, malformed_rows)
 
     ####################################################################################################
-    logging.info('(RAW) Getting current pr_nbr, pr_line_nbr from conveyor gh_eapproval_pr_line_item...')
+    # Products, sites and validation rules (shared by the datafiles while reference_cache is fresh) and
+    # the current line items; run at the same time on pooled connections with parallel_reference_load.
     ####################################################################################################
+    nbr_db_col, line_nbr_db_col = schema.key_columns
+    logging.info('Getting reference data, ' + nbr_db_col + ', ' + line_nbr_db_col + ' from ' + schema.table +
+                 ' and current invalid recs from ' + schema.invalid_table + '...')
+    loads = {'reference_data': (park_pool, conn, reference_cache.get),
+             'current_IDs': (park_pool, conn, lambda c: get_line_item_summary_keys(c, schema.table, nbr_db_col, line_nbr_db_col, current_hashes, current_pr_nbrs)),
+             'current_invalid': (park_pool, conn, lambda c: get_invalid_records(c, schema.invalid_table, nbr_db_col, line_nbr_db_col, schema.invalid_state_columns))}
+    # with the conveyor journal, the drainer looks up the existing lines when it applies them.
+    if conveyor_journal is None:
+        logging.info('(RAW) Getting current ' + nbr_db_col + ', ' + line_nbr_db_col + ' from conveyor ' + schema.table + '...')
+        loads['current_raw_IDs'] = (conveyor_pool, conn2, lambda c: get_line_item_keys(c, schema.table, nbr_db_col, line_nbr_db_col, current_raw_hashes))
     try:
-        with conn2.cursor() as cursor:
-            sql = "SELECT concat(pr_nbr, ':', pr_line_nbr) as pr_id FROM gh_eapproval_pr_line_item"
-            cursor.execute(sql)
-            result = cursor.fetchall()
-
-            for row in result:
-                current_raw_PR_IDs.append(row['pr_id'])
+        loaded = run_loads(loads, parallel_reference_load)
     except Exception as err:
-        errmsg = "*(RAW) ERROR* %s while getting current records from conveyor gh_eapproval_pr_line_item...", err
+        errmsg = "*ERROR* %s while getting reference data and current records in processing_line_items() for %s." % (format(err), name)
         logging.critical(errmsg)
         raise
 
-    ####################################################################################################
-    logging.info('Getting pr_nbr, pr_line_nbr from gh_eapproval_pr_line_item...')
-    ####################################################################################################
-    try:
-        with conn.cursor() as cursor:
-            sql = "SELECT concat(pr_nbr, ':', pr_line_nbr) as pr_id FROM gh_eapproval_pr_line_item"
-            cursor.execute(sql)
-            result = cursor.fetchall()
-    
-            for row in result:
-                current_PR_IDs.append(row['pr_id'])
-    
-            ####################################################################################################
-            # Getting current rec from gh_pr_invalid_data
-            logging.info('Getting current invalid recs from gh_pr_invalid_data...')
-            ####################################################################################################
-            sql = "SELECT pr_nbr, pr_line_nbr, aq_id, gh_product_id, gh_site_id FROM gh_pr_invalid_data"
-            cursor.execute(sql)
-            result = cursor.fetchall()
-    
-            for row in result:
-                current_invalid_PR.append({'pr_nbr': row['pr_nbr'],
-                                           'pr_line_nbr': row['pr_line_nbr']})
-
-        ####################################################################################################
-        # Defining SQLs
-        ####################################################################################################
-        new_pr_INSERT_SQL = """
-            INSERT INTO gh_eapproval_pr_line_item (pr_nbr, pr_line_nbr, pr_status_desc, company_code, currency_code, request_date, material_description, total_amount, price_per_unit, quantity, model_number, aq_id, project_nbr, spend_type_code, functional_location_code, spend_type_description, functional_location_description, destination, vendor_number, vendor_name, initiator, cost_center_nbr, record_type, gh_product_id, gh_site_id, gh_equipment_id, gh_equipment_db_id, created)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"""
-
-        new_raw_pr_INSERT_SQL = """
-            INSERT INTO gh_eapproval_pr_line_item (pr_nbr, pr_line_nbr, pr_status_desc, company_code, currency_code, request_date, material_description, total_amount, price_per_unit, quantity, model_number, aq_id, project_nbr, spend_type_code, functional_location_code, spend_type_description, functional_location_description, destination, vendor_number, vendor_name, initiator, cost_center_nbr, record_type, gh_product_id, gh_site_id, gh_equipment_id, gh_equipment_db_id, gh_product_name, gh_site, created)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"""
-
-        pr_UPDATE_SQL = """
-            UPDATE gh_eapproval_pr_line_item
-            SET
-                pr_status_desc = %s,
-                company_code = %s,
-                currency_code = %s,
-                request_date = %s,
-                material_description = %s,
-                total_amount = %s,
-                price_per_unit = %s,
-                quantity = %s,
-                model_number = %s,
-                aq_id = %s,
-                project_nbr = %s,
-                spend_type_code = %s,
-                functional_location_code = %s,
-                spend_type_description = %s,
-                functional_location_description = %s,
-                destination = %s,
-                vendor_number = %s,
-                vendor_name = %s,
-                initiator = %s,
-                cost_center_nbr = %s,
-                record_type = %s,
-                gh_product_id = %s,
-                gh_site_id = %s,
-                gh_equipment_id = %s,
-                gh_equipment_db_id = %s,
-                updated = %s,
-                status_id = %s
-             WHERE
-                pr_nbr = %s
-                AND pr_line_nbr = %s"""
-
-        pr_raw_UPDATE_SQL = """
-            UPDATE gh_eapproval_pr_line_item
-            SET
-                pr_status_desc = %s,
-                company_code = %s,
-                currency_code = %s,
-                request_date = %s,
-                material_description = %s,
-                total_amount = %s,
-                price_per_unit = %s,
-                quantity = %s,
-                model_number = %s,
-                aq_id = %s,
-                project_nbr = %s,
-                spend_type_code = %s,
-                functional_location_code = %s,
-                spend_type_description = %s,
-                functional_location_description = %s,
-                destination = %s,
-                vendor_number = %s,
-                vendor_name = %s,
-                initiator = %s,
-                cost_center_nbr = %s,
-                record_type = %s,
-                gh_product_id = %s,
-                gh_site_id = %s,
-                gh_equipment_id = %s,
-                gh_equipment_db_id = %s,
-                gh_product_name = %s,
-                gh_site = %s,
-                updated = %s
-             WHERE
-                pr_nbr = %s
-                AND pr_line_nbr = %s"""
-    
-        filename_by_pr_po_rec = """
-            INSERT INTO gh_pr_po_file (pr_nbr, pr_line_nbr, file_name, created)
-            VALUES (%s, %s, %s, %s)"""
-
-        pr_status_UPDATE_SQL = """
-            UPDATE gh_eapproval_pr_line_item
-            SET
-                record_type = %s, updated = %s, status_id = %s
-            WHERE 
-                pr_nbr = %s
-                AND pr_line_nbr = %s"""
-
-        pr_invalid_product_site_aqid_INSERT_SQL = """
-            INSERT INTO gh_pr_invalid_data (pr_nbr, pr_line_nbr, aq_id, gh_product_id, gh_site_id, gh_equipment_id, gh_equipment_db_id, category, description, updated)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"""
-
-        pr_invalid_product_site_aqid_UPDATE_SQL = """
-            UPDATE gh_pr_invalid_data
-            SET
-                aq_id = %s,
-                gh_product_id = %s,
-                gh_site_id = %s,
-                gh_equipment_id = %s,
-                gh_equipment_db_id = %s,
-                description = %s,
-                status_id = %s,
-                updated = %s
-            WHERE
-                pr_nbr = %s
-                and pr_line_nbr = %s"""
-
-        pr_invalid_product_site_aqid_DELETE_SQL = """
-            UPDATE gh_pr_invalid_data
-            SET
-                updated = %s, status_id = %s
-            WHERE
-                pr_nbr = %s
-                and pr_line_nbr = %s"""
+    reference_data = loaded['reference_data']
+    products, sites, validation_rules = reference_data.products, reference_data.sites, reference_data.validation_rules
+    current_IDs, current_invalid = loaded['current_IDs'], loaded['current_invalid']
+    current_raw_IDs = loaded.get('current_raw_IDs', current_raw_IDs)
 
+    journal_writer = None
+    try:
         ###########################################################
         # Looping thru each record from the main datafile
         # date format from datafile is: yyyy-mm-dd, any other format will cause this conversion to fail.
-        # datetime.strptime(row['PO_DATE'], '%m/%d/%y').strftime('%Y-%m-%d')
+        # datetime.strptime(row.PO_DATE, '%m/%d/%y').strftime('%Y-%m-%d')
         # datetime.now().strftime("%Y-%m-%d %X")	# the %X is shorthand for 00:00:00
         ###########################################################
         now = datetime.now().strftime("%Y-%m-%d %X")
         #now = datetime.now().strftime("%Y-%m-%d 00:00:00")
         spend_type_desc = ['EQ','RETRO','AOU']
+        # status_id values of the statements that only write it with_status.
+        active = (1,) if schema.with_status else ()
 
-        for row in input_text_datafile:
-            product_sites = {}
-            record_not_matched_flag = ''
-            total_no_recs += 1
-            pr_id = row['PURCHASE_REQUISITION_NBR'] + ':' + row['PURCH_REQ_LINE_NBR']
+        # AQ_IDs are resolved against gh_bom_equipment for a chunk of rows at a time instead of one query per row.
+        equipment_resolver = EquipmentResolver(conn)
 
-            ###########################################################
+        ####################################################################################################
+        # Product, site and equipment of a datafile row (prefetch its AQ_ID first). A row gets to the line
+        # item writes of the main logic below only when all of them map (see writes_line_item()).
+        ####################################################################################################
+        def map_line_item(row):
             product_id = product_name = None
-            gh_product = products.get(row['PROJECT_NBR'])
+            gh_product = products.get(row.PROJECT_NBR)
             if gh_product:
                 product_id = gh_product['product_id']
                 product_name = gh_product['product_name']
 
-            ###########################################################
             site_id = site = None
-            gh_site = sites.get(row['FUNCTIONAL_LOCATION_CODE'])
+            gh_site = sites.get(getattr(row, site_col))
             if gh_site:
                 site_id = gh_site['site_id']
                 site = gh_site.get('site')		# for populating gh_site in raw table and in email report.
-            else:
-                if (row['FUNCTIONAL_LOCATION_CODE'] == 'LOCN-TBD1'):
-                    site_id = 0
-                elif (row['FUNCTIONAL_LOCATION_CODE'] == ''):
-                    sitecode_not_found += row['FUNCTIONAL_LOCATION_CODE'] + " (" + row['PURCHASE_REQUISITION_NBR'] + '-' + row['PURCH_REQ_LINE_NBR'] + ")\n"
-                else:
-                    sitecode_not_found += row['FUNCTIONAL_LOCATION_CODE'] + " (" + row['PURCHASE_REQUISITION_NBR'] + '-' + row['PURCH_REQ_LINE_NBR'] + ")\n"
+            elif (getattr(row, site_col) == 'LOCN-TBD1'):
+                site_id = 0
 
-            #print('(PR) FUNCTIONAL_LOCATION_CODE: ', row['FUNCTIONAL_LOCATION_CODE'], ' , site_id: ', site_id, ', site: ', site)
+            aq_id = equipment_id = equipment_db_id = None
+            if getattr(row, aqid_col):
+                aq_id = normalize_aqid(getattr(row, aqid_col), getattr(row, spend_type_col))
 
-            ###########################################################
-            equipment_id = equipment_db_id = None
-            if row['AQ_ID']:
-                aq_id = (row['AQ_ID'] + "-R") if (row['SPEND_TYPE_DESCRIPTION'] == 'RETRO' and row['AQ_ID'][-2:] != '-R') else row['AQ_ID']
-
-                aqid_equipment = get_equipment(conn, parse_aqid(aq_id))
+                aqid_equipment = equipment_resolver.resolve(aq_id)
 
                 if (aqid_equipment):
                     equipment_id = aqid_equipment[0]
                     equipment_db_id = aqid_equipment[1]
-            else:
+
+            return product_id, product_name, site_id, site, aq_id, equipment_id, equipment_db_id
+
+        def writes_line_item(row):
+            product_id, _, site_id, _, _, equipment_id, equipment_db_id = map_line_item(row)
+            return bool(product_id and getattr(row, spend_type_col) in spend_type_desc and site_id != None and equipment_id and equipment_db_id)
+
+        # line item INSERT/UPDATEs are buffered and sent as executemany() batches (multi-row INSERTs).
+        writer = BatchWriter(conn, batch_size, savepoints=(commit_mode == 'savepoint'))
+        if conveyor_journal is None:
+            raw_writer = BatchWriter(conn2, batch_size, savepoints=(commit_mode == 'savepoint'))
+
+            # which file each line came from, written to conveyor gh_pr_po_file in large batches.
+            provenance = ProvenanceRecorder(conn2, 'gh_pr_po_file', schema.provenance_columns, provenance_batch_size, provenance_load_data)
+            commit_conns = [conn2, conn]
+        else:
+            # raw lines and gh_pr_po_file rows go to the conveyor journal; conn2 is not written here.
+            raw_writer = provenance = journal_writer = conveyor_journal.writer(schema.table, nbr_db_col, line_nbr_db_col, schema.raw_insert_SQL, schema.raw_update_SQL,
+                                                                               'gh_pr_po_file', schema.provenance_columns)
+            commit_conns = [conn]
+
+        # nothing is committed per statement; see CommitPolicy.
+        commit_policy = CommitPolicy(commit_conns, [provenance, raw_writer, writer], commit_mode, commit_every,
+                                     None if processing_manifest is None else functools.partial(processing_manifest.committed, name, file_name),
+                                     resume_row)
+
+        rows = datafile_rows.decode(input_text_datafile)
+        raw_duplicate_lines = DuplicateLineCollapser(nbr_col, line_nbr_col)
+        duplicate_lines = DuplicateLineCollapser(nbr_col, line_nbr_col)
+        # whether a later row of the same line supersedes the raw and the line item write of a row.
+        raw_superseded = superseded = itertools.repeat(False)
+        if collapse_duplicate_lines and not streaming_decrypt:
+            # every I/U/D row writes its raw line, but only a mapped one writes its line item.
+            rows = list(prefetch_equipment(rows, equipment_resolver, aqid_col, spend_type_col, aqid_prefetch_size))
+            rows, raw_superseded = raw_duplicate_lines.collapse(rows)
+            rows, superseded = duplicate_lines.collapse(rows, writes_line_item)
+        if resume_row:
+            # the first resume_row rows were committed by an earlier run of this datafile ('rows' commit_mode).
+            logging.info('Resuming ' + name + ' ' + file_name + ' after row ' + str(resume_row) + ', committed by an earlier run.')
+            rows, raw_superseded, superseded = (itertools.islice(values, resume_row, None) for values in (rows, raw_superseded, superseded))
+
+        for row, row_raw_superseded, row_superseded in zip(prefetch_equipment(rows, equipment_resolver, aqid_col, spend_type_col, aqid_prefetch_size),
+                                                           raw_superseded, superseded):
+            record_not_matched_flag = ''
+            total_no_recs += 1
+            nbr, line_nbr = getattr(row, nbr_col), getattr(row, line_nbr_col)
+            line_id = line_item_key(nbr, line_nbr)
+            row_aqid, site_code = getattr(row, aqid_col), getattr(row, site_col)
+
+            ###########################################################
+            product_id, product_name, site_id, site, aq_id, equipment_id, equipment_db_id = map_line_item(row)
+            if site_code not in sites and site_code != 'LOCN-TBD1':
+                sitecode_not_found.add(site_code, nbr + '-' + str(line_nbr))
+            if not row_aqid:
                 recs_with_null_aqid += 1
 
             ####################################################################################################
@@ -418,105 +429,44 @@ def processing_PR(conn, conn2, input_text_datafile, file_name):
             # ERRORS: KeyError: 'T205380101'
             #         During handling of the above exception, another exception occurred:
             #         TypeError: not all arguments converted during string formatting
-            # SOL: row['PROJECT_NBR'] doesnot exist in products{} , set to default valiue 'None'
+            # SOL: row.PROJECT_NBR doesnot exist in products{} , set to default valiue 'None'
             ####################################################################################################
-            if conn2.open:
-                try:
-                    with conn2.cursor() as cursor:
-                        if ( (row['RECORD_TYPE'] == 'I') or (row['RECORD_TYPE'] == 'U') or (row['RECORD_TYPE'] == 'D') ):
-                            data = (row['PURCHASE_REQUISITION_NBR'], row['PURCH_REQ_LINE_NBR'], file_name, now)
-                            cursor.execute(filename_by_pr_po_rec, data)
-                            conn2.commit()
-
-                            if pr_id not in current_raw_PR_IDs:
-                                data = (row['PURCHASE_REQUISITION_NBR'],
-                                        row['PURCH_REQ_LINE_NBR'],
-                                        row['PR_STATUS_DESCRIPTION'],
-                                        row['COMPANY_CODE'],
-                                        row['CURRENCY_CODE'],
-                                        row['REQUEST_DATE'],
-                                        row['MATERIAL_DESCRIPTION'],
-                                        row['TOTAL_AMOUNT'],
-                                        row['PRICE_PER_UNIT'],
-                                        row['QUANTITY'],
-                                        row['MODEL_NUMBER'],
-                                        row['AQ_ID'],
-                                        row['PROJECT_NBR'],
-                                        row['SPEND_TYPE_CODE'],
-                                        row['FUNCTIONAL_LOCATION_CODE'],
-                                        row['SPEND_TYPE_DESCRIPTION'],
-                                        row['FUNCTIONAL_LOCATION_DESCRIPTION'],
-                                        row['DESTINATION'],
-                                        row['VENDOR_NUMBER'],
-                                        row['VENDOR_NAME'],
-                                        row['INITIATOR'],
-                                        row['COST_CENTER_NBR'],
-                                        row['RECORD_TYPE'],
-                                        product_id,
-                                        site_id,
-                                        equipment_id,
-                                        equipment_db_id,
-                                        product_name,
-                                        site,
-                                        now)
-                                cursor.execute(new_raw_pr_INSERT_SQL, data)
-                                raw_rows_inserted += cursor.rowcount
-                                conn2.commit()
-                            else:
-                                data = (row['PR_STATUS_DESCRIPTION'],
-                                        row['COMPANY_CODE'],
-                                        row['CURRENCY_CODE'],
-                                        row['REQUEST_DATE'],
-                                        row['MATERIAL_DESCRIPTION'],
-                                        row['TOTAL_AMOUNT'],
-                                        row['PRICE_PER_UNIT'],
-                                        row['QUANTITY'],
-                                        row['MODEL_NUMBER'],
-                                        row['AQ_ID'],
-                                        row['PROJECT_NBR'],
-                                        row['SPEND_TYPE_CODE'],
-                                        row['FUNCTIONAL_LOCATION_CODE'],
-                                        row['SPEND_TYPE_DESCRIPTION'],
-                                        row['FUNCTIONAL_LOCATION_DESCRIPTION'],
-                                        row['DESTINATION'],
-                                        row['VENDOR_NUMBER'],
-                                        row['VENDOR_NAME'],
-                                        row['INITIATOR'],
-                                        row['COST_CENTER_NBR'],
-                                        row['RECORD_TYPE'],
-                                        product_id,
-                                        site_id,
-                                        equipment_id,
-                                        equipment_db_id,
-                                        product_name,
-                                        site,
-                                        now,
-                                        row['PURCHASE_REQUISITION_NBR'],
-                                        row['PURCH_REQ_LINE_NBR'])
-                                cursor.execute(pr_raw_UPDATE_SQL, data)
-                                raw_rows_updated += cursor.rowcount
-                                conn2.commit()
-                except Exception as err:
-                    logging.critical('*ERROR* while inserting or updating raw PR data to conveyor database. ', err)
-                    send_email_notification_on_errors()
-                    raise
-            else:
-                conn2.ping(reconnect=True)
+            try:
+                if ( (row.RECORD_TYPE == 'I') or (row.RECORD_TYPE == 'U') or (row.RECORD_TYPE == 'D') ):
+                    provenance.record(schema.provenance_params(row, (file_name, now)))
+
+                # a superseded row is recorded above, but a later row of its line in the file writes the line.
+                if ( (row.RECORD_TYPE == 'I') or (row.RECORD_TYPE == 'U') or (row.RECORD_TYPE == 'D') ) and not row_raw_superseded:
+                    raw_hash = schema.content_hash(row, (product_id, site_id, equipment_id, equipment_db_id, product_name, site)) if skip_unchanged_rows else None
+                    if line_id not in current_raw_IDs:
+                        data = schema.raw_insert_params(row, (product_id, site_id, equipment_id, equipment_db_id, product_name, site, now) + active, raw_hash)
+                        raw_writer.add(schema.raw_insert_SQL, data, line_id, 'raw_rows_inserted')
+                        current_raw_IDs.add(line_id)
+                    elif raw_hash is not None and current_raw_hashes.get(line_id) == raw_hash:
+                        raw_rows_unchanged += 1
+                    else:
+                        data = schema.raw_update_params(row, (product_id, site_id, equipment_id, equipment_db_id, product_name, site, now) + active, raw_hash)
+                        raw_writer.add(schema.raw_update_SQL, data, line_id, 'raw_rows_updated')
+                    if raw_hash is not None:
+                        current_raw_hashes[line_id] = raw_hash
+            except Exception as err:
+                logging.critical('*ERROR* while inserting or updating raw ' + name + ' data to conveyor database. ', err)
+                raise
 
             ####################################################################################################
             # Main Logic
             ####################################################################################################
             if product_id:
-                if row['SPEND_TYPE_DESCRIPTION'] in spend_type_desc:
+                if getattr(row, spend_type_col) in spend_type_desc:
                     if site_id != None:
                         if (equipment_id and equipment_db_id):
                             try:
                                 with conn.cursor() as cursor:
                                     ####################################################################################################
                                     # The record types:
-                                    #	“I” for new PR
-                                    #	“U” for changed PR (OLD. No longer used.)
-                                    #	“D” for deleted/cancelled PR.
+                                    #	“I” for new PR/PO
+                                    #	“U” for changed PR/PO (OLD. No longer used.)
+                                    #	“D” for deleted/cancelled PR/PO.
                                     #
                                     # * For 'I' and 'U', insert new record into database, if a record exists in database, then update.
                                     #   By default, status_id is set to '1' for newly inserted record
@@ -528,217 +478,117 @@ def processing_PR(conn, conn2, input_text_datafile, file_name):
                                     # ERROR:  Warning: (1264, "Out of range value for column 'xxxx_date' at row 1")
                                     # SOLUTION: incorrect date format. Must be yyyy-mm-dd
                                     ####################################################################################################
-                                    if (row['RECORD_TYPE'] == 'I') or (row['RECORD_TYPE'] == 'U'):
+                                    # equipment summary key this line is written with; the stored key is in current_IDs.
+                                    summary_key = (product_id, site_id, equipment_id, equipment_db_id)
+
+                                    if row_superseded:
+                                        # a later row of this line in the file writes it.
+                                        pass
+                                    elif (row.RECORD_TYPE == 'I') or (row.RECORD_TYPE == 'U'):
                                         ####################################################################################################
                                         # Checking if the record in the datafile is already in the database.
                                         ####################################################################################################
-                                        if pr_id not in current_PR_IDs:
-                                            data = (row['PURCHASE_REQUISITION_NBR'],
-                                                    row['PURCH_REQ_LINE_NBR'],
-                                                    row['PR_STATUS_DESCRIPTION'],
-                                                    row['COMPANY_CODE'],
-                                                    row['CURRENCY_CODE'],
-                                                    row['REQUEST_DATE'],
-                                                    row['MATERIAL_DESCRIPTION'],
-                                                    row['TOTAL_AMOUNT'],
-                                                    row['PRICE_PER_UNIT'],
-                                                    row['QUANTITY'],
-                                                    row['MODEL_NUMBER'],
-                                                    row['AQ_ID'],
-                                                    row['PROJECT_NBR'],
-                                                    row['SPEND_TYPE_CODE'],
-                                                    row['FUNCTIONAL_LOCATION_CODE'],
-                                                    row['SPEND_TYPE_DESCRIPTION'],
-                                                    row['FUNCTIONAL_LOCATION_DESCRIPTION'],
-                                                    row['DESTINATION'],
-                                                    row['VENDOR_NUMBER'],
-                                                    row['VENDOR_NAME'],
-                                                    row['INITIATOR'],
-                                                    row['COST_CENTER_NBR'],
-                                                    row['RECORD_TYPE'],
-                                                    product_id,
-                                                    site_id,
-                                                    equipment_id,
-                                                    equipment_db_id,
-                                                    now)
-                                            cursor.execute(new_pr_INSERT_SQL, data)
-                                            rows_inserted += cursor.rowcount
-                                            conn.commit()
+                                        row_hash = schema.content_hash(row, summary_key) if skip_unchanged_rows else None
+                                        if line_id not in current_IDs:
+                                            data = schema.insert_params(row, (product_id, site_id, equipment_id, equipment_db_id, now) + active, row_hash)
+                                            writer.add(schema.insert_SQL, data, line_id, 'rows_inserted')
+                                            consolidation_scope.add_keys(summary_key)
+                                            if pr_nbr_of:
+                                                consolidation_scope.add_pr_nbr(pr_nbr_of(row))
+                                                current_pr_nbrs[line_id] = pr_nbr_of(row)
+                                            current_IDs[line_id] = summary_key
+                                        elif row_hash is not None and current_hashes.get(line_id) == row_hash:
+                                            # stored with the same data, equipment and status_id 1; nothing to write.
+                                            rows_unchanged += 1
                                         else:
-                                            data = (row['PR_STATUS_DESCRIPTION'],
-                                                    row['COMPANY_CODE'],
-                                                    row['CURRENCY_CODE'],
-                                                    row['REQUEST_DATE'],
-                                                    row['MATERIAL_DESCRIPTION'],
-                                                    row['TOTAL_AMOUNT'],
-                                                    row['PRICE_PER_UNIT'],
-                                                    row['QUANTITY'],
-                                                    row['MODEL_NUMBER'],
-                                                    row['AQ_ID'],
-                                                    row['PROJECT_NBR'],
-                                                    row['SPEND_TYPE_CODE'],
-                                                    row['FUNCTIONAL_LOCATION_CODE'],
-                                                    row['SPEND_TYPE_DESCRIPTION'],
-                                                    row['FUNCTIONAL_LOCATION_DESCRIPTION'],
-                                                    row['DESTINATION'],
-                                                    row['VENDOR_NUMBER'],
-                                                    row['VENDOR_NAME'],
-                                                    row['INITIATOR'],
-                                                    row['COST_CENTER_NBR'],
-                                                    row['RECORD_TYPE'],
-                                                    product_id,
-                                                    site_id,
-                                                    equipment_id,
-                                                    equipment_db_id,
-                                                    now,
-                                                    1,
-                                                    row['PURCHASE_REQUISITION_NBR'],
-                                                    row['PURCH_REQ_LINE_NBR'])
-                                            cursor.execute(pr_UPDATE_SQL, data)
-                                            rows_updated += cursor.rowcount
-                                            conn.commit()
-                                    elif (row['RECORD_TYPE'] == 'D'):
-                                        data = (row['RECORD_TYPE'], now, 0, row['PURCHASE_REQUISITION_NBR'], row['PURCH_REQ_LINE_NBR'])
-                                        cursor.execute(pr_status_UPDATE_SQL, data)
-                                        rows_deleted += cursor.rowcount
-                                        conn.commit()
+                                            data = schema.update_params(row, (product_id, site_id, equipment_id, equipment_db_id, now, 1), row_hash)
+                                            writer.add(schema.update_SQL, data, line_id, 'rows_updated')
+                                            consolidation_scope.add_keys(current_IDs[line_id], summary_key)
+                                            if pr_nbr_of:
+                                                # a line moved to another PR leaves the PR it was stored with as well.
+                                                stored_pr_nbr = current_pr_nbrs.get(line_id)
+                                                if stored_pr_nbr != pr_nbr_of(row):
+                                                    consolidation_scope.add_pr_nbr(stored_pr_nbr)
+                                                consolidation_scope.add_pr_nbr(pr_nbr_of(row))
+                                                current_pr_nbrs[line_id] = pr_nbr_of(row)
+                                            current_IDs[line_id] = summary_key
+                                        if row_hash is not None:
+                                            current_hashes[line_id] = row_hash
+                                    elif (row.RECORD_TYPE == 'D'):
+                                        if line_id in current_IDs or not schema.insert_deleted:
+                                            data = schema.status_params(row, (row.RECORD_TYPE, now, 0))
+                                            writer.add(schema.status_UPDATE_SQL, data, line_id, 'rows_deleted')
+                                            consolidation_scope.add_keys(current_IDs.get(line_id))
+                                        else:
+                                            # inserted with status_id 0 and no content_hash.
+                                            data = schema.insert_params(row, (product_id, site_id, equipment_id, equipment_db_id, now, 0))
+                                            writer.add(schema.insert_SQL, data, line_id, 'rows_deleted')
+                                            if pr_nbr_of:
+                                                consolidation_scope.add_pr_nbr(pr_nbr_of(row))
+                                                current_pr_nbrs[line_id] = pr_nbr_of(row)
+                                            current_IDs[line_id] = summary_key
+                                        if current_hashes is not None:
+                                            current_hashes.pop(line_id, None)
 
                                     ####################################################################
                                     # BEGIN checking for invalid records
                                     ####################################################################
-                                    product_sites = {'product_id': product_id,
-                                                     'site_id': site_id}
-
-                                    aqid_kpr_release = {'product_id': product_id,
-                                                        'site_id': site_id,
-                                                        'equipment_id': equipment_id,
-                                                        'equipment_db_id': equipment_db_id}
+                                    category, description = validation_rules.classify(product_id, site_id, equipment_id, equipment_db_id,
+                                                                                     row.PROJECT_NBR, site_code, aq_id)
 
-                                    # cast current_pr.pr_line_nbr to integer because current_invalid_PR.pr_line_nbr is integer.
-                                    current_pr = {'pr_nbr': row['PURCHASE_REQUISITION_NBR'],
-                                                  'pr_line_nbr': int(row['PURCH_REQ_LINE_NBR'])}
+                                    # stored invalid table state of this line, None if it has no invalid record.
+                                    current_invalid_state = current_invalid.get(line_id)
 
                                     ####################################################################
                                     # Is Functional Location a valid site for a given product?
                                     # if not valid, then mark as invalid product site.
+                                    # Does AQID have KPR release? AQID has KPR release if (qty > 0)
                                     ####################################################################
-                                    if product_sites not in valid_product_sites:
-                                        category = 'Invalid product and site'
-                                        description = row['PROJECT_NBR'] + " and " + row['FUNCTIONAL_LOCATION_CODE'] + " are not valid MP site in ghDS."
-                                        send_email_invalid_pr_recs.append([
-                                            row['PURCHASE_REQUISITION_NBR'],
-                                            row['PURCH_REQ_LINE_NBR'],
-                                            '',
-                                            '',
-                                            aq_id,
-                                            product_name,
-                                            site,
-                                            category,
-                                            description])
-
-                                        if current_pr in current_invalid_PR:
-                                            #print('UPDATE: ', current_pr)
-                                            data = (aq_id,
-                                                    product_id,
-                                                    site_id,
-                                                    equipment_id,
-                                                    equipment_db_id,
-                                                    description,
-                                                    '1',
-                                                    now,
-                                                    row['PURCHASE_REQUISITION_NBR'],
-                                                    row['PURCH_REQ_LINE_NBR'])
-                                            cursor.execute(pr_invalid_product_site_aqid_UPDATE_SQL, data)
-                                            invalid_prod_sites_rows_updated += cursor.rowcount
-                                            conn.commit()
-                                        else:
-                                            #print('INSERT: ', current_pr)
-                                            data = (row['PURCHASE_REQUISITION_NBR'],
-                                                    row['PURCH_REQ_LINE_NBR'],
-                                                    aq_id,
-                                                    product_id,
-                                                    site_id,
-                                                    equipment_id,
-                                                    equipment_db_id,
-                                                    category,
-                                                    description,
-                                                    now)
-                                            cursor.execute(pr_invalid_product_site_aqid_INSERT_SQL, data)
-                                            invalid_prod_sites_rows_inserted += cursor.rowcount
-                                            conn.commit()
-                                    elif aqid_kpr_release in invalid_aqid_kpr_release:
-                                        ####################################################################
-                                        # Does AQID have KPR release? AQID has KPR release if (qty > 0)
-                                        ####################################################################
-                                            category = 'No KPR release for AQ_ID'
-                                            description = 'No KPR release for: ' + str(aq_id)
-                                            send_email_invalid_pr_recs.append([
-                                                row['PURCHASE_REQUISITION_NBR'],
-                                                row['PURCH_REQ_LINE_NBR'],
-                                                '',
-                                                '',
-                                                aq_id,
-                                                product_name,
-                                                site,
-                                                category,
-                                                description])
-
-                                            if current_pr in current_invalid_PR:
-                                                #print('UPDATE: ', current_pr)
-                                                data = (aq_id,
-                                                        product_id,
-                                                        site_id,
-                                                        equipment_id,
-                                                        equipment_db_id,
-                                                        description,
-                                                        '1',
-                                                        now,
-                                                        row['PURCHASE_REQUISITION_NBR'],
-                                                        row['PURCH_REQ_LINE_NBR'])
-                                                cursor.execute(pr_invalid_product_site_aqid_UPDATE_SQL, data)
+                                    if category in (INVALID_PRODUCT_SITE, NO_KPR_RELEASE):
+                                        invalid_recs.append(list(schema.report_key(row)) + [aq_id, product_name, site, category, description])
+
+                                        invalid_state = schema.invalid_state(row, (aq_id, product_id, site_id, equipment_id, equipment_db_id, description, 1))
+                                        if current_invalid_state == invalid_state:
+                                            invalid_rows_unchanged += 1
+                                        elif current_invalid_state is not None:
+                                            data = schema.invalid_update_params(row, (aq_id, product_id, site_id, equipment_id, equipment_db_id, description, '1', now))
+                                            cursor.execute(schema.invalid_update_SQL, data)
+                                            if category == INVALID_PRODUCT_SITE:
+                                                invalid_prod_sites_rows_updated += cursor.rowcount
+                                            else:
                                                 invalid_kpr_rel_rows_updated += cursor.rowcount
-                                                conn.commit()
+                                            current_invalid[line_id] = invalid_state
+                                        else:
+                                            data = schema.invalid_insert_params(row, (aq_id, product_id, site_id, equipment_id, equipment_db_id, category, description, now))
+                                            cursor.execute(schema.invalid_insert_SQL, data)
+                                            if category == INVALID_PRODUCT_SITE:
+                                                invalid_prod_sites_rows_inserted += cursor.rowcount
                                             else:
-                                                #print('INSERT: ', current_pr)
-                                                data = (row['PURCHASE_REQUISITION_NBR'],
-                                                       row['PURCH_REQ_LINE_NBR'],
-                                                       aq_id,
-                                                       product_id,
-                                                       site_id,
-                                                       equipment_id,
-                                                       equipment_db_id,
-                                                       category,
-                                                       description,
-                                                       now)
-                                                cursor.execute(pr_invalid_product_site_aqid_INSERT_SQL, data)
                                                 invalid_kpr_rel_rows_inserted += cursor.rowcount
-                                                conn.commit()
+                                            current_invalid[line_id] = invalid_state
                                     else:
-                                        if current_pr in current_invalid_PR:
-                                            #print('TO DELETE: ', current_pr)
-                                            data = (now,
-                                                    0,
-                                                    row['PURCHASE_REQUISITION_NBR'],
-                                                    row['PURCH_REQ_LINE_NBR'])
-                                            cursor.execute(pr_invalid_product_site_aqid_DELETE_SQL, data)
+                                        if current_invalid_state is not None and current_invalid_state[-1] != '0':
+                                            data = schema.invalid_delete_params(row, (now, 0))
+                                            cursor.execute(schema.invalid_delete_SQL, data)
                                             valid_prod_sites_and_kpr_rel_deleted += cursor.rowcount
-                                            conn.commit()
-                            except Exception as sqlprerr:
+                                            current_invalid[line_id] = current_invalid_state[:-1] + ('0',)
+                            except Exception as sqlerr:
                                 # Write to the /status/.error and log files.
-                                erfile = open(pr_data_path + '/status/' + file_name + '.error', 'a')
-                                erfile.write('*PR SQL ERROR* Got error {!r}, errno is {}\n'.format(sqlprerr, sqlprerr.args[0]))
+                                commit_policy.rollback()
+                                erfile = open(data_path + '/status/' + file_name + '.error', 'a')
+                                erfile.write('*' + name + ' SQL ERROR* Got error {!r}, errno is {}\n'.format(sqlerr, sqlerr.args[0]))
 
-                                logging.critical('*PR SQL ERROR* Got error {!r}, errno is {}'.format(sqlprerr, sqlprerr.args[0]))
+                                logging.critical('*' + name + ' SQL ERROR* Got error {!r}, errno is {}'.format(sqlerr, sqlerr.args[0]))
                                 raise
                         else:
                             # AQ_ID
                             # logs AQ_ID that is not found in ghDS. Null/empty AQ_ID not print to log.
-                            if (row['AQ_ID']):
-                                logging.info('aq_id: ' + aq_id + ' (' + row['PURCHASE_REQUISITION_NBR'] + '-' + row['PURCH_REQ_LINE_NBR'] + ') not found. Unable to map.')
-                                aqid_not_found += aq_id + " (" + row['PURCHASE_REQUISITION_NBR'] + '-' + row['PURCH_REQ_LINE_NBR'] + ")\n"
+                            if (row_aqid):
+                                logging.info('aq_id: ' + aq_id + ' (' + nbr + '-' + str(line_nbr) + ') not found. Unable to map.')
+                                aqid_not_found.add(aq_id, nbr + '-' + str(line_nbr))
                             record_not_matched_flag = 1
                     else:
-                        # FUNCTIONAL_LOCATION_CODE
+                        # FUNCTIONAL_LOCATION(_CODE)
                         record_not_matched_flag = 1
                 else:
                     # SPEND_TYPE_DESCRIPTION
@@ -747,21 +597,46 @@ def processing_PR(conn, conn2, input_text_datafile, file_name):
                 # PROJECT_NBR
                 record_not_matched_flag = 1
 
+            # an unmapped row is never superseded (see DuplicateLineCollapser).
             if (record_not_matched_flag):
-                if pr_id in current_PR_IDs:
+                if line_id in current_IDs:
                     try:
-                        with conn.cursor() as cursor:
-                            data = ('C', now, 0, row['PURCHASE_REQUISITION_NBR'], row['PURCH_REQ_LINE_NBR'])
-                            cursor.execute(pr_status_UPDATE_SQL, data)
-                            rows_updated_with_rectype_c += cursor.rowcount
-                            conn.commit()
+                        data = schema.status_params(row, ('C', now, 0))
+                        writer.add(schema.status_UPDATE_SQL, data, line_id, 'rows_updated_with_rectype_c')
+                        consolidation_scope.add_keys(current_IDs[line_id])
+                        if current_hashes is not None:
+                            current_hashes.pop(line_id, None)
                     except Exception as sqlerr:
-                            # Write to the /status/.error and log files.
-                            erfile = open(pr_data_path + '/status/' + file_name + '.error', 'a')
-                            erfile.write('*pr_status_UPDATE_SQL ERROR* Got error {!r}, errno is {}\n'.format(sqlprerr, sqlprerr.args[0]))
-                            logging.critical('*pr_status_UPDATE_SQL ERROR* Got error {!r}, errno is {}'.format(sqlerr, sqlerr.args[0]))
-                            raise
+                        # Write to the /status/.error and log files.
+                        commit_policy.rollback()
+                        erfile = open(data_path + '/status/' + file_name + '.error', 'a')
+                        erfile.write('*' + name.lower() + '_status_UPDATE_SQL ERROR* Got error {!r}, errno is {}\n'.format(sqlerr, sqlerr.args[0]))
+                        logging.critical('*' + name.lower() + '_status_UPDATE_SQL ERROR* Got error {!r}, errno is {}'.format(sqlerr, sqlerr.args[0]))
+                        raise
+
+            commit_policy.row_done()
+
+        try:
+            writer.flush()
+            raw_writer.flush()
+            provenance.flush()
+        except Exception as sqlerr:
+            # Write to the /status/.error and log files.
+            commit_policy.rollback()
+            erfile = open(data_path + '/status/' + file_name + '.error', 'a')
+            erfile.write('*' + name + ' SQL ERROR* Got error {!r}, errno is {}\n'.format(sqlerr, sqlerr.args[0]))
+
+            logging.critical('*' + name + ' SQL ERROR* Got error {!r}, errno is {}'.format(sqlerr, sqlerr.args[0]))
+            raise
 
+        rows_inserted = writer.counts['rows_inserted']
+        rows_updated = writer.counts['rows_updated']
+        rows_deleted = writer.counts['rows_deleted']
+        rows_updated_with_rectype_c = writer.counts['rows_updated_with_rectype_c']
+        raw_rows_inserted = raw_writer.counts['raw_rows_inserted']
+        raw_rows_updated = raw_writer.counts['raw_rows_updated']
+        # malformed rows were read, and are counted as ignored.
+        total_no_recs += datafile_rows.num_malformed
 
         log['num_recs_loaded'] = total_no_recs
         log['num_new_recs_added'] = rows_inserted
@@ -769,27 +644,34 @@ def processing_PR(conn, conn2, input_text_datafile, file_name):
         log['num_recs_ignored'] = (total_no_recs - rows_inserted - recs_with_null_aqid)
 
         if sitecode_not_found:
-            logging.info("\nSAP Site Code not found in gh_sites:")
-            logging.info(sitecode_not_found)
+            logging.info("\n" + sitecode_not_found.render())
 
-        logging.info("(RAW) No of PR recs loaded: " + str(total_no_recs))
-        logging.info("(RAW) No of PR recs inserted: " + str(raw_rows_inserted))
-        logging.info("(RAW) No of PR recs updated: " + str(raw_rows_updated))
+        logging.info("(RAW) No of " + name + " recs loaded: " + str(total_no_recs))
+        logging.info("(RAW) No of " + name + " recs inserted: " + str(raw_rows_inserted))
+        logging.info("(RAW) No of " + name + " recs updated: " + str(raw_rows_updated))
+        logging.info("(RAW) No of " + name + " recs unchanged: " + str(raw_rows_unchanged))
+        logging.info("(RAW) No of " + name + " recs superseded by a later row of their line: " + str(raw_duplicate_lines.num_collapsed))
+        logging.info("(RAW) No of " + name + " recs recorded in gh_pr_po_file: " + str(provenance.num_recorded))
 
         logging.info("(INVALID sites for products) No of recs inserted: " + str(invalid_prod_sites_rows_inserted))
         logging.info("(INVALID sites for products) No of recs updated: " + str(invalid_prod_sites_rows_updated))
         logging.info("(INVALID AQID with no KPR Release) No of recs inserted: " + str(invalid_kpr_rel_rows_inserted))
         logging.info("(INVALID AQID with no KPR Release) No of recs updated: " + str(invalid_kpr_rel_rows_updated))
         logging.info("(VALID) No of recs deleted: " + str(valid_prod_sites_and_kpr_rel_deleted))
-
-        logging.info("No of PR recs loaded: " + str(total_no_recs))
-        logging.info("No of PR recs inserted: " + str(rows_inserted))
-        logging.info("No of PR recs updated: " + str(rows_updated))
-        logging.info("No of PR recs updated to Record Type C: " + str(rows_updated_with_rectype_c))
-        logging.info("No of PR recs deleted: " + str(rows_deleted))
-        logging.info("No of PR recs with empty aq_id: " + str(recs_with_null_aqid))
-        logging.info("No of PR recs ignored: " + str(total_no_recs - rows_inserted - recs_with_null_aqid))
-        logging.info('Ending script for PR at ' + datetime.now().strftime("%Y-%m-%d %X"))
+        logging.info("(INVALID) No of recs unchanged: " + str(invalid_rows_unchanged))
+
+        logging.info("No of " + name + " recs loaded: " + str(total_no_recs))
+        logging.info("No of " + name + " recs inserted: " + str(rows_inserted))
+        logging.info("No of " + name + " recs updated: " + str(rows_updated))
+        logging.info("No of " + name + " recs unchanged: " + str(rows_unchanged))
+        logging.info("No of " + name + " recs updated to Record Type C: " + str(rows_updated_with_rectype_c))
+        logging.info("No of " + name + " recs deleted: " + str(rows_deleted))
+        logging.info("No of " + name + " recs with empty aq_id: " + str(recs_with_null_aqid))
+        logging.info("No of " + name + " recs ignored: " + str(total_no_recs - rows_inserted - recs_with_null_aqid))
+        logging.info("No of malformed " + name + " recs skipped: " + str(datafile_rows.num_malformed))
+        logging.info("No of " + name + " recs skipped, committed by an earlier run: " + str(resume_row))
+        logging.info("No of " + name + " recs superseded by a later row of their line: " + str(duplicate_lines.num_collapsed))
+        logging.info('Ending script for ' + name + ' at ' + datetime.now().strftime("%Y-%m-%d %X"))
         logging.info('===================================================\n\n')
 
         ####################################################################################################
@@ -800,765 +682,49 @@ def processing_PR(conn, conn2, input_text_datafile, file_name):
         # 2. Warning: (1265, "Data truncated for column 'description' at row 1")
         #       Solution: Change text to mediumtext for Description. Only needed for full data load. Change back to text for incremental load.
         ####################################################################################################
-        description = "SAP Site Code not found in gh_sites:\n" + sitecode_not_found[:32000] + "\naq_id not found in gh_bom_equipment:\n" + aqid_not_found[:32000]
+        description = sitecode_not_found.render()[:32000] + "\n" + aqid_not_found.render()[:32000]
+        if malformed_rows:
+            description += "\n" + malformed_rows.render()[:32000]
+        if resume_row:
+            description += "\nResumed after row " + str(resume_row) + ", committed by an earlier run; the counts are for the rows after it."
         try:
             with conn.cursor() as cursor:
                 sql = "INSERT INTO gh_pr_po_file_process_log (loaded_date_time, file_name, file_saved_to, num_recs_loaded, num_new_recs_added, num_recs_ignored, num_recs_with_issues, description) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)"
                 data = (log['loaded_date_time'], log['file_name'], log['decrypted_data_loc'], log['num_recs_loaded'], log['num_new_recs_added'], log['num_recs_ignored'], log['num_recs_with_issues'], description)
                 cursor.execute(sql, data)
-                conn.commit()
-
-                if (cursor.rowcount):
-                    open(pr_data_path + '/status/' + file_name + '.processed', 'a').close()
-        except Exception as ex:
-            errmsg = "ERROR: %s while inserting into gh_pr_po_file_process_log in processing_PR()." % format(ex)
-            logging.critical(errmsg)
-            raise
-
-    except Exception as ex:
-        errmsg = "Exception occured: %s while running processing_PR(). Returning to main." % format(ex)
-        logging.critical(errmsg)
-        raise
-
-def processing_PO(conn, conn2, input_text_datafile, file_name):
-    log, products, sites, current_invalid_PO = {}, {}, {}, []
-    current_raw_PO_IDs, current_PO_IDs = [], []
-    sitecode_not_found = aqid_not_found = ""
-    total_no_recs = raw_rows_inserted = rows_inserted = rows_updated = raw_rows_updated = rows_deleted = rows_updated_with_rectype_c = recs_with_issues = recs_with_null_aqid = 0
-    invalid_prod_sites_rows_inserted = invalid_prod_sites_rows_updated = 0
-    invalid_kpr_rel_rows_inserted = invalid_kpr_rel_rows_updated  = 0
-    valid_prod_sites_and_kpr_rel_deleted = 0
-
-    logging.info('Begin processing PO at ' + datetime.now().strftime('%Y-%m-%d %X'))
-    log['loaded_date_time'] = datetime.now().strftime('%Y-%m-%d %X')
-
-    ####################################################################################################
-    # Mapping: Database columns <=> column header from text datafile.
-    # Validating column headers of gh_sap_po_line_item table with text datafile.
-    ####################################################################################################
-    db_col_mapping = {'po_nbr': 'PURCHASE_ORDER_NUMBER',
-                      'po_line_nbr': 'PURCH_ORDER_LINE_NBR',
-                      'material_description': 'MATERIAL_DESCRIPTION',
-                      'company_code': 'COMPANY_CODE',
-                      'tracking_no': 'TRACKING_NO',
-                      'po_quantity': 'PO_QUANTITY',
-                      'net_price': 'NET_PRICE',
-                      'net_value': 'NET_VALUE',
-                      'effective_value': 'EFFECTIVE_VALUE',
-                      'pr_nbr': 'EAPPROVAL_PR_NBR',
-                      'pr_line_nbr': 'EAPPROVAL_PR_LINE_NBR',
-                      'initiator': 'NAME_OF_INITIATOR',
-                      'vendor_name': 'VENDOR_NAME',
-                      'functional_location': 'FUNCTIONAL_LOCATION',
-                      'project_nbr': 'PROJECT_NBR',
-                      'aq_id': 'AQID',
-                      'po_status': 'PO_STATUS',
-                      'spend_type_code': 'SPEND_TYPE_CODE',
-                      'spend_type_description': 'SPEND_TYPE_DESC',
-                      'currency': 'CURRENCY',
-                      'order_unit': 'ORDER_UNIT',
-                      'order_price_unit': 'ORDER_PRICE_UNIT',
-                      'gr_quantity': 'GR_QUANTITY',
-                      'record_type': 'RECORD_TYPE',
-                      'po_date': 'PO_DATE',
-                      'po_item_deleted_flag': 'PO_ITEM_DELETED_FLAG' }
-
-    ####################################################################################################
-    # Opening and reading text datafile.
-    # Exception occured: invalid file: PosixPath('file.txt')
-    # Exception occured: must be str, not PosixPath. (cast filename to str())
-    logging.info('Opening datafile: /var/po/data/' + str(file_name))
-    log['file_name'] = po_data_path + '/data/' + str(file_name)
-    log['decrypted_data_loc'] = po_data_path + '/tmp/'
-    logging.info('Reading datafile.' + '\n')
-
-    ###########################################################
-    # Mapping column headers of text datafile
-    # strip() to remove all leading or trailing blank spaces before the fieldnames from the datafiles.
-    ###########################################################
-    headers = input_text_datafile.fieldnames
-    if not headers:
-        logging.error('Datafile is empty. Please check the datafile and try again.')
-        open(po_data_path + '/status/' + str(file_name) + '.processed', 'a').close()
-        return
-    else:
-        headers = [x.strip(' ') for x in headers]
-        for k,v in db_col_mapping.items():
-            if v not in headers:
-                logging.error(v + ' Headers do not match. Please check the datafile.')
-                sys.exit(1)
-
-    logging.info('Getting products from gh_product_codes...')
-    products = get_product_id(conn)
-
-    logging.info('Getting site_id from gh_sites...')
-    sites = get_site_id(conn)
-
-    logging.info('Getting valid products and sites...')
-    valid_product_sites = check_valid_product_and_site(conn)
-
-    logging.info('Getting AQ_ID with no KPR Release...')
-    invalid_aqid_kpr_release = check_invalid_aqid_with_kpr_release(conn)
-
-    ####################################################################################################
-    logging.info('(RAW) Getting current po_nbr, po_line_nbr from conveyor gh_sap_po_line_item...')
-    ####################################################################################################
-    try:
-        with conn2.cursor() as cursor:
-            sql = "SELECT concat(po_nbr, ':', po_line_nbr) as po_id FROM gh_sap_po_line_item"
-            cursor.execute(sql)
-            result = cursor.fetchall()
-
-            for row in result:
-                current_raw_PO_IDs.append(row['po_id'])
-    except Exception as err:
-        errmsg = "*(RAW) ERROR* %s while getting current records from conveyor gh_sap_po_line_item...", err
-        logging.critical(errmsg)
-        raise
-
-    ####################################################################################################
-    # Getting current PO ids from database.
-    logging.info('Getting po_nbr, po_line_nbr from gh_sap_po_line_item...')
-    ####################################################################################################
-    try:
-        with conn.cursor() as cursor:
-            sql = "SELECT concat(po_nbr, ':', po_line_nbr) as po_id FROM gh_sap_po_line_item"
-            cursor.execute(sql)
-            result = cursor.fetchall()
-
-            for row in result:
-                current_PO_IDs.append(row['po_id'])
-
-            ####################################################################################################
-            # Getting current rec from gh_po_invalid_data
-            logging.info('Getting current invalid recs from gh_po_invalid_data...')
-            ####################################################################################################
-            sql = "SELECT pr_nbr, pr_line_nbr, po_nbr, po_line_nbr, aq_id, gh_product_id, gh_site_id FROM gh_po_invalid_data"
-            cursor.execute(sql)
-            result = cursor.fetchall()
-    
-            for row in result:
-                current_invalid_PO.append({'po_nbr': row['po_nbr'],
-                                           'po_line_nbr': row['po_line_nbr']})
-
-	    ####################################################################################################
-	    # Defining sqls
-	    ####################################################################################################
-        new_po_INSERT_SQL = """
-            INSERT INTO gh_sap_po_line_item ( po_nbr, po_line_nbr, material_description, company_code, tracking_no, po_quantity, net_price, net_value, effective_value, pr_nbr, pr_line_nbr, initiator, vendor_name, functional_location, project_nbr, aq_id, po_status, spend_type_code, spend_type_description, currency, order_unit, order_price_unit, gr_quantity, record_type, po_date, po_item_deleted_flag, gh_product_id, gh_site_id, gh_equipment_id, gh_equipment_db_id, created, status_id)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"""
-
-        new_raw_po_INSERT_SQL = """
-            INSERT INTO gh_sap_po_line_item ( po_nbr, po_line_nbr, material_description, company_code, tracking_no, po_quantity, net_price, net_value, effective_value, pr_nbr, pr_line_nbr, initiator, vendor_name, functional_location, project_nbr, aq_id, po_status, spend_type_code, spend_type_description, currency, order_unit, order_price_unit, gr_quantity, record_type, po_date, po_item_deleted_flag, gh_product_id, gh_site_id, gh_equipment_id, gh_equipment_db_id, gh_product_name, gh_site, created, status_id)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"""
-
-        po_UPDATE_SQL = """
-            UPDATE gh_sap_po_line_item
-            SET
-                 material_description = %s,
-                 company_code = %s,
-                 tracking_no = %s,
-                 po_quantity = %s,
-                 net_price = %s,
-                 net_value = %s,
-                 effective_value = %s,
-                 pr_nbr = %s,
-                 pr_line_nbr = %s,
-                 initiator = %s,
-                 vendor_name = %s,
-                 functional_location = %s,
-                 project_nbr = %s,
-                 aq_id = %s,
-                 po_status = %s,
-                 spend_type_code = %s,
-                 spend_type_description = %s,
-                 currency = %s,
-                 order_unit = %s,
-                 order_price_unit = %s,
-                 gr_quantity = %s,
-                 record_type = %s,
-                 po_date = %s,
-                 po_item_deleted_flag = %s,
-                 gh_product_id = %s,
-                 gh_site_id = %s,
-                 gh_equipment_id = %s,
-                 gh_equipment_db_id = %s,
-                 updated = %s,
-                 status_id = %s
-              WHERE
-                 po_nbr = %s
-                 AND po_line_nbr = %s"""
-
-        po_raw_UPDATE_SQL = """
-            UPDATE gh_sap_po_line_item
-            SET
-                 material_description = %s,
-                 company_code = %s,
-                 tracking_no = %s,
-                 po_quantity = %s,
-                 net_price = %s,
-                 net_value = %s,
-                 effective_value = %s,
-                 pr_nbr = %s,
-                 pr_line_nbr = %s,
-                 initiator = %s,
-                 vendor_name = %s,
-                 functional_location = %s,
-                 project_nbr = %s,
-                 aq_id = %s,
-                 po_status = %s,
-                 spend_type_code = %s,
-                 spend_type_description = %s,
-                 currency = %s,
-                 order_unit = %s,
-                 order_price_unit = %s,
-                 gr_quantity = %s,
-                 record_type = %s,
-                 po_date = %s,
-                 po_item_deleted_flag = %s,
-                 gh_product_id = %s,
-                 gh_site_id = %s,
-                 gh_equipment_id = %s,
-                 gh_equipment_db_id = %s,
-                 gh_product_name = %s,
-                 gh_site = %s,
-                 updated = %s,
-                 status_id = %s
-              WHERE
-                 po_nbr = %s
-                 AND po_line_nbr = %s"""
-
-        filename_by_pr_po_rec = """
-            INSERT INTO gh_pr_po_file (po_nbr, po_line_nbr, pr_nbr, pr_line_nbr, file_name, created)
-            VALUES (%s, %s, %s, %s, %s, %s)"""
-
-        po_status_UPDATE_SQL = """
-             UPDATE gh_sap_po_line_item
-             SET
-                 record_type = %s, updated = %s, status_id = %s
-             WHERE 
-                 po_nbr = %s
-                 AND po_line_nbr = %s"""
-
-        po_invalid_product_site_aqid_INSERT_SQL = """
-            INSERT INTO gh_po_invalid_data (pr_nbr, pr_line_nbr, po_nbr, po_line_nbr, aq_id, gh_product_id, gh_site_id, gh_equipment_id, gh_equipment_db_id, category, description, updated)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"""
-
-        po_invalid_product_site_aqid_UPDATE_SQL = """
-            UPDATE gh_po_invalid_data
-            SET
-                pr_nbr = %s,
-                pr_line_nbr = %s,
-                aq_id = %s,
-                gh_product_id = %s,
-                gh_site_id = %s,
-                gh_equipment_id = %s,
-                gh_equipment_db_id = %s,
-                description = %s,
-                status_id = %s,
-                updated = %s
-            WHERE
-                po_nbr = %s
-                and po_line_nbr = %s"""
-
-        po_invalid_product_site_aqid_DELETE_SQL = """
-            UPDATE gh_po_invalid_data
-            SET
-                updated = %s, status_id = %s
-            WHERE
-                po_nbr = %s
-                and po_line_nbr = %s"""
-
-        ###########################################################
-        # Looping thru each record from the datafile
-        ###########################################################
-        now = datetime.now().strftime('%Y-%m-%d %X')
-        #now = datetime.now().strftime('%Y-%m-%d 00:00:00')
-        spend_type_desc = ['EQ','RETRO','AOU']
-
-        for row in input_text_datafile:
-            record_not_matched_flag = ''
-            total_no_recs += 1
-            po_id = row['PURCHASE_ORDER_NUMBER'] + ':' + row['PURCH_ORDER_LINE_NBR']
-
-            ###########################################################
-            product_id = product_name = None
-            gh_product = products.get(row['PROJECT_NBR'])
-            if gh_product:
-                product_id = gh_product['product_id']
-                product_name = gh_product['product_name']
-
-            ###########################################################
-            site_id = site = None
-            gh_site = sites.get(row['FUNCTIONAL_LOCATION'])
-            if gh_site:
-                site_id = gh_site['site_id']
-                site = gh_site.get('site')      # for populating gh_site in raw table and in email report.
-            else:
-                if (row['FUNCTIONAL_LOCATION'] == 'LOCN-TBD1'):
-                    site_id = 0
-                elif (row['FUNCTIONAL_LOCATION'] == ''):
-                    sitecode_not_found += row['FUNCTIONAL_LOCATION'] + " (" + row['PURCHASE_ORDER_NUMBER'] + '-' + row['PURCH_ORDER_LINE_NBR'] + ")\n"
-                else:
-                    sitecode_not_found += row['FUNCTIONAL_LOCATION'] + " (" + row['PURCHASE_ORDER_NUMBER'] + '-' + row['PURCH_ORDER_LINE_NBR'] + ")\n"
-
-            #print('(PO) FUNCTIONAL_LOCATION: ', row['FUNCTIONAL_LOCATION'], ' , site_id: ', site_id, ', site: ', site)
-
-            ###########################################################
-            equipment_id = equipment_db_id = None
-            if row['AQID']:
-                aq_id = (row['AQID'] + "-R") if (row['SPEND_TYPE_DESC'] == 'RETRO' and row['AQID'][-2:] != '-R') else row['AQID']
-
-                aqid_equipment = get_equipment(conn, parse_aqid(aq_id))
-                if (aqid_equipment):
-                    equipment_id = aqid_equipment[0]
-                    equipment_db_id = aqid_equipment[1]
-            else:
-                recs_with_null_aqid += 1
-
-            ####################################################################################################
-            # Storing RAW PO data in a separate database
-            ####################################################################################################
-            if conn2.open:
-                try:
-                    with conn2.cursor() as cursor:
-                        if ( (row['RECORD_TYPE'] == 'I') or (row['RECORD_TYPE'] == 'U') or (row['RECORD_TYPE'] == 'D') ):
-                            data = (row['PURCHASE_ORDER_NUMBER'], row['PURCH_ORDER_LINE_NBR'], row['EAPPROVAL_PR_NBR'], row['EAPPROVAL_PR_LINE_NBR'], file_name, now)
-                            cursor.execute(filename_by_pr_po_rec, data)
-                            conn2.commit()
-
-                            if po_id not in current_raw_PO_IDs:
-                                data = (row['PURCHASE_ORDER_NUMBER'],
-                                        row['PURCH_ORDER_LINE_NBR'],
-                                        row['MATERIAL_DESCRIPTION'],
-                                        row['COMPANY_CODE'],
-                                        row['TRACKING_NO'],
-                                        row['PO_QUANTITY'],
-                                        row['NET_PRICE'],
-                                        row['NET_VALUE'],
-                                        row['EFFECTIVE_VALUE'],
-                                        row['EAPPROVAL_PR_NBR'],
-                                        row['EAPPROVAL_PR_LINE_NBR'],
-                                        row['NAME_OF_INITIATOR'],
-                                        row['VENDOR_NAME'],
-                                        row['FUNCTIONAL_LOCATION'],
-                                        row['PROJECT_NBR'],
-                                        row['AQID'],
-                                        row['PO_STATUS'],
-                                        row['SPEND_TYPE_CODE'],
-                                        row['SPEND_TYPE_DESC'],
-                                        row['CURRENCY'],
-                                        row['ORDER_UNIT'],
-                                        row['ORDER_PRICE_UNIT'],
-                                        row['GR_QUANTITY'],
-                                        row['RECORD_TYPE'],
-                                        row['PO_DATE'],
-                                        row['PO_ITEM_DELETED_FLAG'],
-                                        product_id,
-                                        site_id,
-                                        equipment_id,
-                                        equipment_db_id,
-                                        product_name,
-                                        site,
-                                        now,
-                                        1)
-                                cursor.execute(new_raw_po_INSERT_SQL, data)
-                                raw_rows_inserted += cursor.rowcount
-                                conn2.commit()
-                            else:
-                                data = (row['MATERIAL_DESCRIPTION'],
-                                        row['COMPANY_CODE'],
-                                        row['TRACKING_NO'],
-                                        row['PO_QUANTITY'],
-                                        row['NET_PRICE'],
-                                        row['NET_VALUE'],
-                                        row['EFFECTIVE_VALUE'],
-                                        row['EAPPROVAL_PR_NBR'],
-                                        row['EAPPROVAL_PR_LINE_NBR'],
-                                        row['NAME_OF_INITIATOR'],
-                                        row['VENDOR_NAME'],
-                                        row['FUNCTIONAL_LOCATION'],
-                                        row['PROJECT_NBR'],
-                                        row['AQID'],
-                                        row['PO_STATUS'],
-                                        row['SPEND_TYPE_CODE'],
-                                        row['SPEND_TYPE_DESC'],
-                                        row['CURRENCY'],
-                                        row['ORDER_UNIT'],
-                                        row['ORDER_PRICE_UNIT'],
-                                        row['GR_QUANTITY'],
-                                        row['RECORD_TYPE'],
-                                        row['PO_DATE'],
-                                        row['PO_ITEM_DELETED_FLAG'],
-                                        product_id,
-                                        site_id,
-                                        equipment_id,
-                                        equipment_db_id,
-                                        product_name,
-                                        site,
-                                        now,
-                                        1,
-                                        row['PURCHASE_ORDER_NUMBER'],
-                                        row['PURCH_ORDER_LINE_NBR'])
-                                cursor.execute(po_raw_UPDATE_SQL, data)
-                                raw_rows_updated += cursor.rowcount
-                                conn2.commit()
-                except Exception as err:
-                    logging.critical('*ERROR* while inserting or updating raw PO data to conveyor database. ', err)
-                    raise
-            else:
-                conn2.ping(reconnect=True)
-
-            ####################################################################################################
-            # Main Logic
-            ####################################################################################################
-            if product_id:
-                if row['SPEND_TYPE_DESC'] in spend_type_desc:
-                    if site_id != None:
-                        if (equipment_id and equipment_db_id):
-                            try:
-                                with conn.cursor() as cursor:
-                                    if (row['RECORD_TYPE'] == 'I') or (row['RECORD_TYPE'] == 'U'):
-                                        if po_id not in current_PO_IDs:
-                                            data = (row['PURCHASE_ORDER_NUMBER'],
-                                                    row['PURCH_ORDER_LINE_NBR'],
-                                                    row['MATERIAL_DESCRIPTION'],
-                                                    row['COMPANY_CODE'],
-                                                    row['TRACKING_NO'],
-                                                    row['PO_QUANTITY'],
-                                                    row['NET_PRICE'],
-                                                    row['NET_VALUE'],
-                                                    row['EFFECTIVE_VALUE'],
-                                                    row['EAPPROVAL_PR_NBR'],
-                                                    row['EAPPROVAL_PR_LINE_NBR'],
-                                                    row['NAME_OF_INITIATOR'],
-                                                    row['VENDOR_NAME'],
-                                                    row['FUNCTIONAL_LOCATION'],
-                                                    row['PROJECT_NBR'],
-                                                    row['AQID'],
-                                                    row['PO_STATUS'],
-                                                    row['SPEND_TYPE_CODE'],
-                                                    row['SPEND_TYPE_DESC'],
-                                                    row['CURRENCY'],
-                                                    row['ORDER_UNIT'],
-                                                    row['ORDER_PRICE_UNIT'],
-                                                    row['GR_QUANTITY'],
-                                                    row['RECORD_TYPE'],
-                                                    row['PO_DATE'],
-                                                    row['PO_ITEM_DELETED_FLAG'],
-                                                    product_id,
-                                                    site_id,
-                                                    equipment_id,
-                                                    equipment_db_id,
-                                                    now,
-                                                    1)
-                                            cursor.execute(new_po_INSERT_SQL, data)
-                                            rows_inserted += cursor.rowcount
-                                            conn.commit()
-                                        else:
-                                            ####################################################################################################
-                                            #logger.info('Updating PO rec: ' + row['PURCHASE_ORDER_NUMBER'] + '-' + row['PURCH_ORDER_LINE_NBR'])
-                                            # UPDATE records from table.
-                                            ####################################################################################################
-                                            data = (row['MATERIAL_DESCRIPTION'],
-                                                    row['COMPANY_CODE'],
-                                                    row['TRACKING_NO'],
-                                                    row['PO_QUANTITY'],
-                                                    row['NET_PRICE'],
-                                                    row['NET_VALUE'],
-                                                    row['EFFECTIVE_VALUE'],
-                                                    row['EAPPROVAL_PR_NBR'],
-                                                    row['EAPPROVAL_PR_LINE_NBR'],
-                                                    row['NAME_OF_INITIATOR'],
-                                                    row['VENDOR_NAME'],
-                                                    row['FUNCTIONAL_LOCATION'],
-                                                    row['PROJECT_NBR'],
-                                                    row['AQID'],
-                                                    row['PO_STATUS'],
-                                                    row['SPEND_TYPE_CODE'],
-                                                    row['SPEND_TYPE_DESC'],
-                                                    row['CURRENCY'],
-                                                    row['ORDER_UNIT'],
-                                                    row['ORDER_PRICE_UNIT'],
-                                                    row['GR_QUANTITY'],
-                                                    row['RECORD_TYPE'],
-                                                    row['PO_DATE'],
-                                                    row['PO_ITEM_DELETED_FLAG'],
-                                                    product_id,
-                                                    site_id,
-                                                    equipment_id,
-                                                    equipment_db_id,
-                                                    now,
-                                                    1,
-                                                    row['PURCHASE_ORDER_NUMBER'],
-                                                    row['PURCH_ORDER_LINE_NBR'])
-                                            cursor.execute(po_UPDATE_SQL, data)
-                                            rows_updated += cursor.rowcount
-                                            conn.commit()
-                                    elif (row['RECORD_TYPE'] == 'D'):
-                                        if po_id in current_PO_IDs:
-                                            data = (row['RECORD_TYPE'], now, 0, row['PURCHASE_ORDER_NUMBER'], row['PURCH_ORDER_LINE_NBR'])
-                                            cursor.execute(po_status_UPDATE_SQL, data)
-                                            rows_deleted += cursor.rowcount
-                                            conn.commit()
-                                        else:
-                                            data = (row['PURCHASE_ORDER_NUMBER'],
-                                                    row['PURCH_ORDER_LINE_NBR'],
-                                                    row['MATERIAL_DESCRIPTION'],
-                                                    row['COMPANY_CODE'],
-                                                    row['TRACKING_NO'],
-                                                    row['PO_QUANTITY'],
-                                                    row['NET_PRICE'],
-                                                    row['NET_VALUE'],
-                                                    row['EFFECTIVE_VALUE'],
-                                                    row['EAPPROVAL_PR_NBR'],
-                                                    row['EAPPROVAL_PR_LINE_NBR'],
-                                                    row['NAME_OF_INITIATOR'],
-                                                    row['VENDOR_NAME'],
-                                                    row['FUNCTIONAL_LOCATION'],
-                                                    row['PROJECT_NBR'],
-                                                    row['AQID'],
-                                                    row['PO_STATUS'],
-                                                    row['SPEND_TYPE_CODE'],
-                                                    row['SPEND_TYPE_DESC'],
-                                                    row['CURRENCY'],
-                                                    row['ORDER_UNIT'],
-                                                    row['ORDER_PRICE_UNIT'],
-                                                    row['GR_QUANTITY'],
-                                                    row['RECORD_TYPE'],
-                                                    row['PO_DATE'],
-                                                    row['PO_ITEM_DELETED_FLAG'],
-                                                    product_id,
-                                                    site_id,
-                                                    equipment_id,
-                                                    equipment_db_id,
-                                                    now,
-                                                    0)
-                                            cursor.execute(new_po_INSERT_SQL, data)
-                                            rows_deleted += cursor.rowcount
-                                            conn.commit()
-
-                                    ####################################################################
-                                    # BEGIN checking for invalid records
-                                    ####################################################################
-                                    product_sites = {'product_id': product_id,
-                                                     'site_id': site_id}
-
-                                    aqid_kpr_release = {'product_id': product_id,
-                                                        'site_id': site_id,
-                                                        'equipment_id': equipment_id,
-                                                        'equipment_db_id': equipment_db_id}
-
-                                    # cast current_po.pr_line_nbr to integer because current_invalid_PR.pr_line_nbr is integer.
-                                    current_po = {'po_nbr': row['PURCHASE_ORDER_NUMBER'],
-                                                  'po_line_nbr': int(row['PURCH_ORDER_LINE_NBR'])}
-
-                                    ####################################################################
-                                    # Is Functional Location a valid site for a given product?
-                                    # if not valid, then mark as invalid product site.
-                                    ####################################################################
-                                    if product_sites not in valid_product_sites:
-                                        category = 'Invalid product and site'
-                                        description = row['PROJECT_NBR'] + " and " + row['FUNCTIONAL_LOCATION'] + " are not valid MP site in ghDS."
-                                        send_email_invalid_po_recs.append([
-                                            row['EAPPROVAL_PR_NBR'],
-                                            row['EAPPROVAL_PR_LINE_NBR'],
-                                            row['PURCHASE_ORDER_NUMBER'],
-                                            row['PURCH_ORDER_LINE_NBR'],
-                                            aq_id,
-                                            product_name,
-                                            site,
-                                            category,
-                                            description])
-                                        if current_po in current_invalid_PO:
-                                            #print('UPDATE: ', current_po)
-                                            data = (row['EAPPROVAL_PR_NBR'],
-                                                    row['EAPPROVAL_PR_LINE_NBR'],
-                                                    aq_id,
-                                                    product_id,
-                                                    site_id,
-                                                    equipment_id,
-                                                    equipment_db_id,
-                                                    description,
-                                                    '1',
-                                                    now,
-                                                    row['PURCHASE_ORDER_NUMBER'],
-                                                    row['PURCH_ORDER_LINE_NBR'])
-                                            cursor.execute(po_invalid_product_site_aqid_UPDATE_SQL, data)
-                                            invalid_prod_sites_rows_updated += cursor.rowcount
-                                            conn.commit()
-                                        else:
-                                            #print('INSERT: ', current_po)
-                                            data = (row['EAPPROVAL_PR_NBR'],
-                                                    row['EAPPROVAL_PR_LINE_NBR'],
-                                                    row['PURCHASE_ORDER_NUMBER'],
-                                                    row['PURCH_ORDER_LINE_NBR'],
-                                                    aq_id,
-                                                    product_id,
-                                                    site_id,
-                                                    equipment_id,
-                                                    equipment_db_id,
-                                                    category,
-                                                    description,
-                                                    now)
-                                            cursor.execute(po_invalid_product_site_aqid_INSERT_SQL, data)
-                                            invalid_prod_sites_rows_inserted += cursor.rowcount
-                                            conn.commit()
-                                    elif aqid_kpr_release in invalid_aqid_kpr_release:
-                                        ####################################################################
-                                        # Does AQID have KPR release? AQID has KPR release if (qty > 0)
-                                        ####################################################################
-                                            category = 'No KPR release for AQ_ID'
-                                            description = 'No KPR release for: ' + str(aq_id)
-                                            send_email_invalid_po_recs.append([
-                                                row['EAPPROVAL_PR_NBR'],
-                                                row['EAPPROVAL_PR_LINE_NBR'],
-                                                row['PURCHASE_ORDER_NUMBER'],
-                                                row['PURCH_ORDER_LINE_NBR'],
-                                                aq_id,
-                                                product_name,
-                                                site,
-                                                category,
-                                                description])
-                                            if current_po in current_invalid_PO:
-                                                #print('UPDATE: ', current_po)
-                                                data = (row['EAPPROVAL_PR_NBR'],
-                                                        row['EAPPROVAL_PR_LINE_NBR'],
-                                                        aq_id,
-                                                        product_id,
-                                                        site_id,
-                                                        equipment_id,
-                                                        equipment_db_id,
-                                                        description,
-                                                        '1',
-                                                        now,
-                                                        row['PURCHASE_ORDER_NUMBER'],
-                                                        row['PURCH_ORDER_LINE_NBR'])
-                                                cursor.execute(po_invalid_product_site_aqid_UPDATE_SQL, data)
-                                                invalid_kpr_rel_rows_updated += cursor.rowcount
-                                                conn.commit()
-                                            else:
-                                                #print('INSERT: ', current_po)
-                                                data = (row['EAPPROVAL_PR_NBR'],
-                                                       row['EAPPROVAL_PR_LINE_NBR'],
-                                                       row['PURCHASE_ORDER_NUMBER'],
-                                                       row['PURCH_ORDER_LINE_NBR'],
-                                                       aq_id,
-                                                       product_id,
-                                                       site_id,
-                                                       equipment_id,
-                                                       equipment_db_id,
-                                                       category,
-                                                       description,
-                                                       now)
-                                                cursor.execute(po_invalid_product_site_aqid_INSERT_SQL, data)
-                                                invalid_kpr_rel_rows_inserted += cursor.rowcount
-                                                conn.commit()
-                                    else:
-                                        if current_po in current_invalid_PO:
-                                            #print('TO DELETE: ', current_po)
-                                            data = (now,
-                                                    0,
-                                                    row['PURCHASE_ORDER_NUMBER'],
-                                                    row['PURCH_ORDER_LINE_NBR'])
-                                            cursor.execute(po_invalid_product_site_aqid_DELETE_SQL, data)
-                                            valid_prod_sites_and_kpr_rel_deleted += cursor.rowcount
-                                            conn.commit()
-
-                            except Exception as sqlpoerr:
-                                # Write to the .error file
-                                erfile = open(po_data_path + '/status/' + file_name + '.error', 'a')
-                                erfile.write('*PO SQL ERROR* Got error {!r}, errno is {}\n'.format(sqlpoerr, sqlpoerr.args[0]))
-
-                                # prints to the log file
-                                logging.critical('*PO SQL ERROR* Got error {!r}, errno is {}'.format(sqlpoerr, sqlpoerr.args[0]))
-                                raise
-                        else:
-                            # AQID
-                            # logs AQID that is not found in ghDS. Null/empty AQID not print to log.
-                            if (row['AQID']):
-                                logging.info('aq_id: ' + aq_id + ' (' + row['PURCHASE_ORDER_NUMBER'] + '-' + row['PURCH_ORDER_LINE_NBR'] + ') not found. Unable to map.')
-                                aqid_not_found += aq_id + " (" + row['PURCHASE_ORDER_NUMBER'] + '-' + row['PURCH_ORDER_LINE_NBR'] + ")\n"
-                            record_not_matched_flag = 1
-                    else:
-                        # FUNCTIONAL_LOCATION
-                        record_not_matched_flag = 1
-                else:
-                    # SPEND_TYPE_DESCRIPTION
-                    record_not_matched_flag = 1
-            else:
-                # PROJECT_NBR
-                record_not_matched_flag = 1
-
-            if (record_not_matched_flag):
-                if po_id in current_PO_IDs:
-                    try:
-                        with conn.cursor() as cursor:
-                            data = ('C', now, 0, row['PURCHASE_ORDER_NUMBER'], row['PURCH_ORDER_LINE_NBR'])
-                            cursor.execute(po_status_UPDATE_SQL, data)
-                            rows_updated_with_rectype_c += cursor.rowcount
-                            conn.commit()
-                    except Exception as sqlerr:
-                            # Write to the /status/.error and log files.
-                            erfile = open(po_data_path + '/status/' + file_name + '.error', 'a')
-                            erfile.write('*po_status_UPDATE_SQL ERROR* Got error {!r}, errno is {}\n'.format(sqlprerr, sqlprerr.args[0]))
-
-                            logging.critical('*po_status_UPDATE_SQL ERROR* Got error {!r}, errno is {}'.format(sqlerr, sqlerr.args[0]))
-                            raise
-
-        log['num_recs_loaded'] = total_no_recs
-        log['num_new_recs_added'] = rows_inserted
-        log['num_recs_with_issues'] = recs_with_issues
-        log['num_recs_ignored'] = (total_no_recs - rows_inserted - recs_with_issues)
-
-        if sitecode_not_found:
-            logging.info("\nSAP Site Code not found in gh_sites:")
-            logging.info(sitecode_not_found)
-    
-        logging.info("(RAW) No of PO recs loaded: " + str(total_no_recs))
-        logging.info("(RAW) No of PO recs inserted: " + str(raw_rows_inserted))
-        logging.info("(RAW) No of PO recs updated: " + str(raw_rows_updated))
-
-        logging.info("(INVALID sites for products) No of recs inserted: " + str(invalid_prod_sites_rows_inserted))
-        logging.info("(INVALID sites for products) No of recs updated: " + str(invalid_prod_sites_rows_updated))
-        logging.info("(INVALID AQID with no KPR Release) No of recs inserted: " + str(invalid_kpr_rel_rows_inserted))
-        logging.info("(INVALID AQID with no KPR Release) No of recs updated: " + str(invalid_kpr_rel_rows_updated))
-        logging.info("(VALID) No of recs deleted: " + str(valid_prod_sites_and_kpr_rel_deleted))
-
-        logging.info("No of PO recs loaded: " + str(total_no_recs))
-        logging.info("No of PO recs inserted: " + str(rows_inserted))
-        logging.info("No of PO recs updated: " + str(rows_updated))
-        logging.info("No of PR recs updated to Record Type C: " + str(rows_updated_with_rectype_c))
-        logging.info("No of PO recs deleted: " + str(rows_deleted))
-        logging.info("No of PO recs with issues: " + str(recs_with_issues))
-        logging.info("No of PO recs ignored: " + str(total_no_recs - rows_inserted - recs_with_issues))
-        logging.info('Ending script for PO at ' + datetime.now().strftime('%Y-%m-%d %X'))
-        logging.info('===================================================\n\n')
+                log_rowcount = cursor.rowcount
 
-        ####################################################################################################
-        # Log status to database.
-        ####################################################################################################
-        description = "SAP Site Code not found in gh_sites:\n" + sitecode_not_found[:32000] + "\naq_id not found in gh_bom_equipment:\n" + aqid_not_found[:32000]
-        try:
-            with conn.cursor() as cursor:
-                sql = "INSERT INTO gh_pr_po_file_process_log (loaded_date_time, file_name, file_saved_to, num_recs_loaded, num_new_recs_added, num_recs_ignored, num_recs_with_issues, description) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)"
-                data = (log['loaded_date_time'], str(log['file_name']), log['decrypted_data_loc'], log['num_recs_loaded'], log['num_new_recs_added'], log['num_recs_ignored'], log['num_recs_with_issues'], description)
-                cursor.execute(sql, data)
-                conn.commit()
+            # the whole file (rows, conveyor rows, process log) is committed before the status marker is written.
+            commit_policy.commit()
 
-                if (cursor.rowcount):
-                    open(po_data_path + '/status/' + file_name + '.processed', 'a').close()
+            if (log_rowcount):
+                open(data_path + '/status/' + file_name + '.processed', 'a').close()
         except Exception as ex:
-            errmsg = "ERROR: %s while inserting into gh_pr_po_file_process_log in processing_PO()." % format(ex)
+            commit_policy.rollback()
+            errmsg = "ERROR: %s while inserting into gh_pr_po_file_process_log in processing_line_items() for %s." % (format(ex), name)
             logging.critical(errmsg)
             raise
 
+        return total_no_recs
+
     except Exception as ex:
-        errmsg = "Exception occured: %s while running processing_PO(). Returning to main." % format(ex)
+        conn.rollback()
+        if conn2 is not None:
+            conn2.rollback()
+        errmsg = "Exception occured: %s while running processing_line_items() for %s. Returning to main." % (format(ex), name)
         logging.critical(errmsg)
         raise
+    finally:
+        # whatever the error, the part of the file not committed to park is not left in a journal .tmp segment.
+        if journal_writer is not None:
+            journal_writer.discard()
 
-def processing_prpo_consolidation(conn):
+####################################################################################################
+# Recomputes gh_pr_po_equipment_summary. Without consolidation_scope every active product is
+# consolidated; with one, only the products of the keys touched by processing_line_items()
+# (a summary row only depends on PR/PO lines of its own product).
+####################################################################################################
+def processing_prpo_consolidation(conn, consolidation_scope=None):
     prs, pos = [], []
 
     ####################################################################################################
@@ -1579,6 +745,20 @@ def processing_prpo_consolidation(conn):
     now_utc = datetime.now(timezone('UTC'))                 # print(now_utc.strftime(fmt))
     now_pst = now_utc.astimezone(timezone('US/Pacific'))    # print(now_pst.strftime(fmt))
     #logging.info('UTC now: ' + now_utc.strftime(fmt))
+
+    pr_scope_SQL = po_scope_SQL = ''
+    scope_args = (now_utc,)
+    if consolidation_scope is not None:
+        consolidation_scope.resolve(conn)
+        product_ids = consolidation_scope.product_ids()
+        if not product_ids:
+            logging.info('No equipment summary keys touched. Consolidation skipped.')
+            return
+
+        logging.info('Consolidating ' + str(len(consolidation_scope.keys)) + ' touched key(s) in ' + str(len(product_ids)) + ' product(s).')
+        pr_scope_SQL = "\n                AND pr.gh_product_id in %s"
+        po_scope_SQL = "\n                 AND po.gh_product_id in %s"
+        scope_args = (now_utc, product_ids)
     
     pr_active_SELECT_SQL = """
             SELECT pr_nbr, pr_line_nbr, quantity, gh_product_id, gh_site_id, gh_equipment_id, gh_equipment_db_id
@@ -1588,9 +768,9 @@ def processing_prpo_consolidation(conn):
                 pr.pr_status_desc not in ('Cancelled', 'Rejected', 'New Requisition (Initiator)')
                 AND pr.status_id = 1
                 AND au.end_date >= %s
-                AND au.status_id = 1
+                AND au.status_id = 1{pr_scope}
             ORDER BY
-                gh_product_id, gh_site_id, gh_equipment_id, gh_equipment_db_id"""
+                gh_product_id, gh_site_id, gh_equipment_id, gh_equipment_db_id""".format(pr_scope=pr_scope_SQL)
     
     pr_in_po_SELECT_SQL = """
             SELECT pr_nbr, pr_line_nbr
@@ -1598,6 +778,20 @@ def processing_prpo_consolidation(conn):
             WHERE
                  pr_nbr = %s"""
     
+    ####################################################################################################
+    # Same PRs as pr_active_SELECT_SQL, minus every PR that pr_in_po_SELECT_SQL would find in PO.
+    ####################################################################################################
+    pr_not_in_po_SELECT_SQL = """
+            SELECT gh_product_id, gh_site_id, gh_equipment_id, gh_equipment_db_id, quantity
+            FROM
+                gh_eapproval_pr_line_item pr INNER JOIN gh_product_prpo_automation au ON (pr.gh_product_id = au.product_id)
+            WHERE
+                pr.pr_status_desc not in ('Cancelled', 'Rejected', 'New Requisition (Initiator)')
+                AND pr.status_id = 1
+                AND au.end_date >= %s
+                AND au.status_id = 1
+                AND NOT EXISTS (SELECT 1 FROM gh_sap_po_line_item po WHERE po.pr_nbr = pr.pr_nbr){pr_scope}""".format(pr_scope=pr_scope_SQL)
+    
     po_active_SELECT_SQL = """
             SELECT gh_product_id as product_id, gh_site_id as site_id, gh_equipment_id as equip_id, gh_equipment_db_id as equip_db_id, CAST(sum(po_quantity) as SIGNED) po_qty
             FROM
@@ -1605,51 +799,54 @@ def processing_prpo_consolidation(conn):
             WHERE
                  po.status_id = 1
                  AND au.end_date >= %s 
-                 AND au.status_id = 1
-            GROUP BY gh_product_id, gh_site_id, gh_equipment_id, gh_equipment_db_id"""
-    
-    prpo_in_equip_summary_SELECT_SQL = """
-            SELECT *
-            FROM gh_pr_po_equipment_summary
-            WHERE
-                 product_id = %s
-                 AND site_id = %s
-                 AND equipment_id = %s
-                 AND equipment_db_id = %s"""
-    
-    insert_new_prpo_to_equip_summary_INSERT_SQL = """
-            INSERT INTO gh_pr_po_equipment_summary (product_id, site_id, equipment_id, equipment_db_id, pr_new_requisition_qty, po_valid_qty, created)
-            VALUES (%s, %s, %s, %s, %s, %s, %s)"""
-    
-    update_equip_summary_UPDATE_SQL = """
-            UPDATE gh_pr_po_equipment_summary
-            SET pr_new_requisition_qty = %s, po_valid_qty = %s, updated = %s
-            WHERE
-                 product_id = %s and site_id = %s and equipment_id = %s and equipment_db_id = %s"""
+                 AND au.status_id = 1{po_scope}
+            GROUP BY gh_product_id, gh_site_id, gh_equipment_id, gh_equipment_db_id""".format(po_scope=po_scope_SQL)
     
     try:
         with conn.cursor() as cursor:
-            ####################################################################################################
-            # Getting active PR data.
-            ####################################################################################################
-            #logger.info('Getting active PR data...')
-            cursor.execute(pr_active_SELECT_SQL, now_utc)
-            result = cursor.fetchall()
-    
-            for row in result:
+            if consolidation_engine in ('legacy', 'verify'):
                 ####################################################################################################
-                # Checks if PR rec is in PO, if PR is NOT in PO, sum PR's qty.
+                # Getting active PR data.
                 ####################################################################################################
-                #data = (row['pr_nbr'], row['pr_line_nbr'])
-                data = (row['pr_nbr'])
-                cursor.execute(pr_in_po_SELECT_SQL, data)
-                result = cursor.fetchone()
+                #logger.info('Getting active PR data...')
+                cursor.execute(pr_active_SELECT_SQL, scope_args)
+                result = cursor.fetchall()
+                pr_quantities = []
+    
+                for row in result:
+                    ####################################################################################################
+                    # Checks if PR rec is in PO, if PR is NOT in PO, sum PR's qty.
+                    ####################################################################################################
+                    #data = (row['pr_nbr'], row['pr_line_nbr'])
+                    data = (row['pr_nbr'])
+                    cursor.execute(pr_in_po_SELECT_SQL, data)
+                    result = cursor.fetchone()
     
-                if (cursor.rowcount == 0):
-                    prs.append({'product_id':row['gh_product_id'], 'site_id':row['gh_site_id'], 'equip_id':row['gh_equipment_id'], 'equip_db_id':row['gh_equipment_db_id'], 'pr_qty':int(row['quantity'])})
+                    if (cursor.rowcount == 0):
+                        pr_quantities.append((row['gh_product_id'], row['gh_site_id'], row['gh_equipment_id'], row['gh_equipment_db_id'], row['quantity']))
     
-            prs = [list(b) for _, b in itertools.groupby(prs, key=lambda x:[x['product_id'], x['site_id'], x['equip_id'], x['equip_db_id']])]
-            prs = [prs_sum_qty(i) for i in prs]
+                # summed per equipment in one pass; does not depend on the ORDER BY of pr_active_SELECT_SQL.
+                prs = QuantityAggregator('pr_qty').consume(pr_quantities).records()
+
+            if consolidation_engine in ('set', 'verify'):
+                ####################################################################################################
+                # Getting active PR data that is not in PO with one query, then summing PR's qty per equipment.
+                ####################################################################################################
+                # unbuffered cursor: rows are summed as they arrive, memory is bounded by the number of equipments.
+                with conn.cursor(pymysql.cursors.SSCursor) as sscursor:
+                    sscursor.execute(pr_not_in_po_SELECT_SQL, scope_args)
+                    set_prs = QuantityAggregator('pr_qty').consume(sscursor).records()
+
+                if consolidation_engine == 'set':
+                    prs = set_prs
+                else:
+                    mismatches = compare_pr_qty(prs, set_prs)
+                    if mismatches:
+                        logging.error('*ERROR* Consolidation engines disagree on ' + str(len(mismatches)) + ' equipment(s). Keeping legacy result.')
+                        for key, legacy_qty, set_qty in mismatches[:20]:
+                            logging.error('(product_id, site_id, equip_id, equip_db_id): ' + str(key) + ', legacy pr_qty: ' + str(legacy_qty) + ', set pr_qty: ' + str(set_qty))
+                    else:
+                        logging.info('Consolidation engines agree on ' + str(len(prs)) + ' PR equipment summaries.')
 
             #logging.info('PR data:')
             #for rec in prs:
@@ -1660,7 +857,7 @@ def processing_prpo_consolidation(conn):
             # To prevent po_qty to return as, Decimal('####'), we need to cast it in the sql query: CAST(sum(po_quantity) as SIGNED) po_qty
             ##############################################################################################################################################
             #logger.info('Getting active PO data...')
-            cursor.execute(po_active_SELECT_SQL, now_utc)
+            cursor.execute(po_active_SELECT_SQL, scope_args)
             result = cursor.fetchall()
     
             pos = result
@@ -1693,36 +890,23 @@ def processing_prpo_consolidation(conn):
                 #logger.info("(product_id: " + str(row['product_id']) + ", site_id: " + str(row['site_id']) + ", equip_id: " + str(row['equip_id']) + ", equip_db_id: " + str(row['equip_db_id']) + ", pr_qty: " +  str(row['pr_qty']) + ", po_qty: " + str(row['po_qty']) + ")")
     
             ####################################################################################################
-            # Check if gh_product_id, gh_site_id, gh_equipment_id, gh_equipment_db_id are in gh_pr_po_equipment_summary
+            # Insert new records into gh_pr_po_equipment_summary and update the ones whose quantities changed.
             ####################################################################################################
             now = datetime.now().strftime('%Y-%m-%d 00:00:00')
-            rows_inserted = rows_updated = 0
-    
-            for row in prpo:
-                data = (row['product_id'], row['site_id'], row['equip_id'], row['equip_db_id'])
-                cursor.execute(prpo_in_equip_summary_SELECT_SQL, data)
-                result = cursor.fetchone()
-    
-                ####################################################################################################
-                # Insert new record into gh_pr_po_equipment_summary for new record or Update existing records.
-                ####################################################################################################
-                if not result:
-                    data = (row['product_id'], row['site_id'], row['equip_id'], row['equip_db_id'], row['pr_qty'], row['po_qty'], now)
-                    cursor.execute(insert_new_prpo_to_equip_summary_INSERT_SQL, data)
-                    rows_inserted += cursor.rowcount
-                    #logger.info("Rows Inserted: {}" . format(rows_inserted))
-                    conn.commit()
-                else:
-                    data = (row['pr_qty'], row['po_qty'], now, row['product_id'], row['site_id'], row['equip_id'], row['equip_db_id'])
-                    cursor.execute(update_equip_summary_UPDATE_SQL, data)
-                    rows_updated += cursor.rowcount
-                    #logger.info("Rows Updated: {}" . format(rows_updated))
-                    conn.commit()
-    
+            summary_sync = EquipmentSummarySync(conn, batch_size)
+            summary_sync.sync(prpo, now)
+
+            logging.info('(SUMMARY) No of recs inserted: ' + str(summary_sync.rows_inserted))
+            logging.info('(SUMMARY) No of recs updated: ' + str(summary_sync.rows_updated))
+            logging.info('(SUMMARY) No of recs unchanged: ' + str(summary_sync.rows_unchanged))
+
+        conn.commit()
+
         logging.info('Consolidation ended at ' + datetime.now().strftime('%Y-%m-%d %X'))
         logging.info('===================================================\n\n')
     
     except Exception as ex:
+        conn.rollback()
         errmsg = "Consolidation Error. Exception occured: %s. Returning to main." % format(ex)
         logging.critical(errmsg)
         raise
@@ -1770,55 +954,70 @@ def get_site_id(conn):
         raise
 
 ####################################################################################################
-# split aq_id
+# Existing PR/PO line item keys, as line_item_key() tuples.
+# With content_hashes (a dict), the content_hash of every line is read into it by the same query.
 ####################################################################################################
-def parse_aqid(aq_id):
-    items = aq_id.split('-')
-    a_equipment_id = items[0]
-    a_equipment_version = items[1]
-    if len(items) == 3:
-        a_equipment_type = items[2]
-    elif len(items) == 2:
-        a_equipment_type = ''
-
-    return a_equipment_id, a_equipment_version, a_equipment_type
+def get_line_item_keys(conn, table, nbr_col, line_nbr_col, content_hashes=None):
+    line_item_keys = set()
+    line_item_keys_SELECT_SQL = "SELECT " + nbr_col + ", " + line_nbr_col + (", content_hash" if content_hashes is not None else ", NULL") + " FROM " + table
+    try:
+        # unbuffered cursor: rows are streamed into the set instead of being fetched into a list first.
+        with conn.cursor(pymysql.cursors.SSCursor) as cursor:
+            cursor.execute(line_item_keys_SELECT_SQL)
+            for nbr, line_nbr, content_hash in cursor:
+                key = line_item_key(nbr, line_nbr)
+                line_item_keys.add(key)
+                if content_hashes is not None:
+                    content_hashes[key] = content_hash
+
+            return line_item_keys
+    except Exception as sqlerr:
+        logging.critical('*ERROR* line_item_keys_SELECT_SQL in get_line_item_keys() on ' + table + '. ' + str(sqlerr))
+        raise
 
 ####################################################################################################
-# get equipment_id, equipment_db_id from aq_id
+# Existing PR/PO line item keys mapped to the equipment summary key each line is stored with,
+# (gh_product_id, gh_site_id, gh_equipment_id, gh_equipment_db_id), so a line that is updated or
+# deleted can report the summary key it leaves to the ConsolidationScope. content_hashes as in
+# get_line_item_keys(). With pr_nbrs (PO lines), the pr_nbr each line is stored with is put in it too,
+# so a line that moves to another PR can report the PR it leaves.
 ####################################################################################################
-def get_equipment(conn, aq_id):
-    equipment_SELECT_SQL = """
-            SELECT
-                equipment_id,
-                db_id as equipment_db_id,
-                a_equipment_id,
-                a_equipment_version,
-                a_equipment_type,
-                if(a_equipment_id is null, '', concat(LPAD(a_equipment_id,5,0),'-',LPAD(gh_bom_equipment.a_equipment_version,2,0),if(ifnull(gh_bom_equipment.a_equipment_type,'')='' ,'', concat('-', gh_bom_equipment.a_equipment_type) ) )) as a_equipment_uid
-            FROM
-                gh_bom_equipment
-            WHERE
-                a_equipment_id = %s
-                and a_equipment_version = %s
-                and ifnull(a_equipment_type,'') = %s"""
+def get_line_item_summary_keys(conn, table, nbr_col, line_nbr_col, content_hashes=None, pr_nbrs=None):
+    line_item_summary_keys = {}
+    line_item_summary_keys_SELECT_SQL = ("SELECT " + nbr_col + ", " + line_nbr_col + ", gh_product_id, gh_site_id, gh_equipment_id, gh_equipment_db_id" +
+                                         (", content_hash" if content_hashes is not None else ", NULL") +
+                                         (", pr_nbr" if pr_nbrs is not None else ", NULL") + " FROM " + table)
+    try:
+        with conn.cursor(pymysql.cursors.SSCursor) as cursor:
+            cursor.execute(line_item_summary_keys_SELECT_SQL)
+            for nbr, line_nbr, product_id, site_id, equipment_id, equipment_db_id, content_hash, pr_nbr in cursor:
+                key = line_item_key(nbr, line_nbr)
+                line_item_summary_keys[key] = (product_id, site_id, equipment_id, equipment_db_id)
+                if content_hashes is not None:
+                    content_hashes[key] = content_hash
+                if pr_nbrs is not None:
+                    pr_nbrs[key] = pr_nbr
+
+            return line_item_summary_keys
+    except Exception as sqlerr:
+        logging.critical('*ERROR* line_item_summary_keys_SELECT_SQL in get_line_item_summary_keys() on ' + table + '. ' + str(sqlerr))
+        raise
 
+####################################################################################################
+# Current invalid PR/PO records keyed by line_item_key(), valued by invalid_record_state().
+####################################################################################################
+def get_invalid_records(conn, table, nbr_col, line_nbr_col, state_cols):
+    invalid_records = {}
+    invalid_records_SELECT_SQL = "SELECT " + nbr_col + ", " + line_nbr_col + ", " + ", ".join(state_cols) + " FROM " + table
     try:
-        with conn.cursor() as cursor:
-            ####################################################################################################
-            # Exception occured: 'NoneType' object is not subscriptable
-            # Add an 'if' condition to prevent the query returns zero record with this error message:
-            # Exception occured: must be str, not NoneType while running processing_PR()
-            # aq_id is empty or null
-            ####################################################################################################
-            cursor.execute(equipment_SELECT_SQL, aq_id)
-            result = cursor.fetchone()
-            if cursor.rowcount == 1:
-                equipment_id = result['equipment_id']
-                equipment_db_id = result['equipment_db_id']
+        with conn.cursor(pymysql.cursors.SSCursor) as cursor:
+            cursor.execute(invalid_records_SELECT_SQL)
+            for row in cursor:
+                invalid_records[line_item_key(row[0], row[1])] = invalid_record_state(*row[2:])
 
-                return equipment_id, equipment_db_id
+            return invalid_records
     except Exception as sqlerr:
-        logging.critical('ERROR: equipment_SELECT_SQL in get_equipment() ', sqlerr)
+        logging.critical('*ERROR* invalid_records_SELECT_SQL in get_invalid_records() on ' + table + '. ' + str(sqlerr))
         raise
 
 ####################################################################################################
@@ -1897,21 +1096,28 @@ def check_invalid_aqid_with_kpr_release(conn):
         logging.critical('ERROR: invalid_aqid_has_kpr_release_SELECT_SQL in check_invalid_aqid_with_kpr_release() ', sqlerr)
         raise
 
-##################################################
-# Sum the QTY based on product_id, site_id, equip_id, equip_db_id
-# "Unpacking Generalizations" works in python v3.5+. Had to rewrite because it doesn't work on v3.4.
-# new_d = [list(b) for _, b in itertools.groupby(prs, key=lambda x:[x['product_id'], x['site_id'], x['equip_id'], x['equip_db_id']])]
-# prs = [{**i[0], **{'pr_qty':sum(b['pr_qty'] for b in i)}} for i in new_d]
-##################################################
-def prs_sum_qty(prs_list):
-    summary = prs_list[0].copy()
-    summary['pr_qty'] = sum(b['pr_qty'] for b in prs_list)
-    return summary
+####################################################################################################
+# Reference data the datafiles are validated against, loaded by load_reference_data(). It is only read
+# while a file is processed, so one ReferenceData can be shared by several files. With parallel the
+# four queries run at the same time (see run_loads()).
+####################################################################################################
+
+def load_reference_data(conn, parallel=False):
+    logging.info('Getting products from gh_product_codes...')
+    logging.info('Getting site_id from gh_sites...')
+    logging.info('Getting valid products and sites...')
+    logging.info('Getting AQ_ID with no KPR Release...')
+    loaded = run_loads({'products': (park_pool, conn, get_product_id),
+                        'sites': (park_pool, conn, get_site_id),
+                        'valid_product_sites': (park_pool, conn, check_valid_product_and_site),
+                        'invalid_aqid_kpr_release': (park_pool, conn, check_invalid_aqid_with_kpr_release)}, parallel)
+
+    return ReferenceData(loaded['products'], loaded['sites'], ValidationRules(loaded['valid_product_sites'], loaded['invalid_aqid_kpr_release']))
 
 ####################################################################################################
 # Send email
 ####################################################################################################
-def send_email(invalid_recs, report_type, filename):
+def send_email(invalid_recs, report_type, filename, diagnostics=()):
     msg = MIMEMultipart()
     msg['From'] = from_addr
     msg['To'] = to_addr
@@ -1967,7 +1173,15 @@ def send_email(invalid_recs, report_type, filename):
                    <td>""" + str(rec[8]) + """</td>
                    </tr>\n"""
     html += """\
-        </table>
+        </table>\n"""
+
+    # Unmapped site codes and aq_ids and malformed rows of the datafile, as summarized by DiagnosticsCollector;
+    # the codes come from the datafile, so they are escaped.
+    for collector in diagnostics:
+        if collector:
+            html += "<br /><pre>" + escape(collector.render()) + "</pre>\n"
+
+    html += """\
          <p>- ghDS PRPO Automation Support</p>
     </div>
     </div>
@@ -2068,100 +1282,302 @@ def send_email_notification_on_errors():
         logging.info("Email sent successfully.\n\n")
         s.quit()
 
+####################################################################################################
+# Park connection and, unless the conveyor journal is used, conveyor connection (None then).
+####################################################################################################
+def checkout_connections():
+    stack = contextlib.ExitStack()
+    try:
+        conn = stack.enter_context(park_pool.connection())
+        conn2 = stack.enter_context(conveyor_pool.connection()) if conveyor_journal is None else None
+    except BaseException:
+        stack.close()
+        raise
+
+    return stack, conn, conn2
+
+####################################################################################################
+# Decrypts and loads queued datafiles, (datatype, filepath, filename), in order on conn/conn2.
+# Returns the number of files processed.
+####################################################################################################
+def process_datafiles(conn, conn2, queued_files, consolidation_scope):
+    num_files = 0
+
+    prefetcher = None
+    if decrypt_prefetch_depth > 0 and not streaming_decrypt and len(queued_files) > 1:
+        prefetcher = DecryptPrefetcher(gpg, [(filepath + '/data/' + filename + '.txt.asc', gpg_pass[datatype]) for datatype, filepath, filename in queued_files],
+                                       decrypt_prefetch_depth, decrypt_prefetch_max_mb)
+
+    try:
+        for datatype, filepath, filename in queued_files:
+            invalid_recs = []
+            diagnostics = []
+
+            msginfo = 'Starting ' + datatype + ' at ' + datetime.now().strftime('%Y-%m-%d %X')
+            logging.info(msginfo)
+
+            with open(filepath + '/data/' + filename + '.txt.asc','rb') as f:
+
+                msginfo = 'Decrypting: ' + filepath + '/data/' + filename + '.txt.asc'
+                logging.info(msginfo)
+
+                if streaming_decrypt:
+                    data = GPGDecryptStream(gpg, f, gpg_pass[datatype])
+                    result = csv.reader(data, delimiter='\t')
+                elif prefetcher is not None:
+                    result = csv.reader(io.StringIO(prefetcher.plaintext(filepath + '/data/' + filename + '.txt.asc', gpg_pass[datatype])), delimiter='\t')
+                else:
+                    data = gpg.decrypt_file(f, passphrase=gpg_pass[datatype])
+                    result = csv.reader(io.StringIO(str(data)), delimiter='\t')
+
+                resume_row = 0
+                if processing_manifest is not None:
+                    # only 'rows' commit_mode leaves the committed rows of an unfinished file behind.
+                    resume_row = processing_manifest.start(datatype, filename, file_checksum(filepath + '/data/' + filename + '.txt.asc'), commit_mode == 'rows')
+
+                try:
+                    msginfo = 'Processing: ' + filepath + '/data/' + filename + '.txt.asc\n'
+                    logging.info(msginfo)
+
+                    num_rows = processing_line_items(PR_SCHEMA if datatype == 'PR' else PO_SCHEMA, filepath,
+                                                     conn, conn2, result, filename, consolidation_scope, invalid_recs, diagnostics, resume_row)
+                except BaseException as err:
+                    if isinstance(err, DecryptError):
+                        # Write to the /status/.error and log files.
+                        erfile = open(filepath + '/status/' + filename + '.error', 'a')
+                        erfile.write('*DECRYPT ERROR* ' + str(err) + '\n')
+                        erfile.close()
+                        logging.critical('*DECRYPT ERROR* ' + filepath + '/data/' + filename + '.txt.asc. ' + str(err))
+                    if processing_manifest is not None:
+                        # processing_line_items() writes the .error marker for errors in the datafile itself.
+                        error_marker = os.path.isfile(filepath + '/status/' + filename + '.error')
+                        processing_manifest.finish(datatype, filename, 'error' if error_marker else 'failed', error=repr(err))
+                    raise
+                else:
+                    if processing_manifest is not None:
+                        processed_marker = os.path.isfile(filepath + '/status/' + filename + '.processed')
+                        processing_manifest.finish(datatype, filename, 'processed' if processed_marker else 'failed', num_rows)
+                finally:
+                    if streaming_decrypt:
+                        data.close()
+
+                num_files += 1
+
+            if invalid_recs:
+                logging.info('Begin sending email for invalid %s reports...' %datatype)
+                send_email(invalid_recs, datatype, filename, diagnostics)
+    finally:
+        if prefetcher is not None:
+            prefetcher.close()
+
+    return num_files
+
+####################################################################################################
+# Processes the queued datafiles of one datatype in a thread, on its own pooled park/conveyor connections.
+# PR and PO workers write different tables; ConsolidationScope only adds to sets, which is safe
+# across threads. An exception is kept in error for the main loop to raise after join().
+####################################################################################################
+class DatafileWorker(threading.Thread):
+    def __init__(self, queued_files, consolidation_scope):
+        super().__init__()
+        self.queued_files = queued_files
+        self.consolidation_scope = consolidation_scope
+        self.num_files = 0
+        self.error = None
+        # the error came with a lost database connection; the main loop reconnects instead of exiting.
+        self.lost_connection = False
+
+    def run(self):
+        if not self.queued_files:
+            return
+
+        try:
+            stack, worker_conn, worker_conn2 = checkout_connections()
+            with stack:
+                try:
+                    self.num_files = process_datafiles(worker_conn, worker_conn2, self.queued_files, self.consolidation_scope)
+                except BaseException:
+                    # checked before the connections are checked in (and a lost one closed).
+                    self.lost_connection = not (worker_conn.open and (worker_conn2 is None or worker_conn2.open))
+                    raise
+        except (Exception, SystemExit) as err:
+            # processing_line_items() sys.exit()s on a bad datafile header; the main loop re-raises it.
+            logging.critical('*ERROR* in DatafileWorker ' + self.name + '. ' + repr(err))
+            self.error = err
+            if isinstance(err, pymysql.err.OperationalError):
+                self.lost_connection = True
+
 ###########################################################################
 # prpo_main.py
 # loop thru the PR and PO datafiles in /var/pr/ or /var/po/ directory.
-# PR -> processing_PR()
-# PO -> processing_PO()
-#       processing_prpo_consolidation()
+# PR, PO -> processing_line_items()
+#           processing_prpo_consolidation()
 ###########################################################################
 
 gpg = gnupg.GPG()
+last_full_consolidation = None
+
+# the connections opened at startup are the first ones in the pools.
+park_pool = ConnectionPool(connect_park, 'park', db_pool_size, [conn])
+conveyor_pool = ConnectionPool(connect_conveyor, 'conveyor', db_pool_size, [conn2])
+
+conveyor_journal = None
+if conveyor_journal_dir:
+    conveyor_journal = ConveyorJournal(conveyor_journal_dir, conveyor_journal_batch_size)
+    conveyor_journal.start_drainer(conveyor_pool)
+# keys touched since the last consolidation; kept across cycles until a consolidation succeeds.
+consolidation_scope = ConsolidationScope()
+
+reference_cache = ReferenceDataCache(load_reference_data, reference_cache_seconds, reference_cache_probe, reference_cache_file, parallel_reference_load)
+
+processing_manifest = None
+if manifest_file:
+    processing_manifest = ProcessingManifest(manifest_file)
+    processing_manifest.import_markers('PR', pr_data_path + '/status')
+    processing_manifest.import_markers('PO', po_data_path + '/status')
+
+status_watcher = StatusWatcher([pr_data_path + '/status', po_data_path + '/status'], status_watch, status_poll_seconds)
+# the queue is built from the .fetched markers status_watcher saw and, with processing_manifest, its pending and
+# failed files. The status directories are listed at startup, when status_watcher cannot name the new markers,
+# after an error (without processing_manifest) and after FULL_SCAN_WAITS waits without a change: a file whose
+# .error marker was removed is retried by a full scan, but no .fetched event announces it.
+FULL_SCAN_WAITS = 6     # 6 x 600 secs = 1 hour
+full_scan = True
+idle_waits = 0
 
 while True:
     try:
         logging.info('Checking database connections...')
-        if (conn.open and conn2.open):
+        stack, conn, conn2 = checkout_connections()
+        with stack:
             logging.info('Database connections: park and conveyor are open...')
 
             datatypes = ['PR', 'PO']
             num_files = 0
+            workers_lost_connection = False
+
+            if conveyor_journal is not None:
+                conveyor_journal.log_lag()
 
             try:
+                ####################################################################################################
+                # Datafiles not processed yet, PR first, each datatype in file name order.
+                # Only the new .fetched markers and the manifest's unfinished files are checked, unless it is
+                # time for a full scan of the status directories.
+                ####################################################################################################
+                queued_files = []
+                fetched = status_watcher.take_fetched()
+                if fetched is None:
+                    full_scan = True
                 for datatype in datatypes:
                     filepath = pr_data_path if datatype == 'PR' else po_data_path
 
-                    for getfile in sorted(pathlib.Path(filepath + '/status').glob('*.fetched')):
-                        send_email_invalid_pr_recs, send_email_invalid_po_recs = [], []
-
-                        index = getfile.name.index(".")
-                        filename = getfile.name[:index]
-
-                        if not ((os.path.isfile(filepath + '/status/' + filename + '.processed')) or (os.path.isfile(filepath + '/status/' + filename + '.error'))):
-                            msginfo = 'Starting ' + datatype + ' at ' + datetime.now().strftime('%Y-%m-%d %X')
-                            logging.info(msginfo)
-
-                            with open(filepath + '/data/' + filename + '.txt.asc','rb') as f:
-
-                                msginfo = 'Decrypting: ' + filepath + '/data/' + filename + '.txt.asc'
-                                logging.info(msginfo)
-
-                                data = gpg.decrypt_file(f, passphrase=gpg_pass[datatype])
-
-                                result = csv.DictReader(io.StringIO(str(data)), delimiter='\t')
-
-                                if datatype == 'PR':
-                                    msginfo = 'Processing: ' + filepath + '/data/' + filename + '.txt.asc\n'
-                                    logging.info(msginfo)
-
-                                    processing_PR(conn, conn2, result, filename)
-                                else:
-                                    msginfo = 'Processing: ' + filepath + '/data/' + filename + '.txt.asc\n'
-                                    logging.info(msginfo)
-
-                                    processing_PO(conn, conn2, result, filename)
-
-                                num_files += 1
+                    if full_scan:
+                        # one directory listing instead of two stats per .fetched marker.
+                        try:
+                            status_files = set(os.listdir(filepath + '/status'))
+                        except FileNotFoundError:
+                            status_files = set()
+                        filenames = set(name[:name.index(".")] for name in status_files if name.endswith('.fetched'))
+                    else:
+                        status_files = None
+                        filenames = set(fetched[filepath + '/status'])
+                    if processing_manifest is not None:
+                        filenames.update(processing_manifest.unfinished(datatype))
+
+                    queued_filenames = []
+                    for filename in sorted(filenames):
+                        if status_files is not None:
+                            error_marker = (filename + '.error') in status_files
+                            processed_marker = (filename + '.processed') in status_files
+                        else:
+                            error_marker = os.path.isfile(filepath + '/status/' + filename + '.error')
+                            processed_marker = os.path.isfile(filepath + '/status/' + filename + '.processed')
 
-                            if send_email_invalid_pr_recs:
-                                logging.info('Begin sending email for invalid %s reports...' %datatype)
-                                send_email(send_email_invalid_pr_recs, datatype, filename)
-                            elif send_email_invalid_po_recs:
-                                logging.info('Begin sending email for invalid %s reports...' %datatype)
-                                send_email(send_email_invalid_po_recs, datatype, filename)
+                        if processing_manifest is not None:
+                            done = processing_manifest.is_done(datatype, filename, error_marker)
+                        else:
+                            done = processed_marker or error_marker
+                        if not done:
+                            queued_files.append((datatype, filepath, filename))
+                            queued_filenames.append(filename)
+
+                    if processing_manifest is not None:
+                        # still pending if this cycle fails before they are started.
+                        processing_manifest.queue(datatype, queued_filenames)
+                full_scan = False
+
+                if parallel_datatypes:
+                    ####################################################################################################
+                    # One worker per datatype; consolidation waits for both (files of a datatype stay in order).
+                    ####################################################################################################
+                    workers = [DatafileWorker([queued_file for queued_file in queued_files if queued_file[0] == datatype], consolidation_scope) for datatype in datatypes]
+                    for worker in workers:
+                        worker.start()
+                    for worker in workers:
+                        worker.join()
+
+                    num_files = sum(worker.num_files for worker in workers)
+                    failed_workers = [worker for worker in workers if worker.error is not None]
+                    if failed_workers:
+                        # any other error wins over a lost connection, which is retried like one of the main connections.
+                        failed_workers.sort(key=lambda worker: worker.lost_connection)
+                        workers_lost_connection = failed_workers[0].lost_connection
+                        raise failed_workers[0].error
+                else:
+                    num_files = process_datafiles(conn, conn2, queued_files, consolidation_scope)
 
+                full_consolidation_due = (last_full_consolidation is None or time.time() - last_full_consolidation >= full_consolidation_hours * 3600)
 
                 if num_files > 0:
                     msginfo = 'Number of files processed: ' + str(num_files)
                     logging.info(msginfo)
 
-                    msginfo = 'Processing consolidation...'
-                    logging.info(msginfo)
+                    if incremental_consolidation and not full_consolidation_due:
+                        msginfo = 'Processing incremental consolidation...'
+                        logging.info(msginfo)
 
-                    processing_prpo_consolidation(conn)
+                        processing_prpo_consolidation(conn, consolidation_scope)
+                        consolidation_scope = ConsolidationScope()
+                    else:
+                        msginfo = 'Processing consolidation...'
+                        logging.info(msginfo)
+
+                        processing_prpo_consolidation(conn)
+                        last_full_consolidation = time.time()
+                        consolidation_scope = ConsolidationScope()
                 else:
                     msginfo = 'Number of PR/PO file(s) processed: ' + str(num_files)
                     logging.info(msginfo)
 
-                msginfo = 'Sleeping...'
+                    if incremental_consolidation and full_consolidation_due:
+                        msginfo = 'Processing full consolidation (reconciliation)...'
+                        logging.info(msginfo)
+
+                        processing_prpo_consolidation(conn)
+                        last_full_consolidation = time.time()
+                        consolidation_scope = ConsolidationScope()
+
+                msginfo = 'Waiting for new datafiles...'
                 logging.info(msginfo)
 
-                time.sleep(600) # 300 secs = 5 minutes
+                idle_waits = 0 if status_watcher.wait(600) else idle_waits + 1   # 600 secs = 10 minutes at most
+                if idle_waits >= FULL_SCAN_WAITS:
+                    full_scan = True
+                    idle_waits = 0
             except Exception as mainerr:
                 errmsg = 'In main. *ERROR* ' + str(mainerr)
                 logging.critical(errmsg)
                 send_email_notification_on_errors()
-                if (conn.open and conn2.open):
+                # the files of the failed cycle are pending or failed in processing_manifest; without it, they are
+                # picked up again by a full scan.
+                full_scan = full_scan or processing_manifest is None
+                if (conn.open and (conn2 is None or conn2.open)) and not workers_lost_connection:
                     sys.exit(1)
                 else:
+                    # a lost connection is closed on checkin; the pool reconnects on the next checkout.
+                    logging.info('Lost database connections. Reconnecting...')
                     time.sleep(60)  # 60 secs = 1 minutes
-                    conn.ping(reconnect=True)
-                    conn2.ping(reconnect=True)
-        else:
-            time.sleep(60)  # 60 secs = 1 minutes
-            logging.info('Lost database connections. Reconnecting...')
-            conn.ping(reconnect=True)
-            conn2.ping(reconnect=True)
 
     except Exception as dberr:
         errmsg = '*ERROR MAKING DATABASE CONNECTION* Please check database login credentials.\n' + str(dberr)
@@ -0,0 +1,67 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.rows = []
+        self.rowcount = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def execute(self, sql, args=None):
+        self.conn.statements.append((sql, args))
+        self.rows = list(self.conn.answer(sql, args) or [])
+        self.rowcount = len(self.rows) if sql.lstrip().upper().startswith('SELECT') else 1
+
+    def executemany(self, sql, seq_of_args):
+        seq_of_args = list(seq_of_args)
+        self.conn.statements.append((sql, seq_of_args))
+        self.conn.answer_many(sql, seq_of_args)
+        self.rowcount = len(seq_of_args)
+
+    def fetchall(self):
+        return self.rows
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+
+class FakeConnection:
+    """Records what is sent to it; answer(sql, args) returns the rows of a query."""
+
+    def __init__(self, answer=None, answer_many=None):
+        self.answer = answer or (lambda sql, args: [])
+        self.answer_many = answer_many or (lambda sql, seq_of_args: None)
+        self.statements = []
+        self.commits = self.rollbacks = 0
+        self.open = True
+
+    def cursor(self, cursorclass=None):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def executed(self, prefix=''):
+        return [(sql, args) for sql, args in self.statements if sql.lstrip().startswith(prefix)]
+
+
+@pytest.fixture
+def fake_conn():
+    return FakeConnection()
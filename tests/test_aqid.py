@@ -0,0 +1,60 @@
+from conftest import FakeConnection
+
+from prpo_lib import normalize_aqid, parse_aqid_key, EquipmentResolver
+
+
+def test_normalize_aqid_appends_the_retro_suffix_once():
+    assert normalize_aqid('123-01', 'RETRO') == '123-01-R'
+    assert normalize_aqid('123-01-R', 'RETRO') == '123-01-R'
+    assert normalize_aqid('123-01', 'EQ') == '123-01'
+
+
+def test_parse_aqid_key():
+    assert parse_aqid_key('00123-01') == ('123', '1', '')
+    assert parse_aqid_key('123-1-r') == ('123', '1', 'R')
+    assert parse_aqid_key('A12-01-X') == ('A12', '1', 'X')
+    assert parse_aqid_key('123') is None
+
+
+def equipment_rows(rows):
+    def answer(sql, args):
+        a_equipment_ids = set(args[0])
+        return [dict(zip(['equipment_id', 'equipment_db_id', 'a_equipment_id', 'a_equipment_version', 'a_equipment_type'], row))
+                for row in rows if str(row[2]) in a_equipment_ids]
+    return answer
+
+
+def test_resolver_queries_once_per_chunk_and_caches_misses():
+    conn = FakeConnection(equipment_rows([(1, 11, 123, 1, None), (2, 22, 124, 2, 'R'), (3, 33, 125, 1, ''), (4, 44, 125, 1, '')]))
+    resolver = EquipmentResolver(conn, chunk_size=2)
+    resolver.prefetch(['00123-01', '124-02-R', '125-01', '999-01'])
+
+    assert resolver.num_queries == 2
+    assert resolver.resolve('00123-01') == (1, 11)
+    assert resolver.resolve('124-02-r') == (2, 22)
+    # an AQ_ID that matches more than one equipment is not mapped.
+    assert resolver.resolve('125-01') is None
+    assert resolver.resolve('999-01') is None
+    assert resolver.resolve('nonsense') is None
+    assert resolver.num_queries == 2
+    # written differently, an AQ_ID is looked up again (it is matched as written first).
+    assert resolver.resolve('123-1') == (1, 11)
+    assert resolver.num_queries == 3
+
+
+def test_exact_aqid_match_comes_before_the_normalized_one(caplog):
+    # a varchar a_equipment_id holding both '010' and '10'.
+    conn = FakeConnection(equipment_rows([(1, 11, '010', '01', None), (2, 22, '10', '01', None), (3, 33, '20', '01', None)]))
+    resolver = EquipmentResolver(conn)
+    resolver.prefetch(['010-01', '10-01', '0010-01'])
+
+    assert resolver.resolve('010-01') == (1, 11)
+    assert resolver.resolve('10-01') == (2, 22)
+    # no exact match: the normalized key matches both, so it is not mapped.
+    assert resolver.resolve('0010-01') is None
+    # no exact match, one normalized match.
+    assert resolver.resolve('020-1') == (3, 33)
+    assert resolver.resolve('20-01') == (3, 33)
+
+    collisions = [record.getMessage() for record in caplog.records if 'same without leading zeros' in record.getMessage()]
+    assert collisions == ['gh_bom_equipment AQ_IDs 010-01, 10-01 are the same without leading zeros; only an exact AQ_ID match maps them.']
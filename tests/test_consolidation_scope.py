@@ -0,0 +1,29 @@
+from conftest import FakeConnection
+
+from prpo_lib import ConsolidationScope
+
+
+def test_keys_and_pr_numbers_are_collected():
+    scope = ConsolidationScope()
+    scope.add_keys((1, 2, 3, 4), None, (1, 2, 3, 4), (5, 2, 3, 4))
+    scope.add_pr_nbr(' PR1 ')
+    scope.add_pr_nbr('')
+    scope.add_pr_nbr(None)
+
+    assert scope.keys == {(1, 2, 3, 4), (5, 2, 3, 4)}
+    assert scope.pr_nbrs == {'PR1'}
+    assert sorted(scope.product_ids()) == [1, 5]
+
+
+def test_resolve_adds_the_keys_of_the_pr_lines_in_chunks():
+    pr_lines = {'PR1': [(7, 2, 3, 4)], 'PR2': [(8, 2, 3, 4), (None, None, None, None)], 'PR3': []}
+    conn = FakeConnection(lambda sql, args: [key for pr_nbr in args[0] for key in pr_lines[pr_nbr]])
+    scope = ConsolidationScope(chunk_size=2)
+    for pr_nbr in pr_lines:
+        scope.add_pr_nbr(pr_nbr)
+    scope.resolve(conn)
+
+    assert len(conn.statements) == 2
+    assert scope.keys == {(7, 2, 3, 4), (8, 2, 3, 4), (None, None, None, None)}
+    assert sorted(scope.product_ids()) == [7, 8]
+    assert scope.pr_nbrs == set()
@@ -0,0 +1,149 @@
+import os
+
+import pytest
+
+from conftest import FakeConnection
+
+from prpo_lib import ConveyorJournal
+
+INSERT_SQL = 'INSERT INTO t (nbr, line_nbr, v) VALUES (%s, %s, %s)'
+UPDATE_SQL = 'UPDATE t SET v = %s WHERE nbr = %s AND line_nbr = %s'
+PROVENANCE_COLUMNS = ['pr_nbr', 'pr_line_nbr', 'file_name']
+
+
+class Conveyor:
+    """Table t and gh_pr_po_file of a conveyor database, applied as the statements arrive."""
+
+    def __init__(self, lines=None):
+        self.lines = dict(lines or {})
+        self.provenance = []
+        self.conn = FakeConnection(self.answer, self.answer_many)
+
+    def answer(self, sql, args):
+        if sql.startswith('SELECT nbr, line_nbr FROM t '):
+            return [key for key in self.lines if key[0] in args[0]]
+        if sql.startswith('SELECT pr_nbr, pr_line_nbr, file_name FROM gh_pr_po_file '):
+            return [row for row in self.provenance if row[2] in args[0]]
+        raise AssertionError(sql)
+
+    def answer_many(self, sql, seq_of_args):
+        for args in seq_of_args:
+            if sql == INSERT_SQL:
+                assert (args[0], args[1]) not in self.lines, 'inserted twice'
+                self.lines[(args[0], args[1])] = args[2]
+            elif sql == UPDATE_SQL:
+                self.lines[(args[1], args[2])] = args[0]
+            else:
+                self.provenance.append(tuple(args))
+
+
+def journal_file(journal, file_name, lines):
+    writer = journal.writer('t', 'nbr', 'line_nbr', INSERT_SQL, UPDATE_SQL, 'gh_pr_po_file', PROVENANCE_COLUMNS)
+    for op, nbr, line_nbr, v in lines:
+        writer.record((nbr, line_nbr, file_name))
+        if op == 'insert':
+            writer.add(INSERT_SQL, (nbr, line_nbr, v), (nbr, line_nbr), 'raw_rows_inserted')
+        else:
+            writer.add(UPDATE_SQL, (v, nbr, line_nbr), (nbr, line_nbr), 'raw_rows_updated')
+    return writer
+
+
+def test_a_segment_is_only_put_in_place_by_flush(tmp_path):
+    journal = ConveyorJournal(str(tmp_path))
+    writer = journal_file(journal, 'f1', [('insert', 'PR1', 1, 'a')])
+    assert journal.segments() == []
+    writer.flush()
+    assert len(journal.segments()) == 1
+    assert (writer.counts['raw_rows_inserted'], writer.num_recorded) == (1, 1)
+
+    writer = journal_file(journal, 'f2', [('insert', 'PR2', 1, 'a')])
+    writer.discard()
+    assert len(journal.segments()) == 1
+    assert list(tmp_path.glob('*.tmp')) == []
+
+
+def test_unfinished_segments_are_removed_at_start(tmp_path):
+    journal_file(ConveyorJournal(str(tmp_path)), 'f1', [('insert', 'PR1', 1, 'a')])
+    assert len(list(tmp_path.glob('*.jsonl.tmp'))) == 1
+    ConveyorJournal(str(tmp_path))
+    assert list(tmp_path.glob('*.jsonl.tmp')) == []
+
+
+def test_insert_or_update_is_decided_when_applied(tmp_path):
+    journal = ConveyorJournal(str(tmp_path))
+    journal_file(journal, 'f1', [('insert', 'PR1', 1, 'a'), ('update', 'PR2', 1, 'b')]).flush()
+    conveyor = Conveyor({('PR1', 1): 'old'})
+
+    assert journal.drain(conveyor.conn)
+    assert conveyor.lines == {('PR1', 1): 'a', ('PR2', 1): 'b'}
+    assert conveyor.provenance == [('PR1', 1, 'f1'), ('PR2', 1, 'f1')]
+    assert journal.segments() == []
+    assert not journal.drain(conveyor.conn)
+
+
+def test_segments_are_applied_in_order(tmp_path):
+    journal = ConveyorJournal(str(tmp_path))
+    journal_file(journal, 'f1', [('insert', 'PR1', 1, 'a')]).flush()
+    journal_file(journal, 'f2', [('update', 'PR1', 1, 'b'), ('insert', 'PR1', 2, 'c')]).flush()
+    conveyor = Conveyor()
+    while journal.drain(conveyor.conn):
+        pass
+
+    assert conveyor.lines == {('PR1', 1): 'b', ('PR1', 2): 'c'}
+    assert [row[2] for row in conveyor.provenance] == ['f1', 'f2', 'f2']
+
+
+def test_replay_after_a_crash_before_the_checkpoint_is_idempotent(tmp_path, monkeypatch):
+    journal = ConveyorJournal(str(tmp_path), batch_size=2)
+    journal_file(journal, 'f1', [('insert', 'PR1', 1, 'a'), ('insert', 'PR1', 2, 'b'), ('insert', 'PR1', 3, 'c')]).flush()
+    conveyor = Conveyor()
+
+    # the first batch (line 1 and its gh_pr_po_file row) is committed, then the process dies before its checkpoint is written.
+    def crash(segment_name, entries):
+        raise OSError('killed')
+    monkeypatch.setattr(journal, 'write_checkpoint', crash)
+    with pytest.raises(OSError):
+        journal.drain(conveyor.conn)
+    assert conveyor.provenance == [('PR1', 1, 'f1')]
+
+    restarted = ConveyorJournal(str(tmp_path), batch_size=2)
+    assert restarted.drain(conveyor.conn)
+    assert conveyor.lines == {('PR1', 1): 'a', ('PR1', 2): 'b', ('PR1', 3): 'c'}
+    assert sorted(conveyor.provenance) == [('PR1', 1, 'f1'), ('PR1', 2, 'f1'), ('PR1', 3, 'f1')]
+
+
+def test_drain_resumes_from_the_checkpoint(tmp_path):
+    journal = ConveyorJournal(str(tmp_path), batch_size=2)
+    journal_file(journal, 'f1', [('insert', 'PR1', 1, 'a'), ('insert', 'PR1', 2, 'b')]).flush()
+    segment = journal.segments()[0]
+    # the first two entries (line 1 and its gh_pr_po_file row) were applied before.
+    journal.write_checkpoint(segment.name, 2)
+    conveyor = Conveyor({('PR1', 1): 'a'})
+    conveyor.provenance.append(('PR1', 1, 'f1'))
+
+    assert journal.drain(conveyor.conn)
+    assert conveyor.provenance == [('PR1', 1, 'f1'), ('PR1', 2, 'f1')]
+    assert not os.path.exists(segment)
+
+
+def test_a_failed_drain_replays_with_provenance_dedupe(tmp_path, monkeypatch):
+    journal = ConveyorJournal(str(tmp_path), batch_size=2)
+    journal_file(journal, 'f1', [('insert', 'PR1', 1, 'a'), ('insert', 'PR1', 2, 'b'), ('insert', 'PR1', 3, 'c')]).flush()
+    conveyor = Conveyor()
+
+    # the first batch is checkpointed; the second is committed, but its checkpoint is not written.
+    write_checkpoint = journal.write_checkpoint
+    def fail_second(segment_name, entries):
+        if entries > 2:
+            raise OSError('disk full')
+        write_checkpoint(segment_name, entries)
+    monkeypatch.setattr(journal, 'write_checkpoint', fail_second)
+    with pytest.raises(OSError):
+        journal.drain(conveyor.conn)
+    assert journal.replaying
+
+    # the same journal retries (drain_forever) and replays the second batch without recording it twice.
+    monkeypatch.setattr(journal, 'write_checkpoint', write_checkpoint)
+    assert journal.drain(conveyor.conn)
+    assert not journal.replaying
+    assert sorted(conveyor.provenance) == [('PR1', 1, 'f1'), ('PR1', 2, 'f1'), ('PR1', 3, 'f1')]
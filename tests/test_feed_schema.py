@@ -0,0 +1,130 @@
+import re
+
+import pytest
+
+from prpo_lib import FeedSchema, PR_DB_COL_MAPPING, PO_DB_COL_MAPPING, PR_COLUMN_TYPES, PO_COLUMN_TYPES
+
+# the statements processing_PR()/processing_PO() used before FeedSchema, whitespace collapsed.
+OLD_STATEMENTS = {
+    'new_pr_INSERT_SQL':
+        'INSERT INTO gh_eapproval_pr_line_item (pr_nbr, pr_line_nbr, pr_status_desc, company_code, currency_code, request_date, material_description, total_amount, price_per_unit, quantity, model_number, aq_id, project_nbr, spend_type_code, functional_location_code, spend_type_description, functional_location_description, destination, vendor_number, vendor_name, initiator, cost_center_nbr, record_type, gh_product_id, gh_site_id, gh_equipment_id, gh_equipment_db_id, created) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)',
+    'new_raw_pr_INSERT_SQL':
+        'INSERT INTO gh_eapproval_pr_line_item (pr_nbr, pr_line_nbr, pr_status_desc, company_code, currency_code, request_date, material_description, total_amount, price_per_unit, quantity, model_number, aq_id, project_nbr, spend_type_code, functional_location_code, spend_type_description, functional_location_description, destination, vendor_number, vendor_name, initiator, cost_center_nbr, record_type, gh_product_id, gh_site_id, gh_equipment_id, gh_equipment_db_id, gh_product_name, gh_site, created) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)',
+    'pr_UPDATE_SQL':
+        'UPDATE gh_eapproval_pr_line_item SET pr_status_desc = %s, company_code = %s, currency_code = %s, request_date = %s, material_description = %s, total_amount = %s, price_per_unit = %s, quantity = %s, model_number = %s, aq_id = %s, project_nbr = %s, spend_type_code = %s, functional_location_code = %s, spend_type_description = %s, functional_location_description = %s, destination = %s, vendor_number = %s, vendor_name = %s, initiator = %s, cost_center_nbr = %s, record_type = %s, gh_product_id = %s, gh_site_id = %s, gh_equipment_id = %s, gh_equipment_db_id = %s, updated = %s, status_id = %s WHERE pr_nbr = %s AND pr_line_nbr = %s',
+    'pr_raw_UPDATE_SQL':
+        'UPDATE gh_eapproval_pr_line_item SET pr_status_desc = %s, company_code = %s, currency_code = %s, request_date = %s, material_description = %s, total_amount = %s, price_per_unit = %s, quantity = %s, model_number = %s, aq_id = %s, project_nbr = %s, spend_type_code = %s, functional_location_code = %s, spend_type_description = %s, functional_location_description = %s, destination = %s, vendor_number = %s, vendor_name = %s, initiator = %s, cost_center_nbr = %s, record_type = %s, gh_product_id = %s, gh_site_id = %s, gh_equipment_id = %s, gh_equipment_db_id = %s, gh_product_name = %s, gh_site = %s, updated = %s WHERE pr_nbr = %s AND pr_line_nbr = %s',
+    'pr_status_UPDATE_SQL':
+        'UPDATE gh_eapproval_pr_line_item SET record_type = %s, updated = %s, status_id = %s WHERE pr_nbr = %s AND pr_line_nbr = %s',
+    'new_po_INSERT_SQL':
+        'INSERT INTO gh_sap_po_line_item ( po_nbr, po_line_nbr, material_description, company_code, tracking_no, po_quantity, net_price, net_value, effective_value, pr_nbr, pr_line_nbr, initiator, vendor_name, functional_location, project_nbr, aq_id, po_status, spend_type_code, spend_type_description, currency, order_unit, order_price_unit, gr_quantity, record_type, po_date, po_item_deleted_flag, gh_product_id, gh_site_id, gh_equipment_id, gh_equipment_db_id, created, status_id) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)',
+    'new_raw_po_INSERT_SQL':
+        'INSERT INTO gh_sap_po_line_item ( po_nbr, po_line_nbr, material_description, company_code, tracking_no, po_quantity, net_price, net_value, effective_value, pr_nbr, pr_line_nbr, initiator, vendor_name, functional_location, project_nbr, aq_id, po_status, spend_type_code, spend_type_description, currency, order_unit, order_price_unit, gr_quantity, record_type, po_date, po_item_deleted_flag, gh_product_id, gh_site_id, gh_equipment_id, gh_equipment_db_id, gh_product_name, gh_site, created, status_id) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)',
+    'po_UPDATE_SQL':
+        'UPDATE gh_sap_po_line_item SET material_description = %s, company_code = %s, tracking_no = %s, po_quantity = %s, net_price = %s, net_value = %s, effective_value = %s, pr_nbr = %s, pr_line_nbr = %s, initiator = %s, vendor_name = %s, functional_location = %s, project_nbr = %s, aq_id = %s, po_status = %s, spend_type_code = %s, spend_type_description = %s, currency = %s, order_unit = %s, order_price_unit = %s, gr_quantity = %s, record_type = %s, po_date = %s, po_item_deleted_flag = %s, gh_product_id = %s, gh_site_id = %s, gh_equipment_id = %s, gh_equipment_db_id = %s, updated = %s, status_id = %s WHERE po_nbr = %s AND po_line_nbr = %s',
+    'po_raw_UPDATE_SQL':
+        'UPDATE gh_sap_po_line_item SET material_description = %s, company_code = %s, tracking_no = %s, po_quantity = %s, net_price = %s, net_value = %s, effective_value = %s, pr_nbr = %s, pr_line_nbr = %s, initiator = %s, vendor_name = %s, functional_location = %s, project_nbr = %s, aq_id = %s, po_status = %s, spend_type_code = %s, spend_type_description = %s, currency = %s, order_unit = %s, order_price_unit = %s, gr_quantity = %s, record_type = %s, po_date = %s, po_item_deleted_flag = %s, gh_product_id = %s, gh_site_id = %s, gh_equipment_id = %s, gh_equipment_db_id = %s, gh_product_name = %s, gh_site = %s, updated = %s, status_id = %s WHERE po_nbr = %s AND po_line_nbr = %s',
+    'po_status_UPDATE_SQL':
+        'UPDATE gh_sap_po_line_item SET record_type = %s, updated = %s, status_id = %s WHERE po_nbr = %s AND po_line_nbr = %s',
+    'pr_invalid_product_site_aqid_INSERT_SQL':
+        'INSERT INTO gh_pr_invalid_data (pr_nbr, pr_line_nbr, aq_id, gh_product_id, gh_site_id, gh_equipment_id, gh_equipment_db_id, category, description, updated) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)',
+    'pr_invalid_product_site_aqid_UPDATE_SQL':
+        'UPDATE gh_pr_invalid_data SET aq_id = %s, gh_product_id = %s, gh_site_id = %s, gh_equipment_id = %s, gh_equipment_db_id = %s, description = %s, status_id = %s, updated = %s WHERE pr_nbr = %s and pr_line_nbr = %s',
+    'pr_invalid_product_site_aqid_DELETE_SQL':
+        'UPDATE gh_pr_invalid_data SET updated = %s, status_id = %s WHERE pr_nbr = %s and pr_line_nbr = %s',
+    'po_invalid_product_site_aqid_INSERT_SQL':
+        'INSERT INTO gh_po_invalid_data (pr_nbr, pr_line_nbr, po_nbr, po_line_nbr, aq_id, gh_product_id, gh_site_id, gh_equipment_id, gh_equipment_db_id, category, description, updated) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)',
+    'po_invalid_product_site_aqid_UPDATE_SQL':
+        'UPDATE gh_po_invalid_data SET pr_nbr = %s, pr_line_nbr = %s, aq_id = %s, gh_product_id = %s, gh_site_id = %s, gh_equipment_id = %s, gh_equipment_db_id = %s, description = %s, status_id = %s, updated = %s WHERE po_nbr = %s and po_line_nbr = %s',
+    'po_invalid_product_site_aqid_DELETE_SQL':
+        'UPDATE gh_po_invalid_data SET updated = %s, status_id = %s WHERE po_nbr = %s and po_line_nbr = %s',
+}
+
+PR_STATEMENTS = {'new_pr_INSERT_SQL': 'insert_SQL', 'new_raw_pr_INSERT_SQL': 'raw_insert_SQL', 'pr_UPDATE_SQL': 'update_SQL',
+                 'pr_raw_UPDATE_SQL': 'raw_update_SQL', 'pr_status_UPDATE_SQL': 'status_UPDATE_SQL',
+                 'pr_invalid_product_site_aqid_INSERT_SQL': 'invalid_insert_SQL', 'pr_invalid_product_site_aqid_UPDATE_SQL': 'invalid_update_SQL',
+                 'pr_invalid_product_site_aqid_DELETE_SQL': 'invalid_delete_SQL'}
+PO_STATEMENTS = {'new_po_INSERT_SQL': 'insert_SQL', 'new_raw_po_INSERT_SQL': 'raw_insert_SQL', 'po_UPDATE_SQL': 'update_SQL',
+                 'po_raw_UPDATE_SQL': 'raw_update_SQL', 'po_status_UPDATE_SQL': 'status_UPDATE_SQL',
+                 'po_invalid_product_site_aqid_INSERT_SQL': 'invalid_insert_SQL', 'po_invalid_product_site_aqid_UPDATE_SQL': 'invalid_update_SQL',
+                 'po_invalid_product_site_aqid_DELETE_SQL': 'invalid_delete_SQL'}
+
+
+def normalized(sql):
+    return ' '.join(sql.replace('(', ' ( ').replace(')', ' ) ').replace(',', ' , ').split()).upper()
+
+
+def sql_columns(sql):
+    # the column of every %s, in parameter order.
+    if sql.startswith('INSERT'):
+        return [column.strip() for column in sql[sql.index('(') + 1:sql.index(')')].split(',')]
+    return re.findall(r'(\w+) = %s', sql)
+
+
+def schemas(with_hash=False):
+    return [(FeedSchema('PR', 'gh_eapproval_pr_line_item', PR_DB_COL_MAPPING, PR_COLUMN_TYPES, 'gh_pr_invalid_data', 'functional_location_code',
+                        with_hash=with_hash), PR_STATEMENTS),
+            (FeedSchema('PO', 'gh_sap_po_line_item', PO_DB_COL_MAPPING, PO_COLUMN_TYPES, 'gh_po_invalid_data', 'functional_location',
+                        pr_columns=['pr_nbr', 'pr_line_nbr'], with_status=True, insert_deleted=True, with_hash=with_hash), PO_STATEMENTS)]
+
+
+@pytest.mark.parametrize('schema, statements', schemas())
+def test_statements_match_the_old_statements(schema, statements):
+    for old, generated in statements.items():
+        assert normalized(getattr(schema, generated)) == normalized(OLD_STATEMENTS[old]), old
+
+
+@pytest.mark.parametrize('with_hash', [False, True])
+def test_builders_put_every_value_under_its_column(with_hash):
+    for schema, statements in schemas(with_hash):
+        # a row whose every value is the name of its column; values are named after theirs too.
+        row = tuple(schema.columns)
+        status = ('status_id',) if schema.table == 'gh_sap_po_line_item' else ()
+        builders = {'insert_SQL': (schema.insert_params, tuple(FeedSchema.GH_COLUMNS) + ('created',) + status),
+                    'raw_insert_SQL': (schema.raw_insert_params, tuple(FeedSchema.RAW_COLUMNS) + ('created',) + status),
+                    'update_SQL': (schema.update_params, tuple(FeedSchema.GH_COLUMNS) + ('updated', 'status_id')),
+                    'raw_update_SQL': (schema.raw_update_params, tuple(FeedSchema.RAW_COLUMNS) + ('updated',) + status),
+                    'status_UPDATE_SQL': (schema.status_params, ('record_type', 'updated', 'status_id'))}
+        for generated, (params, values) in builders.items():
+            sql = getattr(schema, generated)
+            assert params(row, values, 'content_hash') == tuple(sql_columns(sql)), generated
+            assert ('content_hash' in sql_columns(sql)) == with_hash
+
+        invalid_builders = {'invalid_insert_SQL': (schema.invalid_insert_params, ('aq_id',) + tuple(FeedSchema.GH_COLUMNS) + ('category', 'description', 'updated')),
+                            'invalid_update_SQL': (schema.invalid_update_params, tuple(FeedSchema.INVALID_STATE_COLUMNS) + ('updated',)),
+                            'invalid_delete_SQL': (schema.invalid_delete_params, ('updated', 'status_id'))}
+        for generated, (params, values) in invalid_builders.items():
+            sql = getattr(schema, generated)
+            assert params(row, values, 'content_hash') == tuple(sql_columns(sql)), generated
+            assert 'content_hash' not in sql
+
+
+def test_invalid_state_is_what_invalid_update_writes():
+    for schema, statements in schemas():
+        row = tuple(schema.columns)
+        values = ('AQ-1', 7, '8', 9, 10, 'desc ', 1)
+        state = schema.invalid_state(row, values)
+        # the state columns, in the order get_invalid_records() reads them, are the SET columns up to updated.
+        assert list(schema.invalid_state_columns) == sql_columns(schema.invalid_update_SQL)[:len(schema.invalid_state_columns)]
+        assert state == tuple(schema.pr_columns) + ('AQ-1', '7', '8', '9', '10', 'desc', '1')
+
+
+def test_provenance_and_report_key():
+    pr_schema, po_schema = [schema for schema, statements in schemas()]
+    pr_row = tuple(pr_schema.columns)
+    assert pr_schema.provenance_columns == ['pr_nbr', 'pr_line_nbr', 'file_name', 'created']
+    assert pr_schema.provenance_params(pr_row, ('f', 'now')) == ('pr_nbr', 'pr_line_nbr', 'f', 'now')
+    assert pr_schema.report_key(pr_row) == ('pr_nbr', 'pr_line_nbr', '', '')
+
+    po_row = tuple(po_schema.columns)
+    assert po_schema.provenance_columns == ['po_nbr', 'po_line_nbr', 'pr_nbr', 'pr_line_nbr', 'file_name', 'created']
+    assert po_schema.provenance_params(po_row, ('f', 'now')) == ('po_nbr', 'po_line_nbr', 'pr_nbr', 'pr_line_nbr', 'f', 'now')
+    assert po_schema.report_key(po_row) == ('pr_nbr', 'pr_line_nbr', 'po_nbr', 'po_line_nbr')
+
+
+def test_content_hash_changes_with_any_value():
+    row = ('PR1', 10, 'a')
+    assert FeedSchema.content_hash(row, (1, 2)) == FeedSchema.content_hash(row, (1, 2))
+    assert FeedSchema.content_hash(row, (1, 2)) != FeedSchema.content_hash(row, (1, 3))
+    # None and '' are different values.
+    assert FeedSchema.content_hash(row, (None,)) != FeedSchema.content_hash(row, ('',))
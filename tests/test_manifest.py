@@ -0,0 +1,90 @@
+import os
+
+from prpo_lib import ProcessingManifest, StatusWatcher, CommitPolicy
+
+from conftest import FakeConnection
+
+
+def manifest(tmp_path):
+    return ProcessingManifest(str(tmp_path / 'manifest.db'))
+
+
+def test_unfinished_lists_pending_processing_and_failed_files(tmp_path):
+    status_dir = tmp_path / 'status'
+    status_dir.mkdir()
+    (status_dir / 'PR-1.fetched').touch()
+    (status_dir / 'PR-1.processed').touch()
+    (status_dir / 'PR-2.error').touch()
+    m = manifest(tmp_path)
+    m.import_markers('PR', str(status_dir))
+
+    m.queue('PR', ['PR-3', 'PR-4', 'PR-5'])
+    m.start('PR', 'PR-4', 'sum4')
+    m.start('PR', 'PR-5', 'sum5')
+    m.finish('PR', 'PR-5', 'failed', error='OperationalError')
+
+    assert sorted(m.unfinished('PR')) == ['PR-3', 'PR-4', 'PR-5']
+    assert m.unfinished('PO') == []
+    assert m.is_done('PR', 'PR-1', False)
+    assert not m.is_done('PR', 'PR-3', False)
+
+
+def test_queue_keeps_the_rows_committed_by_a_failed_run(tmp_path):
+    m = manifest(tmp_path)
+    assert m.start('PO', 'PO-1', 'sum', resume=True) == 0
+    m.committed('PO', 'PO-1', 2000)
+    m.finish('PO', 'PO-1', 'failed', error='OperationalError')
+
+    m.queue('PO', ['PO-1'])
+    assert m.unfinished('PO') == ['PO-1']
+    assert m.start('PO', 'PO-1', 'sum', resume=True) == 2000
+
+
+def test_start_resumes_only_the_same_unfinished_datafile(tmp_path):
+    m = manifest(tmp_path)
+    m.start('PR', 'PR-1', 'sum')
+    m.committed('PR', 'PR-1', 1000)
+    # not resumed unless asked ('file' and 'savepoint' commit_mode).
+    assert m.start('PR', 'PR-1', 'sum') == 0
+
+    m.committed('PR', 'PR-1', 1000)
+    # the datafile was fetched again with other content.
+    assert m.start('PR', 'PR-1', 'other', resume=True) == 0
+
+    m.committed('PR', 'PR-1', 1000)
+    m.finish('PR', 'PR-1', 'processed', 1500)
+    assert m.start('PR', 'PR-1', 'other', resume=True) == 0
+
+
+def test_commit_policy_counts_on_from_the_resumed_row():
+    committed = []
+    policy = CommitPolicy([FakeConnection()], mode='rows', commit_every=1000, on_commit=committed.append, committed_rows=2000)
+    for _ in range(1000):
+        policy.row_done()
+    assert committed == [3000]
+
+
+def test_watcher_names_the_new_fetched_markers(tmp_path):
+    status_dir = tmp_path / 'status'
+    status_dir.mkdir()
+    watcher = StatusWatcher([str(status_dir)], 'inotify')
+    if watcher.inotify_fd is None:
+        return
+
+    (status_dir / 'PR-1.processed').touch()
+    (status_dir / 'PR-2.fetched').touch()
+    assert watcher.wait(5)
+    assert watcher.take_fetched() == {str(status_dir): {'PR-2'}}
+    assert watcher.take_fetched() == {str(status_dir): set()}
+    os.close(watcher.inotify_fd)
+
+
+def test_polling_watcher_asks_for_a_full_scan(tmp_path):
+    status_dir = tmp_path / 'status'
+    status_dir.mkdir()
+    watcher = StatusWatcher([str(status_dir)], 'poll', poll_seconds=0.01)
+    watcher.mtimes = [None]
+
+    assert watcher.wait(1)
+    assert watcher.take_fetched() is None
+    assert watcher.take_fetched() == {str(status_dir): set()}
@@ -0,0 +1,24 @@
+from decimal import Decimal
+
+from prpo_lib import QuantityAggregator, compare_pr_qty
+
+
+def test_quantities_are_summed_per_equipment_in_any_order():
+    rows = [(7, 3, 5, 1, Decimal('2.9')), (8, 3, 5, 1, 4), (7, 3, 5, 1, '3'), (7, 3, 6, 1, 1)]
+    records = QuantityAggregator('pr_qty').consume(rows).consume(reversed(rows)).records()
+    # every quantity is truncated with int() before it is added.
+    assert sorted(records, key=lambda record: (record['product_id'], record['equip_id'])) == [
+        {'product_id': 7, 'site_id': 3, 'equip_id': 5, 'equip_db_id': 1, 'pr_qty': 10},
+        {'product_id': 7, 'site_id': 3, 'equip_id': 6, 'equip_db_id': 1, 'pr_qty': 2},
+        {'product_id': 8, 'site_id': 3, 'equip_id': 5, 'equip_db_id': 1, 'pr_qty': 8}]
+
+
+def test_po_rows_are_totalled_as_po_qty():
+    assert QuantityAggregator('po_qty').consume([(7, 3, 5, 1, 2)]).records() == [{'product_id': 7, 'site_id': 3, 'equip_id': 5, 'equip_db_id': 1, 'po_qty': 2}]
+
+
+def test_compare_pr_qty_reports_differences_and_missing_equipment():
+    legacy = QuantityAggregator('pr_qty').consume([(7, 3, 5, 1, 2), (7, 3, 6, 1, 1)]).records()
+    other = QuantityAggregator('pr_qty').consume([(7, 3, 5, 1, 3)]).records()
+    assert sorted(compare_pr_qty(legacy, other)) == [((7, 3, 5, 1), 2, 3), ((7, 3, 6, 1), 1, None)]
+    assert compare_pr_qty(legacy, legacy) == []
@@ -0,0 +1,66 @@
+import json
+import time
+
+from conftest import FakeConnection
+
+from prpo_lib import ReferenceData, ReferenceDataCache, ValidationRules, INVALID_PRODUCT_SITE, NO_KPR_RELEASE
+
+PROBE = {'product_codes': 2, 'sites': 1, 'release_qty': None}
+
+
+def reference_data():
+    return ReferenceData({'T2053': {'product_id': 7, 'product_code': 'T2053', 'product_name': 'P7'}},
+                         {'AB12': {'site_id': 3, 'site': 'Site 3', 'site_sap_code': 'AB12'}},
+                         ValidationRules([{'product_id': 7, 'site_id': 3}],
+                                         [{'product_id': 7, 'site_id': 3, 'equipment_id': 5, 'equipment_db_id': 1}]))
+
+
+def counting_load():
+    loads = []
+    def load(conn, parallel):
+        loads.append(conn)
+        return reference_data()
+    return load, loads
+
+
+def test_snapshot_is_json_and_read_back_at_startup(tmp_path):
+    snapshot_file = str(tmp_path / 'reference.json')
+    conn = FakeConnection(lambda sql, args: [PROBE])
+    load, loads = counting_load()
+    cache = ReferenceDataCache(load, 3600, probe=True, snapshot_file=snapshot_file)
+    cache.get(conn)
+    assert len(loads) == 1
+    with open(snapshot_file) as f:
+        assert json.load(f)['valid_product_sites'] == [[7, 3]]
+
+    restarted_load, restarted_loads = counting_load()
+    restarted = ReferenceDataCache(restarted_load, 3600, probe=True, snapshot_file=snapshot_file)
+    data = restarted.get(conn)
+    # the probe signature survived the snapshot, so nothing was reloaded.
+    assert restarted_loads == []
+    assert data.products == reference_data().products
+    assert data.validation_rules.classify(7, 3, 5, 1)[0] == NO_KPR_RELEASE
+    assert data.validation_rules.classify(7, 4, 5, 1)[0] == INVALID_PRODUCT_SITE
+    assert data.validation_rules.classify(7, 3, 6, 1) == (None, None)
+
+
+def test_a_snapshot_of_another_shape_is_ignored(tmp_path):
+    snapshot_file = tmp_path / 'reference.json'
+    for content in ['not json', json.dumps([1, 2]),
+                    json.dumps({'loaded': time.time(), 'signature': None, 'products': {'T1': 'x'}, 'sites': {},
+                                'valid_product_sites': [], 'invalid_aqid_kpr_release': []}),
+                    json.dumps({'loaded': time.time(), 'signature': None, 'products': {}, 'sites': {},
+                                'valid_product_sites': [[7]], 'invalid_aqid_kpr_release': []})]:
+        snapshot_file.write_text(content)
+        cache = ReferenceDataCache(counting_load()[0], 3600, snapshot_file=str(snapshot_file))
+        assert cache.data is None
+
+
+def test_a_stale_snapshot_is_not_used(tmp_path):
+    snapshot_file = str(tmp_path / 'reference.json')
+    cache = ReferenceDataCache(counting_load()[0], 3600, snapshot_file=snapshot_file)
+    cache.get(FakeConnection())
+    assert ReferenceDataCache(counting_load()[0], 3600, snapshot_file=snapshot_file).data is not None
+    cache.loaded -= 7200
+    cache.write_snapshot()
+    assert ReferenceDataCache(counting_load()[0], 3600, snapshot_file=snapshot_file).data is None
@@ -0,0 +1,85 @@
+from collections import namedtuple
+from decimal import Decimal
+
+from prpo_lib import RowDecoder, PR_COLUMN_TYPES, DuplicateLineCollapser, DiagnosticsCollector
+
+HEADERS = [' PURCHASE_REQUISITION_NBR', 'PURCH_REQ_LINE_NBR', 'QUANTITY', 'REQUEST_DATE', 'RECORD_TYPE']
+COLUMNS = ['PURCHASE_REQUISITION_NBR', 'PURCH_REQ_LINE_NBR', 'QUANTITY', 'REQUEST_DATE', 'RECORD_TYPE']
+
+
+def test_untyped_rows_keep_the_datafile_strings():
+    decoder = RowDecoder(HEADERS, ['RECORD_TYPE', 'PURCHASE_REQUISITION_NBR', 'QUANTITY'], PR_COLUMN_TYPES)
+    rows = list(decoder.decode([['PR1', '00010', '2.5', '2020-01-31', 'I'], [], ['PR2', '20']]))
+
+    assert [tuple(row) for row in rows] == [('I', 'PR1', '2.5'), (None, 'PR2', None)]
+    assert rows[0].PURCHASE_REQUISITION_NBR == 'PR1'
+    assert decoder.num_malformed == 0
+
+
+def test_typed_rows_are_converted_once_and_malformed_rows_skipped():
+    malformed_rows = DiagnosticsCollector('Malformed datafile rows skipped:', 5)
+    decoder = RowDecoder(HEADERS, COLUMNS, PR_COLUMN_TYPES, typed=True, malformed_rows=malformed_rows)
+    rows = list(decoder.decode([['PR1', '00010', '2.5', '2020-01-31', 'I'],
+                                ['PR2', '10', '', '', 'U'],
+                                ['PR3', 'ten', '1', '2020-01-31', 'I'],
+                                ['PR4', '10', 'NaN', '2020-01-31', 'I'],
+                                ['PR5', '10', '1', '31/01/2020', 'I'],
+                                ['PR6', '10']]))
+
+    assert rows[0] == ('PR1', 10, Decimal('2.5'), '2020-01-31', 'I')
+    assert rows[1] == ('PR2', 10, '', '', 'U')
+    assert len(rows) == 2
+    assert decoder.num_malformed == 4
+    # counted by column, with the datafile line numbers (the header is line 1).
+    assert dict(malformed_rows.counts) == {'PURCH_REQ_LINE_NBR': 1, 'QUANTITY': 1, 'REQUEST_DATE': 1, 'too few columns': 1}
+    assert malformed_rows.samples['QUANTITY'] == ['line 5']
+
+
+Line = namedtuple('Line', ['PURCHASE_REQUISITION_NBR', 'PURCH_REQ_LINE_NBR', 'RECORD_TYPE', 'seq'])
+
+
+def collapse(rows, writes=None):
+    collapser = DuplicateLineCollapser('PURCHASE_REQUISITION_NBR', 'PURCH_REQ_LINE_NBR')
+    rows, superseded = collapser.collapse((Line(*row) for row in rows), writes)
+    # every row is still returned, in file order.
+    assert [row.seq for row in rows] == sorted(row.seq for row in rows)
+    return [row.seq for row, row_superseded in zip(rows, superseded) if not row_superseded], collapser.num_collapsed
+
+
+def test_collapse_keeps_the_last_write_of_a_line():
+    assert collapse([('PR1', '10', 'I', 1), ('PR1', '00010', 'U', 2), ('PR1', 10, 'U', 3)]) == ([3], 2)
+
+
+def test_collapse_keeps_the_write_before_a_delete():
+    assert collapse([('PR1', '10', 'I', 1), ('PR1', '10', 'U', 2), ('PR1', '10', 'D', 3), ('PR1', '10', 'D', 4)]) == ([2, 4], 2)
+    assert collapse([('PR1', '10', 'I', 1), ('PR1', '10', 'D', 2), ('PR1', '10', 'I', 3)]) == ([3], 2)
+
+
+def test_collapse_ignores_rows_that_do_not_write_their_line():
+    # the U does not map (product, site or AQ_ID), so the I still inserts the line before the U marks it C.
+    unmapped = lambda row: row.seq != 2
+    assert collapse([('PR1', '10', 'I', 1), ('PR1', '10', 'U', 2)], unmapped) == ([1, 2], 0)
+    assert collapse([('PR1', '10', 'I', 1), ('PR1', '10', 'U', 2), ('PR1', '10', 'U', 3)], unmapped) == ([2, 3], 1)
+    assert collapse([('PR1', '10', 'I', 1), ('PR1', '10', 'D', 2), ('PR1', '10', 'D', 3)], unmapped) == ([1, 2, 3], 0)
+
+
+def test_collapse_keeps_file_order_other_lines_and_other_record_types():
+    rows = [('PR1', '10', 'I', 1), ('PR2', '10', 'I', 2), ('PR1', '20', 'X', 3), ('PR1', '10', 'U', 4), ('PR1', '20', 'X', 5), ('PR2', '20', 'I', 6)]
+    assert collapse(rows) == ([2, 3, 4, 5, 6], 1)
+
+
+def test_diagnostics_are_counted_per_code_with_bounded_samples():
+    collector = DiagnosticsCollector('SAP Site Code not found in gh_sites:', 2)
+    assert not collector
+    for line in range(5):
+        collector.add('AB12', 'PR1-' + str(line))
+    collector.add('', 'PR2-1')
+    collector.add('ZZ', 'PR3-1')
+
+    assert len(collector) == 7
+    assert collector.samples['AB12'] == ['PR1-0', 'PR1-1']
+    assert collector.render().splitlines() == ['SAP Site Code not found in gh_sites: 7 recs, 3 codes',
+                                               'AB12: 5 (PR1-0, PR1-1, +3 more)',
+                                               "'': 1 (PR2-1)",
+                                               'ZZ: 1 (PR3-1)']
+    assert collector.render(max_codes=1).splitlines()[-1] == '+2 more codes'
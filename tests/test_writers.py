@@ -0,0 +1,87 @@
+import pymysql
+import pytest
+
+from conftest import FakeConnection
+
+from prpo_lib import BatchWriter, CommitPolicy, ProvenanceRecorder
+
+INSERT_SQL = 'INSERT INTO t (nbr, line_nbr, v) VALUES (%s, %s, %s)'
+UPDATE_SQL = 'UPDATE t SET v = %s WHERE nbr = %s AND line_nbr = %s'
+
+
+def test_batches_are_sent_every_batch_size_rows():
+    conn = FakeConnection()
+    writer = BatchWriter(conn, batch_size=2)
+    writer.add(INSERT_SQL, ('PR1', 1, 'a'), ('PR1', 1), 'rows_inserted')
+    assert conn.statements == []
+    writer.add(UPDATE_SQL, ('b', 'PR2', 1), ('PR2', 1), 'rows_updated')
+    writer.add(INSERT_SQL, ('PR3', 1, 'c'), ('PR3', 1), 'rows_inserted')
+    writer.flush()
+
+    assert conn.statements == [(INSERT_SQL, [('PR1', 1, 'a')]), (UPDATE_SQL, [('b', 'PR2', 1)]), (INSERT_SQL, [('PR3', 1, 'c')])]
+    assert writer.counts == {'rows_inserted': 2, 'rows_updated': 1}
+
+
+def test_a_second_statement_for_a_key_flushes_first():
+    conn = FakeConnection()
+    writer = BatchWriter(conn, batch_size=100)
+    writer.add(UPDATE_SQL, ('b', 'PR1', 1), ('PR1', 1), 'rows_updated')
+    writer.add(INSERT_SQL, ('PR2', 1, 'a'), ('PR2', 1), 'rows_inserted')
+    writer.add(INSERT_SQL, ('PR1', 1, 'c'), ('PR1', 1), 'rows_inserted')
+    writer.flush()
+
+    assert [args for sql, args in conn.statements] == [[('b', 'PR1', 1)], [('PR2', 1, 'a')], [('PR1', 1, 'c')]]
+
+
+def test_a_lock_wait_timeout_is_retried_from_the_savepoint():
+    failures = [pymysql.err.OperationalError(1205, 'Lock wait timeout exceeded')]
+
+    def answer_many(sql, seq_of_args):
+        if failures:
+            raise failures.pop()
+
+    conn = FakeConnection(answer_many=answer_many)
+    writer = BatchWriter(conn, savepoints=True)
+    writer.add(INSERT_SQL, ('PR1', 1, 'a'), ('PR1', 1), 'rows_inserted')
+    writer.flush()
+
+    assert [sql for sql, args in conn.statements] == ['SAVEPOINT batch_writer', INSERT_SQL, 'ROLLBACK TO SAVEPOINT batch_writer', INSERT_SQL]
+    assert writer.counts['rows_inserted'] == 1
+
+
+def test_other_errors_are_not_retried():
+    def answer_many(sql, seq_of_args):
+        raise pymysql.err.OperationalError(1213, 'Deadlock found')
+
+    writer = BatchWriter(FakeConnection(answer_many=answer_many), savepoints=True)
+    writer.add(INSERT_SQL, ('PR1', 1, 'a'), ('PR1', 1), 'rows_inserted')
+    with pytest.raises(pymysql.err.OperationalError):
+        writer.flush()
+
+
+def test_commit_policy_commits_every_n_rows_in_rows_mode():
+    conn, conn2 = FakeConnection(), FakeConnection()
+    provenance = ProvenanceRecorder(conn2, 'gh_pr_po_file', ['pr_nbr', 'pr_line_nbr'], batch_size=100)
+    committed = []
+    policy = CommitPolicy([conn2, conn], [provenance], 'rows', 2, committed.append)
+    for line in range(5):
+        provenance.record(('PR1', line))
+        policy.row_done()
+
+    assert (conn.commits, conn2.commits) == (2, 2)
+    assert committed == [2, 4]
+    assert provenance.num_recorded == 4
+
+    policy.rollback()
+    assert provenance.pending == []
+    assert (conn.rollbacks, conn2.rollbacks) == (1, 1)
+
+
+def test_commit_policy_commits_once_in_file_mode():
+    conn = FakeConnection()
+    policy = CommitPolicy([conn], [], 'file', 2)
+    for line in range(5):
+        policy.row_done()
+    assert conn.commits == 0
+    policy.commit()
+    assert conn.commits == 1